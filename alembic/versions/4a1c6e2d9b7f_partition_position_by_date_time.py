@@ -0,0 +1,124 @@
+"""Partition position by date_time
+
+Turns sms.position into a table partitioned by range of date_time with a partition per month
+and a default partition, requires PostgreSQL >= 11.
+A BRIN index on date_time replaces sequential scans for time range queries like the one of /status.
+Table and column grants of the old table are copied to the partitioned table,
+rows are inserted through the partitioned table so the partitions themselves need no grants.
+
+Use `sms_partitions` to create partitions for future months and detach old partitions.
+
+sms.raw_message is not partitioned, as a unique message_id can not be enforced on a table partitioned by time.
+
+As it requires PostgreSQL >= 11 this migration is opt-in, on its own `partitioning` branch,
+which the `sms` branch of the other migrations does not depend on.
+Opt in with `alembic upgrade partitioning@head`.
+
+Revision ID: 4a1c6e2d9b7f
+Revises: 340b921f3d41
+Create Date: 2026-10-18 10:12:41.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4a1c6e2d9b7f'
+down_revision = '340b921f3d41'
+branch_labels = ('partitioning',)
+depends_on = None
+
+from alembic import op
+
+
+def copy_grants(from_table, to_table):
+    """Copies table and column privileges between tables in sms schema"""
+    op.execute("""
+    DO $$
+    DECLARE
+        r record;
+    BEGIN
+        FOR r IN SELECT grantee, privilege_type FROM information_schema.role_table_grants
+                 WHERE table_schema = 'sms' AND table_name = '{from_table}' AND grantee NOT IN (current_user, 'PUBLIC')
+        LOOP
+            EXECUTE format('GRANT %s ON sms.{to_table} TO %I', r.privilege_type, r.grantee);
+        END LOOP;
+        FOR r IN SELECT grantee, privilege_type, column_name FROM information_schema.column_privileges
+                 WHERE table_schema = 'sms' AND table_name = '{from_table}' AND grantee NOT IN (current_user, 'PUBLIC')
+        LOOP
+            EXECUTE format('GRANT %s (%I) ON sms.{to_table} TO %I', r.privilege_type, r.column_name, r.grantee);
+        END LOOP;
+    END
+    $$
+    """.format(from_table=from_table, to_table=to_table))
+
+
+def upgrade():
+    op.execute('ALTER TABLE sms.position RENAME TO position_unpartitioned')
+    op.execute('ALTER TABLE sms.position_unpartitioned RENAME CONSTRAINT position_pkey TO position_unpartitioned_pkey')
+    op.execute('ALTER TABLE sms.position_unpartitioned RENAME CONSTRAINT position_device_info_serial_date_time_key '
+               'TO position_unpartitioned_device_info_serial_date_time_key')
+    op.execute('ALTER INDEX sms.idx_position_location RENAME TO idx_position_unpartitioned_location')
+
+    op.execute("""
+    CREATE TABLE sms.position (
+        id INTEGER NOT NULL,
+        device_info_serial INTEGER,
+        date_time TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+        lon FLOAT,
+        lat FLOAT,
+        location geometry(POINT,4326),
+        PRIMARY KEY (id, date_time),
+        UNIQUE (device_info_serial, date_time),
+        FOREIGN KEY(id) REFERENCES sms.message (id)
+    ) PARTITION BY RANGE (date_time)
+    """)
+    op.execute('CREATE TABLE sms.position_default PARTITION OF sms.position DEFAULT')
+    # A partition for each month with positions and the next 3 months
+    op.execute("""
+    DO $$
+    DECLARE
+        month timestamp;
+    BEGIN
+        FOR month IN SELECT generate_series(
+            coalesce(date_trunc('month', (SELECT min(date_time) FROM sms.position_unpartitioned)), date_trunc('month', now() AT TIME ZONE 'UTC')),
+            date_trunc('month', greatest(now() AT TIME ZONE 'UTC', (SELECT max(date_time) FROM sms.position_unpartitioned))) + interval '3 months',
+            interval '1 month'
+        )
+        LOOP
+            EXECUTE format('CREATE TABLE sms.%I PARTITION OF sms.position FOR VALUES FROM (%L) TO (%L)',
+                           'position_y' || to_char(month, 'YYYY') || 'm' || to_char(month, 'MM'),
+                           month, month + interval '1 month');
+        END LOOP;
+    END
+    $$
+    """)
+    op.execute('CREATE INDEX idx_position_location ON sms.position USING GIST (location)')
+    op.execute('CREATE INDEX idx_position_date_time ON sms.position USING BRIN (date_time)')
+    # Insert in time order, so BRIN block ranges are tight
+    op.execute('INSERT INTO sms.position SELECT * FROM sms.position_unpartitioned ORDER BY date_time')
+    copy_grants('position_unpartitioned', 'position')
+    op.execute('DROP TABLE sms.position_unpartitioned')
+
+
+def downgrade():
+    op.execute('ALTER TABLE sms.position RENAME TO position_partitioned')
+    op.execute('ALTER INDEX sms.idx_position_location RENAME TO idx_position_partitioned_location')
+    op.execute('ALTER INDEX sms.position_pkey RENAME TO position_partitioned_pkey')
+    op.execute('ALTER INDEX sms.position_device_info_serial_date_time_key '
+               'RENAME TO position_partitioned_device_info_serial_date_time_key')
+    op.execute("""
+    CREATE TABLE sms.position (
+        id INTEGER NOT NULL,
+        device_info_serial INTEGER,
+        date_time TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+        lon FLOAT,
+        lat FLOAT,
+        location geometry(POINT,4326),
+        PRIMARY KEY (id, date_time),
+        UNIQUE (device_info_serial, date_time),
+        FOREIGN KEY(id) REFERENCES sms.message (id)
+    )
+    """)
+    op.execute('INSERT INTO sms.position SELECT * FROM sms.position_partitioned')
+    op.execute('CREATE INDEX idx_position_location ON sms.position USING GIST (location)')
+    copy_grants('position_partitioned', 'position')
+    op.execute('DROP TABLE sms.position_partitioned CASCADE')
@@ -0,0 +1,38 @@
+"""Generated position location
+
+Turns sms.position.location into a column generated from lon and lat, requires PostgreSQL >= 12.
+The receiver then must not send a point per position, so this migration is on its own `generated_location` branch,
+which `head` of the other migrations does not depend on.
+Opt in by setting `location = database` in the ini file and running `alembic upgrade generated_location@head`.
+It builds on the partitioning migration, which recreates sms.position with a plain location column,
+so upgrading to `generated_location@head` also partitions sms.position.
+
+Revision ID: 7d3e5f1a2c84
+Revises: 4a1c6e2d9b7f
+Create Date: 2026-10-18 14:02:19.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7d3e5f1a2c84'
+down_revision = '4a1c6e2d9b7f'
+branch_labels = ('generated_location',)
+depends_on = None
+
+from alembic import op
+
+
+def upgrade():
+    op.execute('DROP INDEX sms.idx_position_location')
+    op.execute('ALTER TABLE sms.position DROP COLUMN location')
+    op.execute('ALTER TABLE sms.position ADD COLUMN location geometry(POINT,4326) '
+               'GENERATED ALWAYS AS (ST_SetSRID(ST_MakePoint(lon, lat), 4326)) STORED')
+    op.execute('CREATE INDEX idx_position_location ON sms.position USING GIST (location)')
+
+
+def downgrade():
+    op.execute('DROP INDEX sms.idx_position_location')
+    op.execute('ALTER TABLE sms.position DROP COLUMN location')
+    op.execute('ALTER TABLE sms.position ADD COLUMN location geometry(POINT,4326)')
+    op.execute('UPDATE sms.position SET location = ST_SetSRID(ST_MakePoint(lon, lat), 4326)')
+    op.execute('CREATE INDEX idx_position_location ON sms.position USING GIST (location)')
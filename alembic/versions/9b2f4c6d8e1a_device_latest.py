@@ -0,0 +1,75 @@
+"""Device latest state
+
+Adds sms.device_latest with the latest message and fix of each device, filled from the existing messages and positions.
+Set `devices.latest = true` in the ini file after upgrading, so ingest keeps it up to date and /status/devices is enabled.
+Roles which can insert into sms.message are granted the privileges needed to upsert into sms.device_latest.
+Does not depend on the partitioning or generated location migrations, sms.device_latest is not partitioned.
+
+Revision ID: 9b2f4c6d8e1a
+Revises: 340b921f3d41
+Create Date: 2026-10-18 16:21:07.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9b2f4c6d8e1a'
+down_revision = '340b921f3d41'
+# main line, the partitioning and generated location migrations are opt-in branches
+branch_labels = ('sms',)
+depends_on = None
+
+from alembic import op
+
+
+def upgrade():
+    op.execute("""
+    CREATE TABLE sms.device_latest (
+        device_info_serial INTEGER NOT NULL,
+        message_date_time TIMESTAMP WITHOUT TIME ZONE,
+        battery_voltage FLOAT(3),
+        memory_usage FLOAT(1),
+        gateway_id VARCHAR,
+        date_time TIMESTAMP WITHOUT TIME ZONE,
+        lon FLOAT,
+        lat FLOAT,
+        location geometry(POINT,4326),
+        max_age FLOAT,
+        min_battery_voltage FLOAT,
+        PRIMARY KEY (device_info_serial)
+    )
+    """)
+    op.execute("""
+    INSERT INTO sms.device_latest (device_info_serial, message_date_time, battery_voltage, memory_usage, gateway_id)
+    SELECT DISTINCT ON (m.device_info_serial) m.device_info_serial, m.date_time, m.battery_voltage, m.memory_usage, r.gateway_id
+    FROM sms.message m JOIN sms.raw_message r USING (id)
+    WHERE m.device_info_serial IS NOT NULL
+    ORDER BY m.device_info_serial, m.date_time DESC NULLS LAST
+    """)
+    op.execute("""
+    UPDATE sms.device_latest d
+    SET date_time = p.date_time, lon = p.lon, lat = p.lat, location = ST_SetSRID(ST_MakePoint(p.lon, p.lat), 4326)
+    FROM (
+        SELECT DISTINCT ON (device_info_serial) device_info_serial, date_time, lon, lat
+        FROM sms.position
+        ORDER BY device_info_serial, date_time DESC
+    ) p
+    WHERE p.device_info_serial = d.device_info_serial
+    """)
+    op.execute("""
+    DO $$
+    DECLARE
+        r record;
+    BEGIN
+        FOR r IN SELECT DISTINCT grantee FROM information_schema.role_table_grants
+                 WHERE table_schema = 'sms' AND table_name = 'message' AND privilege_type = 'INSERT'
+                 AND grantee NOT IN (current_user, 'PUBLIC')
+        LOOP
+            EXECUTE format('GRANT SELECT, INSERT, UPDATE ON sms.device_latest TO %I', r.grantee);
+        END LOOP;
+    END
+    $$
+    """)
+
+
+def downgrade():
+    op.execute('DROP TABLE sms.device_latest')
@@ -0,0 +1,30 @@
+"""Archive raw messages
+
+Drops the foreign key from sms.message to sms.raw_message,
+so raw messages can be moved to a columnar archive with `sms_archive` while their messages and positions are kept.
+The id of a message remains the id of its raw message, in the database or in the archive.
+On the `sms` branch, so archiving does not require the partitioning or generated location migrations.
+
+Revision ID: c4e8a1f2b3d5
+Revises: 9b2f4c6d8e1a
+Create Date: 2026-10-18 18:40:12.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c4e8a1f2b3d5'
+down_revision = '9b2f4c6d8e1a'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+
+
+def upgrade():
+    op.execute('ALTER TABLE sms.message DROP CONSTRAINT IF EXISTS message_id_fkey')
+
+
+def downgrade():
+    # not validated, messages of archived raw messages have no raw message in the database
+    op.execute('ALTER TABLE sms.message ADD CONSTRAINT message_id_fkey '
+               'FOREIGN KEY (id) REFERENCES sms.raw_message (id) NOT VALID')
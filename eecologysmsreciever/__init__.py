@@ -1,28 +1,119 @@
+import time
+# before the other imports, so their duration is part of the startup time
+IMPORT_STARTED = time.time()
+
 import os
 from pyramid.config import Configurator
-from sqlalchemy import engine_from_config
+from pyramid.settings import asbool
+from sqlalchemy.orm import configure_mappers
 
+from .admission import AdmissionControl, optional
+from .breaker import CircuitBreaker
+from .bulkhead import Bulkhead, bulkheads_from_settings
+from .db import engine_from_settings, read_settings, warm_up
+from .metrics import METRICS
 from .models import (
     DBSession,
+    ReadSession,
     Base,
+    LOCATION_EWKT,
+    LOCATION_MODES,
 )
+from .recent import RecentlySeen
+from .spool import Spool, SpoolDrainer, DEFAULT_MAX_FAILURES
+from .startup import Startup
+from .watermark import Watermark
+from .writer import warm_statements
 
+IMPORTED = time.time()
 
-def main(global_config, **settings):
-    """ This function returns a Pyramid WSGI application.
-    """
+
+def environ_settings(settings):
+    """Overwrites database url and secret key settings with DB_URL and SECRET_KEY environment variables"""
     old_url = settings.get('sqlalchemy.url')
     settings['sqlalchemy.url'] = os.environ.get('DB_URL', old_url)
     old_secret = settings.get('secret_key')
     settings['secret_key'] = os.environ.get('SECRET_KEY', old_secret)
-    engine = engine_from_config(settings, 'sqlalchemy.')
-    DBSession.configure(bind=engine)
-    Base.metadata.bind = engine
+    return settings
 
+
+def main(global_config, **settings):
+    """ This function returns a Pyramid WSGI application.
+    """
+    startup = Startup(IMPORT_STARTED, IMPORTED)
+    environ_settings(settings)
     settings['alert_too_old'] = int(settings['alert_too_old'])
+    # before engine is made, as prepared statements depend on it
+    location = settings.setdefault('location', LOCATION_EWKT)
+    if location not in LOCATION_MODES:
+        raise ValueError('location setting must be one of {0}'.format(', '.join(LOCATION_MODES)))
+    settings['devices.latest'] = asbool(settings.get('devices.latest', False))
+
+    with startup.phase('configure'):
+        engine = engine_from_settings(settings)
+        DBSession.configure(bind=engine)
+        Base.metadata.bind = engine
+        read_config = read_settings(settings)
+        read_engine = engine_from_settings(read_config)
+        ReadSession.configure(bind=read_engine)
+        # otherwise done by the first request
+        configure_mappers()
+        warm_statements(location)
+    with startup.phase('warm_up'):
+        warm_up(engine, int(settings.get('db.warm_up', 0)))
+        warm_up(read_engine, int(read_config.get('db.warm_up', 0)))
 
     config = Configurator(settings=settings)
+    config.registry.startup = startup
+    config.registry.engine = engine
+    config.registry.read_engine = read_engine
+    config.registry.bulkheads = bulkheads_from_settings(settings)
+    if asbool(settings.get('admission.enabled', False)):
+        config.registry.admission = AdmissionControl.from_settings(settings, engine.pool)
+    breaker = None
+    if asbool(settings.get('breaker.enabled', False)):
+        breaker = CircuitBreaker.from_settings(settings)
+        config.registry.breaker = breaker
+    config.add_tween('eecologysmsreciever.bulkhead.bulkhead_tween_factory')
+    # an export holds a read connection while it is downloaded, others are rejected instead of waiting
+    config.registry.exports = Bulkhead(int(settings.get('export.concurrency', 1)), queue=0, timeout=0)
+    watermark = Watermark(settings.get('status.watermark_path'),
+                          fallback_interval=float(settings.get('status.fallback_interval', 300)))
+    config.registry.watermark = watermark
+    if settings.get('metrics.dir'):
+        METRICS.share(settings['metrics.dir'], interval=float(settings.get('metrics.interval', 5)))
+    recent_size = int(settings.get('recent.size', 0))
+    if recent_size > 0:
+        recent_ttl = float(settings.get('recent.ttl', 3600))
+        config.registry.recent_messages = RecentlySeen(recent_size, recent_ttl)
+        config.registry.recent_positions = RecentlySeen(recent_size, recent_ttl)
+    if settings.get('spool.path'):
+        spool = Spool(settings['spool.path'],
+                      compact_size=int(settings.get('spool.compact_size', 1048576)))
+        drainer = SpoolDrainer(spool, engine,
+                               batch_size=int(settings.get('spool.batch_size', 100)),
+                               interval=float(settings.get('spool.interval', 1.0)),
+                               watermark=watermark,
+                               location=location,
+                               device_latest=settings['devices.latest'],
+                               breaker=breaker,
+                               max_failures=optional(int, settings.get('spool.max_drain_failures',
+                                                                       DEFAULT_MAX_FAILURES)))
+        drainer.start()
+        config.registry.spool = spool
+        config.registry.spool_drainer = drainer
     config.add_route('messages', '/messages')
+    config.add_route('messages_batch', '/messages/batch')
     config.add_route('status', '/status')
-    config.scan()
-    return config.make_wsgi_app()
+    config.add_route('pool_status', '/status/pool')
+    config.add_route('device_status', '/status/devices')
+    config.add_route('positions', '/positions')
+    config.add_route('export', '/export')
+    config.add_route('metrics', '/metrics')
+    config.add_route('ready', '/status/ready')
+    with startup.phase('scan'):
+        # only the views, scanning the package would import the scripts and their optional dependencies
+        config.scan('.views')
+        app = config.make_wsgi_app()
+    startup.mark_ready()
+    return app
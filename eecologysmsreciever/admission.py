@@ -0,0 +1,183 @@
+"""Admission control of messages which are stored in the database.
+
+When the database slows down, requests pile up waiting for it, gateways time out and resend,
+adding load when the database can least take it.
+Before a message is stored, the database load of the worker process is checked and
+when it is over a limit the message is rejected at once with 503 Service Unavailable and a Retry-After header,
+SMSSync keeps the message and sends it again later.
+
+The database load is measured by
+
+* in flight, nr of messages being stored
+* pool wait, recent seconds waited for a connection from the pool
+* latency, recent seconds it took to store a message
+
+Recent values are averages which decay towards zero while no messages are stored,
+so rejecting all messages does not keep the averages high forever.
+
+Limits are set with `admission.max_in_flight`, `admission.max_pool_wait` and `admission.max_latency` settings
+and can be set for a single gateway with `admission.gateway.<gateway_id>.<limit>` settings,
+for example to shed messages of a gateway sooner or to limit the nr of its messages in flight.
+Resends acknowledged from the recently seen cache and spooled messages are not limited, they do not wait for the database.
+"""
+from collections import namedtuple
+import threading
+import time
+
+from sqlalchemy.pool import QueuePool
+
+Limits = namedtuple('Limits', ['max_in_flight', 'max_pool_wait', 'max_latency'])
+
+DEFAULT_MAX_POOL_WAIT = 1.0
+DEFAULT_RETRY_AFTER = 30
+GATEWAY_PREFIX = 'admission.gateway.'
+
+
+class DecayingAverage(object):
+    """Exponentially weighted average which halves every `half_life` seconds without new values
+
+    :param half_life: (float) seconds
+    :param weight: (float) weight of a new value
+    """
+
+    def __init__(self, half_life=10.0, weight=0.2):
+        self.half_life = half_life
+        self.weight = weight
+        self._value = 0.0
+        self._updated = None
+        self._lock = threading.Lock()
+
+    def _decayed(self, now):
+        if self._updated is None:
+            return 0.0
+        return self._value * 0.5 ** ((now - self._updated) / self.half_life)
+
+    def add(self, value):
+        now = time.time()
+        with self._lock:
+            self._value = self.weight * value + (1 - self.weight) * self._decayed(now)
+            self._updated = now
+
+    def value(self):
+        with self._lock:
+            return self._decayed(time.time())
+
+
+class AdmissionControl(object):
+    """Decides whether a message may be stored in the database now
+
+    :param limits: (Limits) limits of all gateways, a None limit is not checked
+    :param gateway_limits: (dict) Limits by gateway_id, overriding `limits`,
+        max_in_flight of a gateway limits the nr of messages in flight of that gateway
+    :param pool_stats: (eecologysmsreciever.db.PoolStats) statistics of the connection pool or None
+    :param retry_after: (int) seconds a rejected gateway should wait before trying again
+    """
+
+    def __init__(self, limits, gateway_limits=None, pool_stats=None, retry_after=DEFAULT_RETRY_AFTER):
+        self.limits = limits
+        self.gateway_limits = gateway_limits or {}
+        self.pool_stats = pool_stats
+        self.retry_after = retry_after
+        self.latency = DecayingAverage()
+        self.in_flight = 0
+        self.gateway_in_flight = {}
+        self.admitted = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, settings, pool=None):
+        """Admission control configured with `admission.*` settings
+
+        By default at most as many messages are in flight as the pool has connections,
+        so messages are rejected instead of waiting for a connection.
+        Latency is not limited by default, a single slow store would otherwise reject the messages after it.
+
+        :param settings: (dict) app settings
+        :param pool: SQLAlchemy pool of ingest
+        :return: (AdmissionControl)
+        """
+        default_max_in_flight = None
+        if isinstance(pool, QueuePool):
+            default_max_in_flight = pool.size() + max(pool._max_overflow, 0)
+        limits = Limits(optional(int, settings.get('admission.max_in_flight', default_max_in_flight)),
+                        optional(float, settings.get('admission.max_pool_wait', DEFAULT_MAX_POOL_WAIT)),
+                        optional(float, settings.get('admission.max_latency')))
+        gateway_settings = {}
+        for key, value in settings.items():
+            if key.startswith(GATEWAY_PREFIX):
+                gateway_id, _, limit = key[len(GATEWAY_PREFIX):].rpartition('.')
+                if limit not in Limits._fields:
+                    raise ValueError('Unknown admission limit {0}, must be one of {1}'.format(
+                        key, ', '.join(Limits._fields)))
+                gateway_settings.setdefault(gateway_id, {})[limit] = value
+        gateway_limits = {}
+        for gateway_id, values in gateway_settings.items():
+            gateway_limits[gateway_id] = Limits(optional(int, values.get('max_in_flight')),
+                                                optional(float, values.get('max_pool_wait', limits.max_pool_wait)),
+                                                optional(float, values.get('max_latency', limits.max_latency)))
+        return cls(limits, gateway_limits, getattr(pool, 'stats', None),
+                   retry_after=int(settings.get('admission.retry_after', DEFAULT_RETRY_AFTER)))
+
+    def admit(self, gateway_id):
+        """Checks limits of gateway and reserves a slot in flight for the message when it is admitted
+
+        Limits are checked and the slot is reserved under a single lock,
+        so concurrent messages can not exceed the in flight limits together.
+        An admitted message must be released with `release`.
+
+        :param gateway_id: (str) gateway of message
+        :return: (str) name of the limit which was exceeded or None when message is admitted
+        """
+        gateway_limits = self.gateway_limits.get(gateway_id)
+        limits = gateway_limits or self.limits
+        with self._lock:
+            reason = None
+            if self.limits.max_in_flight is not None and self.in_flight >= self.limits.max_in_flight:
+                reason = 'in_flight'
+            elif (gateway_limits is not None and gateway_limits.max_in_flight is not None and
+                  self.gateway_in_flight.get(gateway_id, 0) >= gateway_limits.max_in_flight):
+                reason = 'gateway_in_flight'
+            elif (limits.max_pool_wait is not None and self.pool_stats is not None and
+                  self.pool_stats.recent_wait.value() > limits.max_pool_wait):
+                reason = 'pool_wait'
+            elif limits.max_latency is not None and self.latency.value() > limits.max_latency:
+                reason = 'latency'
+            if reason is None:
+                self.admitted += 1
+                self.in_flight += 1
+                self.gateway_in_flight[gateway_id] = self.gateway_in_flight.get(gateway_id, 0) + 1
+            else:
+                self.rejected += 1
+        return reason
+
+    def release(self, gateway_id, seconds=None):
+        """Releases the slot in flight reserved by `admit`
+
+        :param gateway_id: (str) gateway of message
+        :param seconds: (float) seconds it took to store the message, None when the database was not used
+        """
+        if seconds is not None:
+            self.latency.add(seconds)
+        with self._lock:
+            self.in_flight -= 1
+            self.gateway_in_flight[gateway_id] -= 1
+            if not self.gateway_in_flight[gateway_id]:
+                del self.gateway_in_flight[gateway_id]
+
+    def statistics(self):
+        return {
+            'in_flight': self.in_flight,
+            'latency': self.latency.value(),
+            'pool_wait': self.pool_stats.recent_wait.value() if self.pool_stats is not None else None,
+            'admitted': self.admitted,
+            'rejected': self.rejected,
+            'limits': self.limits._asdict(),
+        }
+
+
+def optional(convert, value):
+    """Converted value or None when value is None or empty"""
+    if value is None or value == '':
+        return None
+    return convert(value)
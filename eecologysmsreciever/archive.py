@@ -0,0 +1,298 @@
+"""Columnar archive of old raw messages.
+
+`sms_archive` moves raw messages sent before a cutoff out of sms.raw_message into zstd compressed Parquet files,
+a file per month of sent_timestamp per run, in row groups of a batch of raw messages ordered by id::
+
+    archive/
+        manifest.json
+        2015-06/raw_message-1203.parquet
+        2015-07/raw_message-4410.parquet
+
+`manifest.json` lists each file with its month, nr of rows, id and sent_timestamp range, SHA-256 checksum and
+whether its raw messages have been deleted from the database.
+A file is only added to the manifest when it is complete, files which are not in the manifest are from an interrupted run.
+
+`Archive` reads files memory-mapped, a row group at a time, for example to re-parse archived raw messages with
+`sms_reparse --archive`.
+
+Requires pyarrow, install with `pip install eEcology-SMS-reciever[archive]`.
+"""
+from datetime import datetime
+import hashlib
+import heapq
+import json
+import os
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+MANIFEST = 'manifest.json'
+SCHEMA = pa.schema([
+    ('id', pa.int64()),
+    ('message_id', pa.string()),
+    ('sent_from', pa.string()),
+    ('body', pa.string()),
+    ('sent_to', pa.string()),
+    ('gateway_id', pa.string()),
+    ('sent_timestamp', pa.timestamp('us')),
+])
+COLUMNS = tuple(SCHEMA.names)
+COMPRESSION = 'zstd'
+TMP_SUFFIX = '.tmp'
+
+
+def month_of(sent_timestamp):
+    """Partition of a raw message, `YYYY-MM` of its sent_timestamp"""
+    return sent_timestamp.strftime('%Y-%m')
+
+
+def isoformat(value):
+    return None if value is None else value.isoformat()
+
+
+def sha256sum(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class PartitionWriter(object):
+    """Writes raw messages of a month to a Parquet file, a row group per `row_group_size` raw messages
+
+    The file is written under a temporary name and renamed by `close`.
+
+    :param path: (str) path of file
+    :param month: (str) partition, see `month_of`
+    :param row_group_size: (int) nr of raw messages per row group
+    """
+
+    def __init__(self, path, month, row_group_size=10000):
+        self.path = path
+        self.month = month
+        self.row_group_size = row_group_size
+        self.rows = 0
+        self.first_id = None
+        self.last_id = None
+        self.first_sent_timestamp = None
+        self.last_sent_timestamp = None
+        self._columns = [[] for _ in COLUMNS]
+        self._writer = pq.ParquetWriter(path + TMP_SUFFIX, SCHEMA, compression=COMPRESSION)
+
+    def write(self, row):
+        """Adds a raw message
+
+        :param row: (tuple) with values of COLUMNS, rows must be written in id order
+        """
+        for column, value in zip(self._columns, row):
+            column.append(value)
+        raw_id, sent_timestamp = row[0], row[-1]
+        if self.first_id is None:
+            self.first_id = raw_id
+        self.last_id = raw_id
+        if self.first_sent_timestamp is None or sent_timestamp < self.first_sent_timestamp:
+            self.first_sent_timestamp = sent_timestamp
+        if self.last_sent_timestamp is None or sent_timestamp > self.last_sent_timestamp:
+            self.last_sent_timestamp = sent_timestamp
+        self.rows += 1
+        if len(self._columns[0]) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if not self._columns[0]:
+            return
+        arrays = [pa.array(column, type=field.type) for column, field in zip(self._columns, SCHEMA)]
+        self._writer.write_table(pa.Table.from_arrays(arrays, schema=SCHEMA))
+        self._columns = [[] for _ in COLUMNS]
+
+    def close(self):
+        """Completes file
+
+        :return: (dict) manifest entry of file, with path relative to archive directory
+        """
+        self.flush()
+        self._writer.close()
+        with open(self.path + TMP_SUFFIX, 'rb') as f:
+            os.fsync(f.fileno())
+        os.rename(self.path + TMP_SUFFIX, self.path)
+        return {
+            'path': os.path.join(self.month, os.path.basename(self.path)),
+            'month': self.month,
+            'rows': self.rows,
+            'first_id': self.first_id,
+            'last_id': self.last_id,
+            'first_sent_timestamp': isoformat(self.first_sent_timestamp),
+            'last_sent_timestamp': isoformat(self.last_sent_timestamp),
+            'sha256': sha256sum(self.path),
+            'archived_at': isoformat(datetime.utcnow()),
+            'deleted': False,
+        }
+
+
+class Archive(object):
+    """Directory with Parquet files of raw messages and their manifest
+
+    :param directory: (str) archive directory, created when missing
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.manifest_path = os.path.join(directory, MANIFEST)
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {'table': 'sms.raw_message', 'columns': list(COLUMNS), 'files': []}
+
+    @property
+    def files(self):
+        """Manifest entries of files"""
+        return self.manifest['files']
+
+    def pending(self):
+        """Manifest entries of files whose raw messages have not been deleted from the database yet"""
+        return [entry for entry in self.files if not entry['deleted']]
+
+    def path(self, entry):
+        return os.path.join(self.directory, entry['path'])
+
+    def save(self):
+        """Writes manifest, replacing the previous one at once"""
+        tmp_path = self.manifest_path + TMP_SUFFIX
+        with open(tmp_path, 'w') as f:
+            json.dump(self.manifest, f, indent=2, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.manifest_path)
+
+    def writer(self, month, first_id, row_group_size=10000):
+        """Writer of a new file of a month, named after the id of its first raw message"""
+        month_directory = os.path.join(self.directory, month)
+        if not os.path.isdir(month_directory):
+            os.makedirs(month_directory)
+        path = os.path.join(month_directory, 'raw_message-{0}.parquet'.format(first_id))
+        return PartitionWriter(path, month, row_group_size)
+
+    def add(self, entries):
+        """Adds manifest entries of completed files and saves manifest"""
+        self.files.extend(entries)
+        self.save()
+
+    def mark_deleted(self, entry):
+        entry['deleted'] = True
+        self.save()
+
+    def remove_incomplete(self):
+        """Removes files of an interrupted run, which are not in the manifest
+
+        :return: (list) paths of removed files
+        """
+        listed = set(self.path(entry) for entry in self.files)
+        removed = []
+        for dirpath, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                if filename.endswith(TMP_SUFFIX) or (filename.endswith('.parquet') and path not in listed):
+                    os.remove(path)
+                    removed.append(path)
+        return removed
+
+    def verify(self, entry):
+        """Whether file matches its checksum in the manifest"""
+        return sha256sum(self.path(entry)) == entry['sha256']
+
+    def parquet_file(self, entry):
+        """Memory-mapped Parquet file of manifest entry"""
+        return pq.ParquetFile(self.path(entry), memory_map=True)
+
+    def table(self, month, columns=None):
+        """pyarrow Table with the raw messages of a month, read from memory-mapped files
+
+        :param month: (str) `YYYY-MM`
+        :param columns: (list) names of columns to read, None for all
+        """
+        tables = [pq.read_table(self.path(entry), columns=columns, memory_map=True)
+                  for entry in self.files if entry['month'] == month]
+        if not tables:
+            raise KeyError('No raw messages archived in {0}'.format(month))
+        return pa.concat_tables(tables)
+
+    def ids(self, entry):
+        """Ids of raw messages of file, a list per row group"""
+        parquet_file = self.parquet_file(entry)
+        for index in range(parquet_file.num_row_groups):
+            yield parquet_file.read_row_group(index, columns=['id']).column(0).to_pylist()
+
+    def rows(self, entry, columns):
+        """Tuples with `columns` of raw messages of a file, in id order, read a row group at a time"""
+        parquet_file = self.parquet_file(entry)
+        for index in range(parquet_file.num_row_groups):
+            values = parquet_file.read_row_group(index, columns=list(columns)).to_pydict()
+            for row in zip(*[values[column] for column in columns]):
+                yield row
+
+    def raw_messages(self, columns=('id', 'body', 'sent_timestamp'), start_id=None, end_id=None,
+                     since=None, until=None):
+        """Archived raw messages in id order over all files
+
+        Files are opened when the next id could be in them, so only files with overlapping id ranges are open at once.
+
+        :param columns: (tuple) names of columns of each raw message, must start with id
+        :param start_id: (int) first id
+        :param end_id: (int) last id
+        :param since: (datetime) sent at or after
+        :param until: (datetime) sent before
+        :return: generator of tuples
+        """
+        if columns[0] != 'id':
+            raise ValueError('First column must be id')
+        entries = sorted((entry for entry in self.files
+                          if (start_id is None or entry['last_id'] >= start_id)
+                          and (end_id is None or entry['first_id'] <= end_id)),
+                         key=lambda entry: entry['first_id'])
+        read_columns = list(columns)
+        if (since is not None or until is not None) and 'sent_timestamp' not in read_columns:
+            read_columns.append('sent_timestamp')
+        sent_timestamp_index = read_columns.index('sent_timestamp') if 'sent_timestamp' in read_columns else None
+        for row in merge_by_id([self.rows(entry, read_columns) for entry in entries],
+                               [entry['first_id'] for entry in entries]):
+            raw_id = row[0]
+            if start_id is not None and raw_id < start_id:
+                continue
+            if end_id is not None and raw_id > end_id:
+                break
+            if sent_timestamp_index is not None:
+                sent_timestamp = row[sent_timestamp_index]
+                if since is not None and sent_timestamp < since:
+                    continue
+                if until is not None and sent_timestamp >= until:
+                    continue
+            yield row[:len(columns)]
+
+
+def merge_by_id(iterators, first_ids):
+    """Merges iterators of id ordered rows into a single id ordered iterator
+
+    :param iterators: (list) of iterators of tuples starting with an id, sorted by first id
+    :param first_ids: (list) smallest id of each iterator
+    """
+    heap = []
+    index = 0
+    while heap or index < len(iterators):
+        # an iterator which has not been started can not contain an id smaller than its first id
+        while index < len(iterators) and (not heap or first_ids[index] <= heap[0][0]):
+            iterator = iterators[index]
+            for row in iterator:
+                heapq.heappush(heap, (row[0], index, row, iterator))
+                break
+            index += 1
+        if not heap:
+            continue
+        _, position, row, iterator = heapq.heappop(heap)
+        yield row
+        for next_row in iterator:
+            heapq.heappush(heap, (next_row[0], position, next_row, iterator))
+            break
@@ -0,0 +1,133 @@
+"""Circuit breaker around the database of ingest.
+
+While the database is down each message waits for a connect or TCP timeout before it fails,
+holding a server thread and keeping gateways waiting for a response they will not get in time.
+The breaker counts consecutive failed stores, a store which takes longer than `slow_call` seconds counts as failed too.
+
+* closed, messages are stored, after `failure_threshold` consecutive failures the breaker opens
+* open, messages are rejected at once without touching the database, after `reset_timeout` seconds it is half open
+* half open, a single message is let through as probe, when it is stored the breaker closes, when it fails it opens again
+
+Rejected messages get 503 Service Unavailable with a Retry-After header of the seconds until the next probe,
+or are spooled when a spool is configured.
+The state is per worker process and reported by /status, /status/pool and the `sms_circuit_breaker_state` metric.
+
+Configured with `breaker.failure_threshold`, `breaker.slow_call` and `breaker.reset_timeout` settings.
+"""
+import logging
+import math
+import threading
+import time
+
+from .metrics import METRICS
+
+LOGGER = logging.getLogger('eecologysmsreciever')
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+STATES = (CLOSED, OPEN, HALF_OPEN)
+
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_SLOW_CALL = 10.0
+DEFAULT_RESET_TIMEOUT = 30.0
+
+
+class CircuitBreaker(object):
+    """Fails stores fast while the database is down
+
+    :param failure_threshold: (int) nr of consecutive failures after which the breaker opens
+    :param slow_call: (float) seconds after which a successful store counts as failed, None to ignore latency
+    :param reset_timeout: (float) seconds the breaker stays open before a probe is let through
+    """
+
+    def __init__(self, failure_threshold=DEFAULT_FAILURE_THRESHOLD, slow_call=DEFAULT_SLOW_CALL,
+                 reset_timeout=DEFAULT_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.slow_call = slow_call
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.rejected = 0
+        self.opened_at = None
+        self.probe_started = None
+        self._lock = threading.Lock()
+        self._publish()
+
+    @classmethod
+    def from_settings(cls, settings):
+        """Circuit breaker configured with `breaker.*` settings"""
+        slow_call = settings.get('breaker.slow_call', DEFAULT_SLOW_CALL)
+        return cls(failure_threshold=int(settings.get('breaker.failure_threshold', DEFAULT_FAILURE_THRESHOLD)),
+                   slow_call=float(slow_call) if slow_call not in (None, '') else None,
+                   reset_timeout=float(settings.get('breaker.reset_timeout', DEFAULT_RESET_TIMEOUT)))
+
+    def allow(self):
+        """Whether a store may use the database now
+
+        When the breaker is half open only the first caller is allowed, as probe.
+        A probe which does not report back with `record` within `reset_timeout` seconds is replaced by the next caller.
+
+        :return: (bool)
+        """
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            now = time.time()
+            if self.state == OPEN and now - self.opened_at >= self.reset_timeout:
+                self._transition(HALF_OPEN)
+                self.probe_started = now
+                return True
+            if self.state == HALF_OPEN and now - self.probe_started >= self.reset_timeout:
+                self.probe_started = now
+                return True
+            self.rejected += 1
+            return False
+
+    def record(self, success, seconds):
+        """Records result of an allowed store
+
+        :param success: (bool) whether database could be used, an invalid message is a success
+        :param seconds: (float) duration of store
+        """
+        failed = not success or (self.slow_call is not None and seconds > self.slow_call)
+        with self._lock:
+            if not failed:
+                self.failures = 0
+                if self.state == HALF_OPEN:
+                    self._transition(CLOSED)
+                return
+            self.failures += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+                self.opened_at = time.time()
+                self._transition(OPEN)
+
+    def retry_after(self):
+        """Seconds until the next probe, the Retry-After of rejected messages
+
+        :return: (int)
+        """
+        with self._lock:
+            if self.state == OPEN:
+                remaining = self.reset_timeout - (time.time() - self.opened_at)
+            else:
+                remaining = self.reset_timeout
+        return max(1, int(math.ceil(remaining)))
+
+    def statistics(self):
+        return {
+            'state': self.state,
+            'consecutive_failures': self.failures,
+            'rejected': self.rejected,
+            'retry_after': self.retry_after(),
+        }
+
+    def _transition(self, state):
+        LOGGER.warn('Database circuit breaker is %s', state)
+        self.state = state
+        METRICS.inc('sms_circuit_breaker_transitions_total', state=state)
+        self._publish()
+
+    def _publish(self):
+        for state in STATES:
+            METRICS.set('sms_circuit_breaker_state', 1 if state == self.state else 0, state=state)
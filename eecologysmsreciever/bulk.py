@@ -0,0 +1,156 @@
+"""Decodes many tracker SMS bodies at once into columnar NumPy arrays.
+
+For reprocessing and analysis of large numbers of raw messages, where building a Python datetime
+and ORM object per position is too slow.
+Bodies are split and numbers are converted in Python, date/time conversion and
+coordinate scaling are done on whole columns.
+
+Accepts the same bodies as `eecologysmsreciever.parser.parse_body`, except for integers which do not fit in 64 bits.
+A body which can not be decoded is reported by its index instead of raising.
+
+Requires NumPy, install with `pip install eEcology-SMS-reciever[bulk]`.
+"""
+from collections import namedtuple
+
+import numpy as np
+
+from .parser import HEADER_COLUMNS, DEBUG_COLUMNS, POSITION_COLUMNS, COORDINATE_SCALE
+
+Messages = namedtuple('Messages', ['device_info_serial', 'battery_voltage', 'memory_usage'])
+Positions = namedtuple('Positions', ['message_index', 'date_time', 'lon', 'lat'])
+
+
+class DecodedBodies(namedtuple('DecodedBodies', ['messages', 'positions', 'invalid'])):
+    """Decoded bodies
+
+    `messages` has an element per body, elements of invalid bodies are -1 or NaN.
+    `positions` has an element per position, `message_index` is the index of its body.
+    `invalid` has the indices of bodies which could not be decoded.
+    """
+    __slots__ = ()
+
+    @property
+    def valid(self):
+        """Boolean mask of decoded bodies"""
+        mask = np.ones(len(self.messages.device_info_serial), dtype=bool)
+        mask[self.invalid] = False
+        return mask
+
+
+# datetime range of parse_body, positions outside it are invalid
+MIN_DATE_TIME = np.datetime64('0001-01-01T00:00:00', 's')
+MAX_DATE_TIME = np.datetime64('9999-12-31T23:59:59', 's')
+# largest time column accepted by datetime.timedelta
+MAX_SECONDS = 86400 * 999999999
+
+
+def _split(bodies):
+    """Splits bodies into header and position columns
+
+    :return: (tuple) of header columns, position columns, each a list of strings,
+        the message index of each position and a set of indices of bodies with too few columns
+    """
+    serials, batteries, memories = [], [], []
+    years, days, seconds, lons, lats = [], [], [], [], []
+    message_index = []
+    invalid = set()
+    for index, body in enumerate(bodies):
+        try:
+            cols = body.split(',')
+        except AttributeError:
+            # None
+            invalid.add(index)
+            cols = [u'-1', u'nan', u'nan']
+        nr_cols = len(cols)
+        if nr_cols < HEADER_COLUMNS:
+            invalid.add(index)
+            cols = [u'-1', u'nan', u'nan']
+            nr_cols = HEADER_COLUMNS
+        serials.append(cols[0])
+        batteries.append(cols[1])
+        memories.append(cols[2])
+        i = HEADER_COLUMNS
+        if (nr_cols - i) % 2 == 1:
+            if nr_cols < i + DEBUG_COLUMNS:
+                invalid.add(index)
+                continue
+            i += DEBUG_COLUMNS
+        if (nr_cols - i) % POSITION_COLUMNS != 0:
+            continue
+        # empty date column means no gps fix yet
+        end = i
+        while end < nr_cols and cols[end]:
+            end += POSITION_COLUMNS
+        dates = cols[i:end:POSITION_COLUMNS]
+        years.extend([date[:2] for date in dates])
+        days.extend([date[2:5] for date in dates])
+        seconds.extend(cols[i + 1:end:POSITION_COLUMNS])
+        lons.extend(cols[i + 2:end:POSITION_COLUMNS])
+        lats.extend(cols[i + 3:end:POSITION_COLUMNS])
+        message_index.extend([index] * len(dates))
+    return (serials, batteries, memories), (years, days, seconds, lons, lats), message_index, invalid
+
+
+def _convert(values, dtype, owners, invalid):
+    """Converts column of strings to an array
+
+    When a value can not be converted, its owner is added to `invalid` and the value is replaced by 0.
+
+    :param values: (list) of strings
+    :param dtype: np.int64 or np.float64
+    :param owners: (list) index of body of each value
+    :param invalid: (set) indices of invalid bodies
+    :return: (numpy.ndarray)
+    """
+    # same conversion as parse_body, numpy's own string conversion does not reliably reject bad values
+    convert = int if dtype is np.int64 else float
+    try:
+        return np.fromiter(map(convert, values), dtype=dtype, count=len(values))
+    except (ValueError, OverflowError):
+        pass
+    # slow path, only for columns with a bad value
+    result = np.zeros(len(values), dtype=dtype)
+    for i, value in enumerate(values):
+        try:
+            result[i] = convert(value)
+        except (ValueError, OverflowError):
+            invalid.add(owners[i])
+    return result
+
+
+def decode_bodies(bodies):
+    """Decodes tracker SMS bodies
+
+    :param bodies: sequence of bodies (str)
+    :return: (DecodedBodies)
+    """
+    headers, cols, message_index, invalid = _split(bodies)
+    body_indices = list(range(len(headers[0])))
+    serial = _convert(headers[0], np.int64, body_indices, invalid)
+    battery_voltage = _convert(headers[1], np.float64, body_indices, invalid) / 1000
+    memory_usage = _convert(headers[2], np.float64, body_indices, invalid) / 10
+
+    years = _convert(cols[0], np.int64, message_index, invalid)
+    days = _convert(cols[1], np.int64, message_index, invalid)
+    seconds = _convert(cols[2], np.int64, message_index, invalid)
+    lon = _convert(cols[3], np.float64, message_index, invalid) / COORDINATE_SCALE
+    lat = _convert(cols[4], np.float64, message_index, invalid) / COORDINATE_SCALE
+    message_index = np.array(message_index, dtype=np.int64)
+
+    # 2 digits year (base 2000) + 3 digits day of year, days of year start at 1
+    year_start = (years + (2000 - 1970)).astype('datetime64[Y]').astype('datetime64[D]')
+    date_time = (year_start + (days - 1)).astype('datetime64[s]') + seconds
+    out_of_range = (np.abs(seconds) > MAX_SECONDS) | (date_time < MIN_DATE_TIME) | (date_time > MAX_DATE_TIME)
+    invalid.update(message_index[out_of_range].tolist())
+
+    invalid = np.array(sorted(invalid), dtype=np.int64)
+    serial[invalid] = -1
+    battery_voltage[invalid] = np.nan
+    memory_usage[invalid] = np.nan
+    keep = ~np.in1d(message_index, invalid)
+
+    return DecodedBodies(
+        Messages(serial, battery_voltage, memory_usage),
+        Positions(message_index[keep], date_time[keep], lon[keep], lat[keep]),
+        invalid,
+    )
@@ -0,0 +1,146 @@
+"""Bulkheads which keep read traffic from starving message ingest.
+
+Requests are split in an ingest class (/messages and /messages/batch) and a read class (everything else, like /status).
+Each class may have `concurrency` requests in progress and `queue` requests waiting for one of them to finish,
+a request which finds the queue full or waits longer than `timeout` seconds is rejected with 503 Service Unavailable
+and a Retry-After header of `timeout` seconds, rounded up.
+A burst of slow reads can therefore hold at most `concurrency + queue` server threads of the read class,
+the other threads stay available for ingest.
+
+A streamed response, like /positions or /export, keeps its slot until the server closed its body,
+as it uses the database while it is sent.
+
+The /status/ready readiness check does no I/O and is never limited,
+so a busy read class does not take a worker out of rotation.
+
+Configured with `bulkhead.<class>.concurrency`, `bulkhead.<class>.queue` and `bulkhead.<class>.timeout` settings.
+Read requests also use their own database connection pool, see `eecologysmsreciever.db.read_settings`.
+"""
+import math
+import threading
+import time
+
+from pyramid.httpexceptions import HTTPServiceUnavailable
+
+from .metrics import METRICS
+from .positions import ClosingIterator
+
+INGEST = 'ingest'
+READ = 'read'
+INGEST_PATHS = ('/messages', '/messages/batch')
+UNLIMITED_PATHS = ('/status/ready',)
+
+# the ini files run waitress with 8 threads, ingest holds at most 5 and reads at most 2 of them,
+# so a thread is left for /status/ready
+DEFAULTS = {
+    INGEST: {'concurrency': 4, 'queue': 1, 'timeout': 10.0},
+    READ: {'concurrency': 2, 'queue': 0, 'timeout': 5.0},
+}
+
+
+class Bulkhead(object):
+    """Limits nr of concurrent and waiting requests
+
+    :param concurrency: (int) maximum nr of requests in progress
+    :param queue: (int) maximum nr of requests waiting to start
+    :param timeout: (float) maximum seconds a request waits to start
+    """
+
+    def __init__(self, concurrency, queue, timeout):
+        self.concurrency = concurrency
+        self.queue = queue
+        self.timeout = timeout
+        # seconds a rejected client should wait before trying again
+        self.retry_after = max(1, int(math.ceil(timeout)))
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """Waits for a free slot
+
+        :return: (bool) True when a slot was acquired, False when request is rejected
+        """
+        with self._condition:
+            if self.active < self.concurrency:
+                self.active += 1
+                return True
+            if self.waiting >= self.queue:
+                self.rejected += 1
+                return False
+            self.waiting += 1
+            try:
+                deadline = time.time() + self.timeout
+                while self.active >= self.concurrency:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.rejected += 1
+                        return False
+                    self._condition.wait(remaining)
+                self.active += 1
+                return True
+            finally:
+                self.waiting -= 1
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+    def statistics(self):
+        return {
+            'concurrency': self.concurrency,
+            'queue': self.queue,
+            'active': self.active,
+            'waiting': self.waiting,
+            'rejected': self.rejected,
+        }
+
+
+def bulkheads_from_settings(settings):
+    """Bulkhead of each request class
+
+    :param settings: (dict) app settings
+    :return: (dict) Bulkhead by request class
+    """
+    bulkheads = {}
+    for name, defaults in DEFAULTS.items():
+        prefix = 'bulkhead.{0}.'.format(name)
+        bulkheads[name] = Bulkhead(int(settings.get(prefix + 'concurrency', defaults['concurrency'])),
+                                   int(settings.get(prefix + 'queue', defaults['queue'])),
+                                   float(settings.get(prefix + 'timeout', defaults['timeout'])))
+    return bulkheads
+
+
+def request_class(request):
+    return INGEST if request.path_info in INGEST_PATHS else READ
+
+
+def bulkhead_tween_factory(handler, registry):
+    """Tween which runs each request inside the bulkhead of its request class"""
+    bulkheads = registry.bulkheads
+
+    def bulkhead_tween(request):
+        if request.path_info in UNLIMITED_PATHS:
+            return handler(request)
+        name = request_class(request)
+        bulkhead = bulkheads[name]
+        if not bulkhead.acquire():
+            METRICS.inc('sms_bulkhead_rejected_total', request_class=name)
+            return HTTPServiceUnavailable(json_body={'payload': {'success': False, 'error': 'Busy'}},
+                                          headers={'Retry-After': str(bulkhead.retry_after)})
+        try:
+            response = handler(request)
+        except Exception:
+            bulkhead.release()
+            raise
+        app_iter = getattr(response, 'app_iter', None)
+        if isinstance(app_iter, ClosingIterator):
+            # body is streamed from the database after the view returned
+            app_iter.add_callback(bulkhead.release)
+        else:
+            bulkhead.release()
+        return response
+
+    return bulkhead_tween
@@ -0,0 +1,202 @@
+"""Database engine and connection pool.
+
+Configured with `sqlalchemy.*` settings, pool sizes are passed to SQLAlchemy's QueuePool,
+and `db.*` settings:
+
+* db.pre_ping, test a pooled connection with SELECT 1 before handing it out, so a stale connection is replaced
+  instead of failing a request
+* db.warm_up, nr of connections to open at startup, so first requests do not pay for connection setup
+* db.prepare, prepare the ingest and status statements once when a connection is opened (PostgreSQL only),
+  the user needs the SELECT grants on the conflict columns listed in sms.sql
+
+Read requests, like /status, use a separate engine, so a slow read can not hold the connections ingest needs.
+It is configured with the same settings, overridden by `read.sqlalchemy.*` and `read.db.*` settings,
+and defaults to a small pool which gives up waiting for a connection quickly.
+
+Session setup (UTC time zone) is done once when a connection is opened instead of on every request.
+
+A connection is only used by the process which opened it, a connection opened before a pre-fork server forked
+is replaced in the worker instead of sharing its socket with the other workers.
+"""
+import logging
+import os
+import threading
+import time
+
+from pyramid.settings import asbool
+from sqlalchemy import engine_from_config, event, exc
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+
+from .admission import DecayingAverage
+from .models import LOCATION_EWKT
+from .writer import prepare_statements
+
+LOGGER = logging.getLogger('eecologysmsreciever')
+
+
+class PoolStats(object):
+    """Statistics of connection checkouts of a pool"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.recent_wait = DecayingAverage()
+
+    def record_wait(self, seconds):
+        self.recent_wait.add(seconds)
+        with self._lock:
+            self.checkouts += 1
+            self.wait_total += seconds
+            if seconds > self.wait_max:
+                self.wait_max = seconds
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool which records how long a checkout waited for a connection"""
+
+    def __init__(self, *args, **kwargs):
+        super(TimedQueuePool, self).__init__(*args, **kwargs)
+        self.stats = PoolStats()
+
+    def _do_get(self):
+        start = time.time()
+        try:
+            return super(TimedQueuePool, self)._do_get()
+        finally:
+            self.stats.record_wait(time.time() - start)
+
+
+def set_utc(dbapi_connection, connection_record):
+    # Make sure db is set to UTC,
+    # db.e-ecology.sara.nl has 'Europe/Amsterdam' as timezone causing date_time to be stored in that timezone
+    cursor = dbapi_connection.cursor()
+    cursor.execute("SET TIME ZONE 'UTC'")
+    cursor.close()
+    # commit, otherwise the setting is undone by the rollback when the connection is returned to the pool
+    dbapi_connection.commit()
+
+
+def ping(dbapi_connection, connection_record, connection_proxy):
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('SELECT 1')
+    except Exception as e:
+        LOGGER.warn('Stale database connection: %s', e)
+        # pool will retry with a new connection
+        raise exc.DisconnectionError()
+    finally:
+        cursor.close()
+
+
+def record_pid(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+
+def check_pid(dbapi_connection, connection_record, connection_proxy):
+    pid = os.getpid()
+    if connection_record.info['pid'] != pid:
+        # opened by parent before fork, detach it without closing the socket the parent still uses
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError(
+            'Connection opened by process {0}, checked out by process {1}'.format(connection_record.info['pid'], pid))
+
+
+def engine_from_settings(settings):
+    """Creates engine from `sqlalchemy.*` and `db.*` settings
+
+    :param settings: (dict) app settings
+    :return: SQLAlchemy engine
+    """
+    kwargs = {}
+    is_postgresql = make_url(settings['sqlalchemy.url']).drivername.startswith('postgresql')
+    if is_postgresql:
+        kwargs['poolclass'] = TimedQueuePool
+    if 'sqlalchemy.max_overflow' in settings:
+        # not coerced by engine_from_config
+        kwargs['max_overflow'] = int(settings['sqlalchemy.max_overflow'])
+    engine = engine_from_config(settings, 'sqlalchemy.', **kwargs)
+    event.listen(engine, 'connect', record_pid)
+    event.listen(engine, 'checkout', check_pid)
+    if is_postgresql:
+        event.listen(engine, 'connect', set_utc)
+        if asbool(settings.get('db.prepare', False)):
+            event.listen(engine, 'connect', prepare_statements(settings.get('location', LOCATION_EWKT)))
+    if asbool(settings.get('db.pre_ping', False)):
+        event.listen(engine, 'checkout', ping)
+    return engine
+
+
+# pool of read engine, unless overridden by read.sqlalchemy.* settings
+READ_POOL_DEFAULTS = {
+    'sqlalchemy.pool_size': '2',
+    'sqlalchemy.max_overflow': '2',
+    'sqlalchemy.pool_timeout': '5',
+}
+
+
+def read_settings(settings):
+    """Settings of the read engine
+
+    `read.sqlalchemy.*` and `read.db.*` settings override the `sqlalchemy.*` and `db.*` settings.
+
+    :param settings: (dict) app settings
+    :return: (dict) settings to pass to `engine_from_settings`
+    """
+    result = dict(settings)
+    if make_url(settings['sqlalchemy.url']).drivername.startswith('postgresql'):
+        # other dialects use pools which are not sized
+        result.update(READ_POOL_DEFAULTS)
+    for key, value in settings.items():
+        if key.startswith('read.sqlalchemy.') or key.startswith('read.db.'):
+            result[key[len('read.'):]] = value
+    return result
+
+
+def warm_up(engine, nr_connections):
+    """Opens `nr_connections` connections and returns them to the pool
+
+    At most the pool size is opened, overflow connections would be closed again when returned.
+    Failure is logged, so the app can start while the database is down.
+    """
+    if isinstance(engine.pool, QueuePool):
+        nr_connections = min(nr_connections, engine.pool.size())
+    connections = []
+    try:
+        for _ in range(nr_connections):
+            connections.append(engine.connect())
+    except exc.SQLAlchemyError as e:
+        LOGGER.warn('Unable to warm up connection pool: %s', e)
+    finally:
+        for connection in connections:
+            connection.close()
+    return len(connections)
+
+
+def pool_statistics(pool):
+    """Size, usage and checkout wait times of a pool
+
+    :param pool: SQLAlchemy pool
+    :return: (dict)
+    """
+    if not isinstance(pool, QueuePool):
+        return {}
+    capacity = pool.size() + max(pool._max_overflow, 0)
+    stats = {
+        'size': pool.size(),
+        'max_overflow': pool._max_overflow,
+        'checked_in': pool.checkedin(),
+        'checked_out': pool.checkedout(),
+        'overflow': pool.overflow(),
+        'saturation': float(pool.checkedout()) / capacity if capacity else 0.0,
+    }
+    pool_stats = getattr(pool, 'stats', None)
+    if pool_stats is not None:
+        stats['checkouts'] = pool_stats.checkouts
+        stats['wait_total'] = pool_stats.wait_total
+        stats['wait_max'] = pool_stats.wait_max
+        stats['wait_mean'] = pool_stats.wait_total / pool_stats.checkouts if pool_stats.checkouts else 0.0
+        stats['wait_recent'] = pool_stats.recent_wait.value()
+    return stats
@@ -0,0 +1,162 @@
+"""Bulk export of positions of many devices as gzipped CSV or GeoJSON.
+
+Rows are fetched from a server-side cursor a batch at a time, serialized and compressed before the next batch is fetched,
+so memory use does not depend on the nr of rows and the first bytes are sent before the query is done.
+
+An export holds a connection of the read pool until it is downloaded,
+so the nr of exports in progress is limited by the `export.concurrency` setting (default 1).
+"""
+import csv
+import json
+import zlib
+
+from pyramid.settings import asbool
+from sqlalchemy import and_, select
+
+from .models import Message, Position
+from .positions import FETCH_SIZE, isoformat, parse_date_time
+
+FORMAT_CSV = 'csv'
+FORMAT_GEOJSON = 'geojson'
+FORMATS = (FORMAT_CSV, FORMAT_GEOJSON)
+MAX_DEVICES = 500
+POSITION_COLUMNS = ('device_info_serial', 'date_time', 'lon', 'lat')
+MESSAGE_COLUMNS = ('battery_voltage', 'memory_usage')
+# gzip container instead of raw deflate
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+class Lines(object):
+    """File-like which collects lines written by csv.writer"""
+
+    def __init__(self):
+        self.lines = []
+
+    def write(self, line):
+        self.lines.append(line)
+
+    def pop(self):
+        lines = ''.join(self.lines)
+        self.lines = []
+        return lines
+
+
+class Export(object):
+    """Positions of devices in a time range
+
+    :param device_info_serials: (list) tracker identifiers
+    :param start: (datetime) positions at or after, in UTC
+    :param end: (datetime) positions before, in UTC, None for no end
+    :param message: (bool) whether to add battery voltage and memory usage of the message of each position
+    :param format: (str) one of FORMATS
+    """
+
+    def __init__(self, device_info_serials, start, end=None, message=False, format=FORMAT_CSV):
+        self.device_info_serials = device_info_serials
+        self.start = start
+        self.end = end
+        self.message = message
+        self.format = format
+
+    @classmethod
+    def from_params(cls, params):
+        """Export from request parameters
+
+        :param params: (MultiDict) with device_info_serial, repeated or comma separated, start,
+            and optional end, message and format
+        :return: (Export)
+        :raises ValueError: when a parameter is missing or invalid
+        """
+        device_info_serials = sorted(set(int(serial)
+                                         for value in params.getall('device_info_serial')
+                                         for serial in value.split(',') if serial.strip()))
+        if not device_info_serials or 'start' not in params:
+            raise ValueError('device_info_serial and start are required')
+        if len(device_info_serials) > MAX_DEVICES:
+            raise ValueError('At most {0} devices can be exported at once'.format(MAX_DEVICES))
+        start = parse_date_time(params['start'])
+        end = parse_date_time(params['end']) if params.get('end') else None
+        message = asbool(params.get('message', False))
+        format = params.get('format', FORMAT_CSV)
+        if format not in FORMATS:
+            raise ValueError('format must be one of {0}'.format(', '.join(FORMATS)))
+        return cls(device_info_serials, start, end, message, format)
+
+    @property
+    def columns(self):
+        if self.message:
+            return POSITION_COLUMNS + MESSAGE_COLUMNS
+        return POSITION_COLUMNS
+
+    @property
+    def filename(self):
+        return 'positions-{0}.{1}.gz'.format(self.start.strftime('%Y%m%d'), self.format)
+
+    def select(self):
+        """Select of positions, ordered by device and date_time"""
+        position = Position.__table__
+        columns = [position.c[column] for column in POSITION_COLUMNS]
+        clauses = [position.c.device_info_serial.in_(self.device_info_serials),
+                   position.c.date_time >= self.start,
+                   ]
+        if self.end is not None:
+            clauses.append(position.c.date_time < self.end)
+        if self.message:
+            message = Message.__table__
+            columns += [message.c[column] for column in MESSAGE_COLUMNS]
+            clauses.append(message.c.id == position.c.id)
+        return select(columns).where(and_(*clauses)).order_by(position.c.device_info_serial, position.c.date_time)
+
+    def serialize(self, result):
+        """Text chunks of rows of `result`, a chunk per fetched batch
+
+        :param result: SQLAlchemy result of `select()`
+        :return: generator of str
+        """
+        if self.format == FORMAT_CSV:
+            lines = Lines()
+            writer = csv.writer(lines, lineterminator='\n')
+            writer.writerow(self.columns)
+            while True:
+                rows = result.fetchmany(FETCH_SIZE)
+                if not rows:
+                    break
+                for row in rows:
+                    writer.writerow([isoformat(value) if column == 'date_time' else value
+                                     for column, value in zip(self.columns, row)])
+                yield lines.pop()
+            yield lines.pop()
+        else:
+            yield '{"type": "FeatureCollection", "features": ['
+            first = True
+            while True:
+                rows = result.fetchmany(FETCH_SIZE)
+                if not rows:
+                    break
+                chunk = []
+                for row in rows:
+                    if not first:
+                        chunk.append(',\n')
+                    first = False
+                    properties = dict(zip(self.columns, row))
+                    properties['date_time'] = isoformat(properties['date_time'])
+                    chunk.append(json.dumps({
+                        'type': 'Feature',
+                        'geometry': {'type': 'Point', 'coordinates': [properties['lon'], properties['lat']]},
+                        'properties': properties,
+                    }))
+                yield ''.join(chunk)
+            yield ']}\n'
+
+    def stream(self, result):
+        """Gzip compressed rows of `result`
+
+        :param result: SQLAlchemy result of `select()`
+        :return: generator of bytes
+        """
+        compressor = zlib.compressobj(6, zlib.DEFLATED, GZIP_WBITS)
+        for chunk in self.serialize(result):
+            compressed = compressor.compress(chunk.encode('utf-8'))
+            if compressed:
+                yield compressed
+        yield compressor.flush()
@@ -0,0 +1,313 @@
+"""Ingest metrics in Prometheus text format.
+
+Each thread records into its own shard, so recording a metric takes no lock.
+Shards are only summed when the metrics are rendered.
+Gauges hold a current value of the process, like the state of the circuit breaker, and are set under a lock.
+
+With multiple worker processes, each worker writes a snapshot of its metrics to a shared directory
+and rendering sums the snapshots of all workers, see `Metrics.share`.
+Gauges are only summed over workers which are still running.
+"""
+from bisect import bisect_left
+import errno
+import json
+import logging
+import os
+import threading
+import time
+
+LOGGER = logging.getLogger('eecologysmsreciever')
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+POSITIONS_BUCKETS = (0, 1, 2, 3, 4, 5, 6, 8, 10, 15, 20)
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+
+class Shard(object):
+    """Counters and histograms recorded by a single thread"""
+    __slots__ = ('counters', 'histograms')
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+
+
+class Metrics(object):
+    """Registry of counters, gauges and histograms
+
+    Metrics must be declared with `counter`, `gauge` or `histogram` before they are recorded.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards = []
+        self._gauges = {}
+        self._declared = {}
+        self.directory = None
+
+    def counter(self, name, help_text):
+        self._declared[name] = ('counter', help_text, None)
+
+    def gauge(self, name, help_text):
+        self._declared[name] = ('gauge', help_text, None)
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self._declared[name] = ('histogram', help_text, tuple(buckets))
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = Shard()
+            self._local.shard = shard
+            # only taken once per thread
+            with self._lock:
+                self._shards.append(shard)
+        return shard
+
+    def inc(self, name, value=1, **labels):
+        """Increments counter `name` with labels"""
+        counters = self._shard().counters
+        key = (name, tuple(sorted(labels.items())))
+        counters[key] = counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """Sets gauge `name` with labels to value"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._gauges[key] = value
+
+    def gauges(self):
+        """Gauges of this process
+
+        :return: (dict) keyed by name and labels
+        """
+        with self._lock:
+            return dict(self._gauges)
+
+    def observe(self, name, value, **labels):
+        """Records value in histogram `name` with labels"""
+        histograms = self._shard().histograms
+        key = (name, tuple(sorted(labels.items())))
+        buckets = self._declared[name][2]
+        counts = histograms.get(key)
+        if counts is None:
+            # a count per bucket, one for +Inf and the sum
+            counts = [0] * (len(buckets) + 1) + [0.0]
+            histograms[key] = counts
+        counts[bisect_left(buckets, value)] += 1
+        counts[-1] += value
+
+    def time(self, name, **labels):
+        """Context manager which records its duration in seconds in histogram `name`"""
+        return Timer(self, name, labels)
+
+    def collect(self):
+        """Sums shards of all threads
+
+        :return: (tuple) dict of counters and dict of histograms, keyed by name and labels
+        """
+        with self._lock:
+            shards = list(self._shards)
+        counters = {}
+        histograms = {}
+        for shard in shards:
+            # items() copies under the GIL, so a recording thread can keep adding keys
+            for key, value in list(shard.counters.items()):
+                counters[key] = counters.get(key, 0) + value
+            for key, counts in list(shard.histograms.items()):
+                total = histograms.get(key)
+                if total is None:
+                    histograms[key] = list(counts)
+                else:
+                    histograms[key] = [a + b for a, b in zip(total, counts)]
+        return counters, histograms
+
+    def snapshot_path(self, pid=None):
+        return os.path.join(self.directory, 'metrics-{0}.json'.format(pid or os.getpid()))
+
+    def dump(self):
+        """Writes snapshot of metrics of this process to shared directory"""
+        counters, histograms = self.collect()
+        snapshot = {
+            'counters': [[name, labels, value] for (name, labels), value in counters.items()],
+            'histograms': [[name, labels, counts] for (name, labels), counts in histograms.items()],
+            'gauges': [[name, labels, value] for (name, labels), value in self.gauges().items()],
+        }
+        path = self.snapshot_path()
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(snapshot, f)
+        # readers never see a partial snapshot
+        os.rename(tmp_path, path)
+
+    def collect_shared(self):
+        """Sums snapshots of all processes in shared directory, after writing snapshot of this process
+
+        Snapshots of exited processes are kept, so counters do not go down when a worker is restarted.
+
+        :return: (tuple) dict of counters and dict of histograms, keyed by name and labels
+        """
+        self.dump()
+        counters = {}
+        histograms = {}
+        for _, snapshot in self.snapshots():
+            for name, labels, value in snapshot['counters']:
+                key = (name, tuple(tuple(label) for label in labels))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, counts in snapshot['histograms']:
+                key = (name, tuple(tuple(label) for label in labels))
+                total = histograms.get(key)
+                histograms[key] = counts if total is None else [a + b for a, b in zip(total, counts)]
+        return counters, histograms
+
+    def collect_shared_gauges(self):
+        """Sums gauges of snapshots of running processes in shared directory
+
+        :return: (dict) keyed by name and labels
+        """
+        gauges = {}
+        for pid, snapshot in self.snapshots():
+            if not is_running(pid):
+                continue
+            for name, labels, value in snapshot.get('gauges', []):
+                key = (name, tuple(tuple(label) for label in labels))
+                gauges[key] = gauges.get(key, 0) + value
+        return gauges
+
+    def snapshots(self):
+        """Snapshots in shared directory
+
+        :return: generator of (pid, snapshot) tuples
+        """
+        for filename in os.listdir(self.directory):
+            if not (filename.startswith('metrics-') and filename.endswith('.json')):
+                continue
+            try:
+                pid = int(filename[len('metrics-'):-len('.json')])
+                with open(os.path.join(self.directory, filename)) as f:
+                    snapshot = json.load(f)
+            except (IOError, OSError, ValueError) as e:
+                LOGGER.warn('Skipping metrics snapshot %s: %s', filename, e)
+                continue
+            yield pid, snapshot
+
+    def share(self, directory, interval=5.0):
+        """Shares metrics with other worker processes through snapshots in `directory`
+
+        A daemon thread writes a snapshot every `interval` seconds,
+        so metrics of workers which do not render are at most `interval` seconds old.
+        Should be called after fork, in each worker.
+        """
+        self.directory = directory
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # made by other worker
+            if not os.path.isdir(directory):
+                raise
+        dumper = threading.Thread(target=self._dump_every, args=(interval,), name='MetricsDumper')
+        dumper.daemon = True
+        dumper.start()
+        return dumper
+
+    def _dump_every(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.dump()
+            except (IOError, OSError) as e:
+                LOGGER.warn('Unable to write metrics snapshot: %s', e)
+
+    def render(self):
+        """Metrics in Prometheus text exposition format
+
+        When shared, metrics of all worker processes are summed.
+
+        :return: (str)
+        """
+        if self.directory is None:
+            counters, histograms = self.collect()
+            gauges = self.gauges()
+        else:
+            counters, histograms = self.collect_shared()
+            gauges = self.collect_shared_gauges()
+        lines = []
+        for name in sorted(self._declared):
+            kind, help_text, buckets = self._declared[name]
+            lines.append('# HELP {0} {1}'.format(name, help_text))
+            lines.append('# TYPE {0} {1}'.format(name, kind))
+            if kind == 'counter':
+                for key in sorted(k for k in counters if k[0] == name):
+                    lines.append(sample(name, key[1], counters[key]))
+                continue
+            if kind == 'gauge':
+                for key in sorted(k for k in gauges if k[0] == name):
+                    lines.append(sample(name, key[1], gauges[key]))
+                continue
+            for key in sorted(k for k in histograms if k[0] == name):
+                counts = histograms[key]
+                cumulative = 0
+                for bound, count in zip(buckets + ('+Inf',), counts):
+                    cumulative += count
+                    le = bound if bound == '+Inf' else format_value(bound)
+                    lines.append(sample(name + '_bucket', key[1] + (('le', le),), cumulative))
+                lines.append(sample(name + '_sum', key[1], counts[-1]))
+                lines.append(sample(name + '_count', key[1], cumulative))
+        return u'\n'.join(lines) + u'\n'
+
+
+class Timer(object):
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.observe(self.name, time.time() - self.start, **self.labels)
+
+
+def is_running(pid):
+    """Whether process with pid is running"""
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        # EPERM, process of another user
+        return e.errno == errno.EPERM
+    return True
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def escape(value):
+    return u'{0}'.format(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def sample(name, labels, value):
+    if not labels:
+        return '{0} {1}'.format(name, format_value(value))
+    label_text = ','.join(u'{0}="{1}"'.format(k, escape(v)) for k, v in labels)
+    return u'{0}{{{1}}} {2}'.format(name, label_text, format_value(value))
+
+
+METRICS = Metrics()
+METRICS.counter('sms_messages_total', 'Messages by outcome: success, duplicate, forbidden, invalid, rejected, unavailable or database_error')
+METRICS.counter('sms_gateway_messages_total', 'Messages received by gateway')
+METRICS.counter('sms_recently_seen_total', 'Recently seen cache lookups by kind (message or position) and result (hit or miss)')
+METRICS.counter('sms_bulkhead_rejected_total', 'Requests rejected because their request class (ingest, read or export) was busy')
+METRICS.counter('sms_admission_rejected_total', 'Messages rejected by admission control by exceeded limit and gateway')
+METRICS.counter('sms_circuit_breaker_transitions_total', 'Transitions of the database circuit breaker by new state')
+METRICS.gauge('sms_circuit_breaker_state', 'Nr of worker processes whose database circuit breaker is in state: closed, open or half_open')
+METRICS.counter('sms_spool_drain_failures_total', 'Batches of spooled messages which could not be stored in the database')
+METRICS.gauge('sms_spool_drain_consecutive_failures', 'Nr of batches of spooled messages which failed in a row')
+METRICS.histogram('sms_stage_seconds', 'Duration of ingest stages in seconds')
+METRICS.histogram('sms_message_positions', 'Nr of positions per message', POSITIONS_BUCKETS)
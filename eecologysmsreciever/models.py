@@ -1,17 +1,19 @@
-from datetime import datetime, timedelta
+import calendar
+from datetime import datetime
 import uuid
 import warnings
 from geoalchemy2 import Geometry
 from pyramid.exceptions import Forbidden
-from pytz import utc
 from sqlalchemy import (
     Column,
     Unicode,
     Integer,
     Float,
     DateTime,
+    FetchedValue,
     ForeignKey,
     UniqueConstraint,
+    func,
 )
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import (
@@ -24,8 +26,21 @@ from sqlalchemy.types import TypeDecorator, CHAR
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy import exc as sa_exc
 
+from .parser import parse_body
+
+
+# How the location of a position is constructed, set with the `location` setting:
+# ewkt, client sends point as Extended Well-Known Text which PostGIS parses
+# server, client sends lon/lat and PostGIS constructs point with ST_MakePoint
+# database, location is a generated column of lon/lat, see alembic migration 7d3e5f1a2c84
+LOCATION_EWKT = 'ewkt'
+LOCATION_SERVER = 'server'
+LOCATION_DATABASE = 'database'
+LOCATION_MODES = (LOCATION_EWKT, LOCATION_SERVER, LOCATION_DATABASE)
 
 DBSession = scoped_session(sessionmaker(expire_on_commit=False))
+# Session of read requests like /status, bound to a separate connection pool so reads can not starve ingest
+ReadSession = scoped_session(sessionmaker(expire_on_commit=False))
 Base = declarative_base()
 SMS_SCHEMA = 'sms'
 
@@ -94,22 +109,48 @@ class RawMessage(Base):
                            cascade='', cascade_backrefs=True)
 
     @classmethod
-    def from_request(cls, request):
+    def check_secret(cls, request, client_secret):
         server_secret = request.registry.settings['secret_key']
-        client_secret = request.POST.get('secret')
         if client_secret != server_secret:
             raise Forbidden('Invalid secret')
+
+    @classmethod
+    def from_request(cls, request):
+        cls.check_secret(request, request.POST.get('secret'))
+        return cls.from_params(request.POST)
+
+    @classmethod
+    def from_params(cls, params):
+        """Raw message from SMSSync parameters
+
+        :param params: (dict) with message_id, from, message, sent_to, device_id and sent_timestamp keys
+        :return: (RawMessage)
+        """
         raw_message = RawMessage()
-        raw_message.message_id = uuid.UUID(request.POST['message_id'])
-        raw_message.sent_from = request.POST['from']
-        raw_message.body = request.POST['message']
-        raw_message.sent_to = request.POST['sent_to']
-        raw_message.gateway_id = request.POST['device_id']
+        raw_message.message_id = uuid.UUID(params['message_id'])
+        raw_message.sent_from = params['from']
+        raw_message.body = params['message']
+        raw_message.sent_to = params['sent_to']
+        raw_message.gateway_id = params['device_id']
         raw_message.sent_timestamp = datetime.utcfromtimestamp(
-            int(request.POST['sent_timestamp']) / 1000)
+            int(params['sent_timestamp']) / 1000)
 
         return raw_message
 
+    def to_params(self):
+        """SMSSync parameters of raw message, inverse of `from_params`
+
+        :return: (dict)
+        """
+        return {
+            'message_id': str(self.message_id),
+            'from': self.sent_from,
+            'message': self.body,
+            'sent_to': self.sent_to,
+            'device_id': self.gateway_id,
+            'sent_timestamp': str(calendar.timegm(self.sent_timestamp.utctimetuple()) * 1000),
+        }
+
 
 class Message(Base):
     __tablename__ = 'message'
@@ -126,48 +167,34 @@ class Message(Base):
                              cascade='', cascade_backrefs=True)
 
     @classmethod
-    def from_raw(cls, raw_message):
+    def from_raw(cls, raw_message, location=LOCATION_EWKT):
         body = raw_message.body
 
-        message = cls.from_body(body)
+        message = cls.from_body(body, location)
         message.id = raw_message.id
         message.date_time = raw_message.sent_timestamp
         return message
 
     @classmethod
-    def from_body(cls, body):
-        cols = body.split(',')
-        message = Message()
-        message.device_info_serial = int(cols.pop(0))
-        message.battery_voltage = float(cols.pop(0)) / 1000
-        message.memory_usage = float(cols.pop(0)) / 10
-        # positions has 4 cols, debug has 5, so if odd nr of cols then has debug
-        has_debug = len(cols) % 2 == 1
-        if has_debug:
-            message.debug_info = cols.pop(0) + u','   # timings, network registration, message sending
-            message.debug_info += cols.pop(0) + u','  # rssi of connection
-            message.debug_info += cols.pop(0) + u','  # status/error codes at commands
-            message.debug_info += cols.pop(0) + u','  # network registration
-            message.debug_info += cols.pop(0)         # arcfn, absolute radio frequency number
-
-        while len(cols):
-            has_position = len(cols) >= 4 and len(cols) % 4 == 0 and len(cols[0]) > 0
-            if not has_position:
-                break
-            position = Position()
-            position.device_info_serial = message.device_info_serial
-            date = cols.pop(0)
-            time = cols.pop(0)
-            year = datetime(2000 + int(date[:2]), 1, 1, tzinfo=utc)
-            # -1 is needed because days of year starts at 1 and min day of datetime is 1 Jan
-            position.date_time = year + timedelta(days=int(date[2:5]) - 1, seconds=int(time))
-            position.lon = float(cols.pop(0)) / 10000000
-            position.lat = float(cols.pop(0)) / 10000000
-            loc_tmpl = 'SRID=4326;POINT({lon} {lat})'
-            position.location = loc_tmpl.format(lon=position.lon,
-                                                lat=position.lat)
-            message.positions.append(position)
+    def from_body(cls, body, location=LOCATION_EWKT):
+        return cls.from_parsed(parse_body(body), location)
 
+    @classmethod
+    def from_parsed(cls, parsed, location=LOCATION_EWKT):
+        """Message with positions from a parsed body
+
+        :param parsed: (eecologysmsreciever.parser.ParsedBody)
+        :param location: (str) how location of positions is constructed, see `Position.from_fix`
+        :return: (Message)
+        """
+        header = parsed.header
+        message = cls(device_info_serial=header.device_info_serial,
+                      battery_voltage=header.battery_voltage,
+                      memory_usage=header.memory_usage,
+                      debug_info=parsed.debug_info,
+                      )
+        for fix in parsed.positions:
+            message.positions.append(Position.from_fix(header.device_info_serial, fix, location))
         return message
 
 
@@ -180,7 +207,60 @@ class Position(Base):
     date_time = Column(DateTime(timezone=False), primary_key=True)
     lon = Column(Float())
     lat = Column(Float())
-    location = Column(Geometry('POINT', srid=4326))
+    # a location which is not set is left out of the INSERT instead of being sent as NULL,
+    # so it can be a generated column, see LOCATION_DATABASE
+    location = Column(Geometry('POINT', srid=4326), server_default=FetchedValue())
+
+    @classmethod
+    def from_fix(cls, device_info_serial, fix, location=LOCATION_EWKT):
+        """Position from a parsed fix
+
+        :param device_info_serial: (int) tracker identifier
+        :param fix: (eecologysmsreciever.parser.Fix)
+        :param location: (str) how location is constructed, one of LOCATION_MODES
+        :return: (Position)
+        """
+        position = cls(device_info_serial=device_info_serial,
+                       date_time=fix.date_time,
+                       lon=fix.lon,
+                       lat=fix.lat,
+                       )
+        if location == LOCATION_EWKT:
+            position.location = ewkt_point(fix.lon, fix.lat)
+        elif location == LOCATION_SERVER:
+            position.location = make_point(fix.lon, fix.lat)
+        # with LOCATION_DATABASE location is not set, so it is left out of the INSERT
+        return position
+
+
+class DeviceLatest(Base):
+    """Latest state of a tracker, maintained by ingest when the `devices.latest` setting is enabled"""
+    __tablename__ = 'device_latest'
+    __table_args__ = {'schema': SMS_SCHEMA}
+    device_info_serial = Column(Integer, primary_key=True, autoincrement=False)
+    # latest message, by sent timestamp
+    message_date_time = Column(DateTime(timezone=False))
+    battery_voltage = Column(Float(precision=3))
+    memory_usage = Column(Float(precision=1))
+    gateway_id = Column(Unicode())
+    # latest fix
+    date_time = Column(DateTime(timezone=False))
+    lon = Column(Float())
+    lat = Column(Float())
+    location = Column(Geometry('POINT', srid=4326, spatial_index=False))
+    # thresholds of /status/devices for this device, NULL uses the `devices.max_age` or `devices.min_battery_voltage` setting
+    max_age = Column(Float())
+    min_battery_voltage = Column(Float())
+
+
+def ewkt_point(lon, lat):
+    """Point in WGS84 as Extended Well-Known Text"""
+    return 'SRID=4326;POINT({lon} {lat})'.format(lon=lon, lat=lat)
+
+
+def make_point(lon, lat):
+    """SQL expression of point in WGS84 constructed by PostGIS"""
+    return func.ST_SetSRID(func.ST_MakePoint(lon, lat), 4326)
 
 
 def dump_ddl():
@@ -0,0 +1,106 @@
+"""Parser for the body of a tracker SMS.
+
+Turns a body into light weight records without touching the ORM or a database session,
+so it can also be used by reprocessing scripts.
+
+Body layout is comma separated::
+
+    <device_info_serial>,<battery voltage in mV>,<memory usage in 0.1%>[,<5 debug columns>][,<date>,<time>,<lon>,<lat>]*
+
+Where date is 2 digits year (base 2000) + 3 digits day of year,
+time is seconds of day and lon/lat are in 1e-7 degrees.
+"""
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from pytz import utc
+
+Header = namedtuple('Header', ['device_info_serial', 'battery_voltage', 'memory_usage'])
+
+# timings (network registration, message sending), rssi of connection, status/error codes at commands,
+# network registration and arfcn (absolute radio frequency number)
+Debug = namedtuple('Debug', ['timings', 'rssi', 'status', 'network_registration', 'arfcn'])
+
+Fix = namedtuple('Fix', ['date_time', 'lon', 'lat'])
+
+
+class ParsedBody(namedtuple('ParsedBody', ['header', 'debug', 'positions'])):
+    """Parsed body, with header, optional debug and a tuple of positions"""
+    __slots__ = ()
+
+    @property
+    def debug_info(self):
+        """Debug columns as comma separated string or None when body has no debug columns"""
+        if self.debug is None:
+            return None
+        return u','.join(self.debug)
+
+
+HEADER_COLUMNS = 3
+DEBUG_COLUMNS = 5
+POSITION_COLUMNS = 4
+COORDINATE_SCALE = 10000000
+
+# date column -> datetime of the start of that day, bounded as trackers only report recent days
+_day_starts = {}
+_MAX_CACHED_DAYS = 4096
+
+
+def day_start(date):
+    """Start of day of a position date column
+
+    :param date: (str) 2 digits year (base 2000) + 3 digits day of year
+    :return: (datetime.datetime) in UTC
+    :raises ValueError: when date column is not numeric
+    """
+    try:
+        return _day_starts[date]
+    except KeyError:
+        year = datetime(2000 + int(date[:2]), 1, 1, tzinfo=utc)
+        # -1 is needed because days of year starts at 1 and min day of datetime is 1 Jan
+        start = year + timedelta(days=int(date[2:5]) - 1)
+        if len(_day_starts) >= _MAX_CACHED_DAYS:
+            _day_starts.clear()
+        _day_starts[date] = start
+        return start
+
+
+def parse_body(body):
+    """Parses body of a tracker SMS
+
+    :param body: (str) body of SMS
+    :return: (ParsedBody)
+    :raises IndexError: when body has too few columns
+    :raises ValueError: when a column is not numeric or a position time is out of range
+    """
+    cols = body.split(',')
+    nr_cols = len(cols)
+    header = Header(int(cols[0]),
+                    float(cols[1]) / 1000,
+                    float(cols[2]) / 10,
+                    )
+    i = HEADER_COLUMNS
+
+    # positions has 4 cols, debug has 5, so if odd nr of cols then has debug
+    debug = None
+    if (nr_cols - i) % 2 == 1:
+        if nr_cols < i + DEBUG_COLUMNS:
+            raise IndexError('Body has incomplete debug columns')
+        debug = Debug(*cols[i:i + DEBUG_COLUMNS])
+        i += DEBUG_COLUMNS
+
+    positions = []
+    # empty date column means no gps fix yet
+    if (nr_cols - i) % POSITION_COLUMNS == 0:
+        while i < nr_cols and cols[i]:
+            try:
+                date_time = day_start(cols[i]) + timedelta(seconds=int(cols[i + 1]))
+            except OverflowError:
+                raise ValueError('Position time out of range')
+            positions.append(Fix(date_time,
+                                 float(cols[i + 2]) / COORDINATE_SCALE,
+                                 float(cols[i + 3]) / COORDINATE_SCALE,
+                                 ))
+            i += POSITION_COLUMNS
+
+    return ParsedBody(header, debug, tuple(positions))
@@ -0,0 +1,219 @@
+"""Reading positions back out, one page at a time.
+
+Pages are keyset paginated on (date_time, id), the `next` cursor of a page is the key of its last position,
+so fetching a page costs the same however far into the window it is, unlike OFFSET which rereads all skipped rows.
+
+Rows are streamed from a server-side cursor and serialized as they arrive,
+so a large page is never held in memory as a whole.
+
+Stored positions are never updated, a page only changes when positions are inserted in it.
+The ETag of a page is made from the request and the count and last key of its rows,
+which is computed with a single aggregate over the page before any row is fetched.
+The aggregate scans the (device_info_serial, date_time) unique index, but reads `id` from the table.
+"""
+from datetime import datetime
+import hashlib
+import json
+
+from sqlalchemy import and_, func, select, tuple_
+
+from .models import Position
+
+FORMAT_JSON = 'json'
+FORMAT_GEOJSON = 'geojson'
+FORMATS = (FORMAT_JSON, FORMAT_GEOJSON)
+CONTENT_TYPES = {
+    FORMAT_JSON: 'application/json',
+    FORMAT_GEOJSON: 'application/geo+json',
+}
+DEFAULT_LIMIT = 1000
+MAX_LIMIT = 10000
+# rows fetched from the server-side cursor at a time
+FETCH_SIZE = 500
+DATE_TIME_FORMATS = ('%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d')
+
+
+class PositionsQuery(object):
+    """Page of positions of a device in a time range
+
+    :param device_info_serial: (int) tracker identifier
+    :param start: (datetime) positions at or after, in UTC
+    :param end: (datetime) positions before, in UTC, None for no end
+    :param after: (tuple) (date_time, id) key of last position of previous page, None for first page
+    :param limit: (int) maximum nr of positions in page
+    :param format: (str) one of FORMATS
+    """
+
+    def __init__(self, device_info_serial, start, end=None, after=None, limit=DEFAULT_LIMIT, format=FORMAT_JSON):
+        self.device_info_serial = device_info_serial
+        self.start = start
+        self.end = end
+        self.after = after
+        self.limit = limit
+        self.format = format
+
+    @classmethod
+    def from_params(cls, params):
+        """Query from request parameters
+
+        :param params: (dict) with device_info_serial, start, and optional end, after, limit and format
+        :return: (PositionsQuery)
+        :raises ValueError: when a parameter is missing or invalid
+        """
+        if 'device_info_serial' not in params or 'start' not in params:
+            raise ValueError('device_info_serial and start are required')
+        device_info_serial = int(params['device_info_serial'])
+        start = parse_date_time(params['start'])
+        end = parse_date_time(params['end']) if params.get('end') else None
+        after = decode_cursor(params['after']) if params.get('after') else None
+        limit = int(params.get('limit', DEFAULT_LIMIT))
+        if not 0 < limit <= MAX_LIMIT:
+            raise ValueError('limit must be between 1 and {0}'.format(MAX_LIMIT))
+        format = params.get('format', FORMAT_JSON)
+        if format not in FORMATS:
+            raise ValueError('format must be one of {0}'.format(', '.join(FORMATS)))
+        return cls(device_info_serial, start, end, after, limit, format)
+
+    @property
+    def content_type(self):
+        return CONTENT_TYPES[self.format]
+
+    def select(self, columns):
+        """Select of `columns` of the positions in the page, ordered by (date_time, id)"""
+        table = Position.__table__
+        clauses = [table.c.device_info_serial == self.device_info_serial,
+                   table.c.date_time >= self.start,
+                   ]
+        if self.end is not None:
+            clauses.append(table.c.date_time < self.end)
+        if self.after is not None:
+            clauses.append(tuple_(table.c.date_time, table.c.id) > tuple_(*self.after))
+        return select(columns).where(and_(*clauses)).order_by(table.c.date_time, table.c.id).limit(self.limit)
+
+    def rows(self):
+        """Select of the positions of the page"""
+        table = Position.__table__
+        return self.select([table.c.id, table.c.device_info_serial, table.c.date_time, table.c.lon, table.c.lat])
+
+    def summary(self):
+        """Select of count and last key of the page"""
+        table = Position.__table__
+        keys = self.select([table.c.date_time, table.c.id]).alias('keys')
+        return select([func.count(), func.max(keys.c.date_time), func.max(keys.c.id)])
+
+    def etag(self, count, last_date_time, last_id):
+        """ETag of page with `count` positions and last key (last_date_time, last_id)"""
+        state = [self.device_info_serial, isoformat(self.start), isoformat(self.end),
+                 encode_cursor(self.after), self.limit, self.format,
+                 count, isoformat(last_date_time), last_id]
+        return hashlib.sha1(json.dumps(state).encode('utf-8')).hexdigest()
+
+    def stream(self, result):
+        """Serializes positions of `result` as they are fetched
+
+        The `next` cursor is written after the positions, it is null when the page is not full.
+
+        :param result: SQLAlchemy result of `rows()`
+        :return: generator of bytes
+        """
+        if self.format == FORMAT_GEOJSON:
+            yield b'{"type": "FeatureCollection", "features": ['
+        else:
+            yield b'{"positions": ['
+        count = 0
+        last = None
+        while True:
+            rows = result.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            chunk = []
+            for row in rows:
+                if count:
+                    chunk.append(', ')
+                chunk.append(json.dumps(self.serialize(row)))
+                count += 1
+                last = (row.date_time, row.id)
+            yield ''.join(chunk).encode('utf-8')
+        next_cursor = encode_cursor(last) if count == self.limit else None
+        yield '], "next": {0}}}'.format(json.dumps(next_cursor)).encode('utf-8')
+
+    def serialize(self, row):
+        position = {
+            'id': row.id,
+            'device_info_serial': row.device_info_serial,
+            'date_time': isoformat(row.date_time),
+            'lon': row.lon,
+            'lat': row.lat,
+        }
+        if self.format == FORMAT_GEOJSON:
+            return {
+                'type': 'Feature',
+                'geometry': {'type': 'Point', 'coordinates': [row.lon, row.lat]},
+                'properties': position,
+            }
+        return position
+
+
+class ClosingIterator(object):
+    """WSGI response body of `chunks` which calls `callbacks` when the server closes it
+
+    A server calls close when the body was sent, when the client disconnected
+    and also when the body was never iterated, unlike a generator, whose finally clause is then skipped.
+    """
+
+    def __init__(self, chunks, *callbacks):
+        self.chunks = chunks
+        self.callbacks = callbacks
+        self.closed = False
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def add_callback(self, callback):
+        """Also calls `callback` when the server closes the body"""
+        self.callbacks += (callback,)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            close = getattr(self.chunks, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            for callback in self.callbacks:
+                callback()
+
+
+def isoformat(value):
+    return None if value is None else value.isoformat()
+
+
+def parse_date_time(value):
+    """UTC datetime of `2015-06-01T12:00:00Z`, `2015-06-01T12:00:00` or `2015-06-01`
+
+    :raises ValueError: when value is not in one of those formats
+    """
+    for date_time_format in DATE_TIME_FORMATS:
+        try:
+            return datetime.strptime(value, date_time_format)
+        except ValueError:
+            pass
+    raise ValueError('Invalid date time {0!r}, expected YYYY-MM-DDTHH:MM:SSZ'.format(value))
+
+
+def encode_cursor(key):
+    """Cursor string of (date_time, id) key"""
+    if key is None:
+        return None
+    return '{0}_{1}'.format(key[0].strftime('%Y-%m-%dT%H:%M:%S'), key[1])
+
+
+def decode_cursor(cursor):
+    """(date_time, id) key of cursor string
+
+    :raises ValueError: when cursor is invalid
+    """
+    date_time, _, position_id = cursor.rpartition('_')
+    return datetime.strptime(date_time, '%Y-%m-%dT%H:%M:%S'), int(position_id)
@@ -0,0 +1,57 @@
+"""Bounded caches of recently stored message ids and position keys.
+
+SMSSync resends a message until it gets a successful reply, so most duplicates arrive within minutes.
+A resend found in the cache is acknowledged without touching the database.
+
+Keys are only added after they have been stored, so a hit is always a real duplicate.
+A miss falls back to the database, which still rejects duplicates,
+for example ones stored by another worker process or longer than `ttl` seconds ago.
+"""
+from collections import OrderedDict
+import threading
+import time
+
+
+class RecentlySeen(object):
+    """Least recently used set of keys which expire after `ttl` seconds
+
+    :param size: (int) maximum nr of keys
+    :param ttl: (float) seconds a key is remembered
+    """
+
+    def __init__(self, size=10000, ttl=3600):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # key -> time it was added, least recently used first
+        self._keys = OrderedDict()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def seen(self, key):
+        """Whether key was added less than `ttl` seconds ago
+
+        :return: (bool)
+        """
+        now = time.time()
+        with self._lock:
+            added = self._keys.pop(key, None)
+            if added is None or now - added > self.ttl:
+                self.misses += 1
+                return False
+            # move to most recently used end
+            self._keys[key] = added
+            self.hits += 1
+            return True
+
+    def add(self, key):
+        """Remembers key, evicting least recently used keys when cache is full"""
+        now = time.time()
+        with self._lock:
+            self._keys.pop(key, None)
+            self._keys[key] = now
+            while len(self._keys) > self.size:
+                self._keys.popitem(last=False)
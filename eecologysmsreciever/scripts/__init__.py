@@ -0,0 +1,26 @@
+# package
+from pyramid.paster import get_appsettings, setup_logging
+from sqlalchemy import engine_from_config
+
+from .. import environ_settings
+
+
+def settings_from_config_uri(config_uri, app='sms'):
+    """Sets up logging and reads settings of the app section of an ini file
+
+    :param config_uri: (str) ini file, for example production.ini
+    :param app: (str) name of app section in ini file
+    :return: (dict) app settings
+    """
+    setup_logging(config_uri)
+    return environ_settings(get_appsettings(config_uri, name=app))
+
+
+def engine_from_config_uri(config_uri, app='sms'):
+    """Sets up logging and creates SQLAlchemy engine from the app section of an ini file
+
+    :param config_uri: (str) ini file, for example production.ini
+    :param app: (str) name of app section in ini file
+    """
+    settings = settings_from_config_uri(config_uri, app)
+    return engine_from_config(settings, 'sqlalchemy.')
@@ -0,0 +1,148 @@
+"""Moves raw messages sent before a cutoff from sms.raw_message to a columnar archive.
+
+Raw messages are streamed with a server-side cursor in id order and written to a Parquet file per month,
+see `eecologysmsreciever.archive`.
+When all files are complete they are added to the manifest,
+after which their raw messages are deleted from the database, a transaction per row group.
+The ids to delete are read back from the files, so only raw messages which can be read from the archive are deleted.
+
+An interrupted run is completed by running it again, files missing from the manifest are written again
+and raw messages of files in the manifest which have not been deleted yet are deleted.
+
+Messages and positions are kept, their id is the id of the archived raw message.
+Requires the `c4e8a1f2b3d5` alembic migration, which drops the foreign key from sms.message to sms.raw_message.
+
+Usage::
+
+    sms_archive production.ini --before 2015-01-01 --directory /data/sms-archive
+"""
+from __future__ import print_function
+import argparse
+import logging
+
+from sqlalchemy import text
+
+from . import engine_from_config_uri
+from .reparse import parse_datetime
+from ..archive import Archive, month_of
+from ..models import SMS_SCHEMA
+
+LOGGER = logging.getLogger('eecologysmsreciever')
+
+SELECT_RAW_MESSAGES = text("""
+SELECT id, message_id::text, sent_from, body, sent_to, gateway_id, sent_timestamp FROM {schema}.raw_message
+WHERE sent_timestamp < :before
+ORDER BY id
+""".format(schema=SMS_SCHEMA))
+
+DELETE_RAW_MESSAGES = text('DELETE FROM {schema}.raw_message WHERE id = ANY(:ids)'.format(schema=SMS_SCHEMA))
+
+SELECT_MESSAGE_FOREIGN_KEY = text("""
+SELECT 1 FROM information_schema.table_constraints
+WHERE table_schema = :schema AND table_name = 'message' AND constraint_type = 'FOREIGN KEY'
+""")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('config_uri', help='Ini file, for example production.ini')
+    parser.add_argument('--app', default='sms', help='Name of app section in ini file (default: %(default)s)')
+    parser.add_argument('--before', type=parse_datetime, required=True,
+                        help='Archive raw messages sent before, format YYYY-MM-DD[THH:MM:SS]')
+    parser.add_argument('--directory', required=True, help='Archive directory')
+    parser.add_argument('--batch-size', type=int, default=10000,
+                        help='Nr of raw messages per row group and per delete transaction (default: %(default)s)')
+    parser.add_argument('--keep', action='store_true',
+                        help='Write archive, but keep raw messages in the database')
+    return parser.parse_args(argv)
+
+
+def has_message_foreign_key(connection):
+    return connection.execute(SELECT_MESSAGE_FOREIGN_KEY, schema=SMS_SCHEMA).first() is not None
+
+
+def write_archive(connection, archive, before, batch_size):
+    """Writes raw messages sent before `before` to a file per month
+
+    :param connection: SQLAlchemy connection
+    :param archive: (eecologysmsreciever.archive.Archive)
+    :param before: (datetime) cutoff
+    :param batch_size: (int) nr of raw messages per row group
+    :return: (list) manifest entries of written files, already added to the manifest
+    """
+    writers = {}
+    # server-side cursor, so only a batch of rows is in memory
+    result = connection.execution_options(stream_results=True).execute(SELECT_RAW_MESSAGES, before=before)
+    try:
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                month = month_of(row[-1])
+                writer = writers.get(month)
+                if writer is None:
+                    writer = archive.writer(month, row[0], batch_size)
+                    writers[month] = writer
+                writer.write(tuple(row))
+            LOGGER.info('Archived raw messages up to id %s', rows[-1][0])
+    finally:
+        result.close()
+    entries = [writers[month].close() for month in sorted(writers)]
+    archive.add(entries)
+    return entries
+
+
+def delete_archived(connection, archive, entry):
+    """Deletes raw messages of an archived file from the database, a transaction per row group
+
+    :return: (int) nr of deleted raw messages
+    """
+    if not archive.verify(entry):
+        raise ValueError('Checksum of {0} does not match manifest'.format(entry['path']))
+    deleted = 0
+    for ids in archive.ids(entry):
+        with connection.begin():
+            deleted += connection.execute(DELETE_RAW_MESSAGES, ids=ids).rowcount
+    archive.mark_deleted(entry)
+    LOGGER.info('Deleted %s raw messages of %s', deleted, entry['path'])
+    return deleted
+
+
+def archive_raw_messages(engine, args):
+    """Archives raw messages selected by args
+
+    :return: (dict) with counts of archived and deleted raw messages and written files
+    """
+    archive = Archive(args.directory)
+    for path in archive.remove_incomplete():
+        LOGGER.warn('Removed incomplete archive file %s', path)
+    counts = {'archived': 0, 'deleted': 0, 'files': 0}
+    connection = engine.connect()
+    try:
+        if args.keep:
+            if archive.pending():
+                # their raw messages would be archived again
+                raise SystemExit('Raw messages of archived files are still in the database, run without --keep first')
+        else:
+            if has_message_foreign_key(connection):
+                raise SystemExit('sms.message references sms.raw_message, run `alembic upgrade c4e8a1f2b3d5` first')
+            # files of an interrupted run or a run with --keep
+            for entry in archive.pending():
+                counts['deleted'] += delete_archived(connection, archive, entry)
+        entries = write_archive(connection, archive, args.before, args.batch_size)
+        counts['files'] = len(entries)
+        counts['archived'] = sum(entry['rows'] for entry in entries)
+        if not args.keep:
+            for entry in entries:
+                counts['deleted'] += delete_archived(connection, archive, entry)
+    finally:
+        connection.close()
+    return counts
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    engine = engine_from_config_uri(args.config_uri, args.app)
+    counts = archive_raw_messages(engine, args)
+    print('{archived} raw messages archived in {files} files, {deleted} raw messages deleted'.format(**counts))
@@ -0,0 +1,391 @@
+"""Replays SMSSync messages against the receiver and reports throughput and latency.
+
+Messages are synthetic or read from a newline delimited JSON file with a SMSSync object per line,
+the format of the spool and of /messages/batch.
+They are posted to the app of an ini file in-process, to the app running on a SQLite stand-in database
+or over HTTP to a running receiver.
+Reports throughput, p50/p95/p99 latency, outcomes and, in-process, database statements per request.
+
+Usage::
+
+    sms_benchmark --sqlite --messages 2000 --concurrency 4 --duplicate-ratio 0.1
+    sms_benchmark benchmark.ini --write-path core --replay messages.ndjson
+    sms_benchmark benchmark.ini --url http://localhost:6566/sms
+
+Only run against a disposable database, the messages are stored.
+"""
+from __future__ import print_function
+import argparse
+from datetime import datetime, timedelta
+import json
+import logging
+import math
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+from pyramid.paster import get_appsettings, setup_logging
+from sqlalchemy import event
+from webob import Request
+
+try:
+    from urllib import urlencode
+    from urllib2 import urlopen
+except ImportError:
+    from urllib.parse import urlencode
+    from urllib.request import urlopen
+
+from .. import environ_settings, main as make_app
+from ..models import DBSession, LOCATION_MODES
+
+LOGGER = logging.getLogger('eecologysmsreciever')
+
+# Schema of sms.sql without PostGIS, location is stored as EWKT text
+SQLITE_SCHEMA = (
+    """CREATE TABLE sms.raw_message (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        message_id CHAR(32) UNIQUE,
+        sent_from TEXT,
+        body TEXT,
+        sent_to TEXT,
+        gateway_id TEXT,
+        sent_timestamp DATETIME
+    )""",
+    """CREATE TABLE sms.message (
+        id INTEGER PRIMARY KEY REFERENCES raw_message (id),
+        device_info_serial INTEGER,
+        date_time DATETIME NOT NULL,
+        battery_voltage FLOAT,
+        memory_usage FLOAT,
+        debug_info TEXT
+    )""",
+    """CREATE TABLE sms.position (
+        id INTEGER NOT NULL REFERENCES message (id),
+        device_info_serial INTEGER,
+        date_time DATETIME NOT NULL,
+        lon FLOAT,
+        lat FLOAT,
+        location TEXT,
+        PRIMARY KEY (id, date_time),
+        UNIQUE (device_info_serial, date_time)
+    )""",
+)
+
+
+# Geometry functions, the core write path uses the PostGIS names, GeoAlchemy2 the SpatiaLite names
+SQLITE_FUNCTIONS = ('ST_GeomFromEWKT', 'GeomFromEWKT', 'AsEWKB')
+SQLITE_POINT_FUNCTIONS = {
+    'ST_MakePoint': lambda lon, lat: 'POINT({0} {1})'.format(lon, lat),
+    'MakePoint': lambda lon, lat: 'POINT({0} {1})'.format(lon, lat),
+    'ST_SetSRID': lambda point, srid: 'SRID={0};{1}'.format(srid, point),
+    'SetSRID': lambda point, srid: 'SRID={0};{1}'.format(srid, point),
+}
+
+
+def use_sqlite_standin(engine, path):
+    """Attaches SQLite database at `path` as sms schema to each connection of engine
+
+    PostGIS functions used by the app are registered as SQLite functions.
+    Must be called before the engine makes its first connection.
+    """
+    create = not os.path.exists(path)
+
+    def attach(dbapi_connection, connection_record):
+        # let SQLAlchemy emit BEGIN, pysqlite's own transaction handling breaks SAVEPOINT
+        dbapi_connection.isolation_level = None
+        dbapi_connection.execute("ATTACH DATABASE '{0}' AS sms".format(path))
+        dbapi_connection.execute('PRAGMA busy_timeout = 30000')
+        for name in SQLITE_FUNCTIONS:
+            dbapi_connection.create_function(name, 1, lambda ewkt: ewkt)
+        for name, function in SQLITE_POINT_FUNCTIONS.items():
+            dbapi_connection.create_function(name, 2, function)
+
+    def begin(connection):
+        connection.execute('BEGIN IMMEDIATE')
+
+    event.listen(engine, 'connect', attach)
+    event.listen(engine, 'begin', begin)
+    if create:
+        with engine.begin() as connection:
+            connection.execute('PRAGMA sms.journal_mode = WAL')
+            for statement in SQLITE_SCHEMA:
+                connection.execute(statement)
+
+
+class StatementCounter(object):
+    """Counts statements executed by an engine"""
+
+    def __init__(self, engine):
+        self._lock = threading.Lock()
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self.increment)
+
+    def increment(self, *args):
+        with self._lock:
+            self.count += 1
+
+
+def synthetic_body(rng, device_info_serial, first_fix, nr_positions):
+    """Tracker SMS body with debug columns and `nr_positions` positions a minute apart"""
+    cols = [str(device_info_serial), str(rng.randint(3600, 4200)), str(rng.randint(0, 1000)),
+            '014022', '031', '00820202020204020200', '0', '722']
+    for i in range(nr_positions):
+        fix = first_fix + timedelta(minutes=i)
+        seconds = fix.hour * 3600 + fix.minute * 60 + fix.second
+        cols += ['{0:02d}{1:03d}'.format(fix.year - 2000, fix.timetuple().tm_yday), str(seconds),
+                 str(rng.randint(40000000, 60000000)), str(rng.randint(500000000, 530000000))]
+    return ','.join(cols)
+
+
+def synthetic_messages(nr_messages, nr_positions=3, nr_devices=100, seed=None):
+    """SMSSync parameters of unique messages, each device reports `nr_positions` positions per message
+
+    :return: (list) of dicts
+    """
+    rng = random.Random(seed)
+    start = datetime(2015, 1, 1)
+    messages = []
+    for i in range(nr_messages):
+        device_info_serial = 1 + i % nr_devices
+        # later messages of a device have later positions, so positions are unique
+        first_fix = start + timedelta(minutes=(i // nr_devices) * nr_positions)
+        sent = first_fix + timedelta(minutes=nr_positions)
+        messages.append({
+            'message_id': str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+            'from': '31600{0:06d}'.format(device_info_serial),
+            'message': synthetic_body(rng, device_info_serial, first_fix, nr_positions),
+            'sent_to': '31612345678',
+            'device_id': 'gateway{0}'.format(i % 3),
+            'sent_timestamp': str(int((sent - datetime(1970, 1, 1)).total_seconds()) * 1000),
+        })
+    return messages
+
+
+def add_duplicates(messages, duplicate_ratio, seed=None):
+    """Replaces a fraction of messages by a resend of an earlier message, like a gateway retrying"""
+    rng = random.Random(seed)
+    result = []
+    for message in messages:
+        if result and rng.random() < duplicate_ratio:
+            result.append(rng.choice(result))
+        else:
+            result.append(message)
+    return result
+
+
+def read_messages(path):
+    """SMSSync parameters from newline delimited JSON file"""
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def write_messages(path, messages):
+    with open(path, 'w') as f:
+        for message in messages:
+            f.write(json.dumps(message) + '\n')
+
+
+def wsgi_poster(app, secret):
+    """Function which posts a message to the WSGI app in-process and returns the payload"""
+    def post(params):
+        request = Request.blank('/messages', POST=dict(params, secret=secret))
+        response = request.get_response(app)
+        return json.loads(response.body.decode('utf-8'))['payload']
+    return post
+
+
+def http_poster(url, secret):
+    """Function which posts a message to a running receiver and returns the payload"""
+    def post(params):
+        data = urlencode(dict(params, secret=secret)).encode('utf-8')
+        response = urlopen(url.rstrip('/') + '/messages', data)
+        try:
+            return json.loads(response.read().decode('utf-8'))['payload']
+        finally:
+            response.close()
+    return post
+
+
+def percentile(sorted_values, fraction):
+    """Nearest rank percentile of sorted values"""
+    if not sorted_values:
+        return None
+    rank = int(math.ceil(fraction * len(sorted_values)))
+    return sorted_values[min(max(rank, 1), len(sorted_values)) - 1]
+
+
+def run(post, messages, concurrency=1):
+    """Posts messages with `concurrency` threads
+
+    :return: (tuple) list of latencies in seconds, dict with count per outcome and elapsed seconds
+    """
+    latencies = []
+    outcomes = {}
+    lock = threading.Lock()
+    todo = iter(messages)
+
+    def worker():
+        try:
+            post_all()
+        finally:
+            # close session of this thread in this thread, SQLite connections can not be shared between threads
+            DBSession.remove()
+
+    def post_all():
+        while True:
+            with lock:
+                params = next(todo, None)
+            if params is None:
+                return
+            start = time.time()
+            try:
+                result = post(params)
+                outcome = 'success' if result['success'] else result['error']
+            except Exception as e:
+                LOGGER.warn(e)
+                outcome = 'request error'
+            latency = time.time() - start
+            with lock:
+                latencies.append(latency)
+                outcomes[outcome] = outcomes.get(outcome, 0) + 1
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, outcomes, time.time() - start
+
+
+def report(latencies, outcomes, elapsed, nr_statements=None):
+    """Summary of a run
+
+    :return: (dict) with requests, throughput in requests per second, latency percentiles in ms,
+        outcomes and statements per request (None when not counted)
+    """
+    latencies = sorted(latencies)
+    nr_requests = len(latencies)
+    summary = {
+        'requests': nr_requests,
+        'elapsed': elapsed,
+        'throughput': nr_requests / elapsed if elapsed else None,
+        'outcomes': outcomes,
+        'statements_per_request': None,
+    }
+    for name, fraction in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99)):
+        value = percentile(latencies, fraction)
+        summary[name] = value * 1000 if value is not None else None
+    if nr_statements is not None and nr_requests:
+        summary['statements_per_request'] = float(nr_statements) / nr_requests
+    return summary
+
+
+def format_report(summary):
+    lines = [
+        'Requests: {requests} in {elapsed:.2f}s'.format(**summary),
+        'Throughput: {throughput:.1f} requests/s'.format(**summary),
+        'Latency: p50 {p50:.2f}ms, p95 {p95:.2f}ms, p99 {p99:.2f}ms'.format(**summary),
+    ]
+    if summary['statements_per_request'] is not None:
+        lines.append('Statements: {statements_per_request:.2f} per request'.format(**summary))
+    for outcome in sorted(summary['outcomes']):
+        lines.append('Outcome {0}: {1}'.format(outcome, summary['outcomes'][outcome]))
+    return '\n'.join(lines)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('config_uri', nargs='?',
+                        help='Ini file of a benchmark database, not needed with --sqlite')
+    parser.add_argument('--app', default='sms', help='Name of app section in ini file (default: %(default)s)')
+    parser.add_argument('--sqlite', action='store_true',
+                        help='Run app in-process on a temporary SQLite stand-in database')
+    parser.add_argument('--url', help='Post over HTTP to receiver running at url, for example http://localhost:6566/sms')
+    parser.add_argument('--secret', help='Secret key, default is secret_key of ini file')
+    parser.add_argument('--write-path', choices=('orm', 'core'), help='Overwrite write_path setting of in-process app')
+    parser.add_argument('--location', choices=LOCATION_MODES, help='Overwrite location setting of in-process app')
+    parser.add_argument('--prepare', choices=('true', 'false'),
+                        help='Overwrite db.prepare setting of in-process app, only used with PostgreSQL')
+    parser.add_argument('--replay', help='Newline delimited JSON file with SMSSync messages to post')
+    parser.add_argument('--save', help='Write synthetic messages to newline delimited JSON file for replay')
+    parser.add_argument('--messages', type=int, default=1000,
+                        help='Nr of synthetic messages (default: %(default)s)')
+    parser.add_argument('--positions', type=int, default=3,
+                        help='Nr of positions per synthetic message (default: %(default)s)')
+    parser.add_argument('--duplicate-ratio', type=float, default=0.0,
+                        help='Fraction of messages which are resends of an earlier message (default: %(default)s)')
+    parser.add_argument('--concurrency', type=int, default=1, help='Nr of concurrent clients (default: %(default)s)')
+    parser.add_argument('--seed', type=int, help='Seed for synthetic messages and duplicates')
+    parser.add_argument('--json', action='store_true', help='Print report as JSON')
+    args = parser.parse_args(argv)
+    if not args.sqlite and not args.config_uri and not (args.url and args.secret):
+        parser.error('Give an ini file, --sqlite or --url with --secret')
+    return args
+
+
+def benchmark(args, settings):
+    """Runs benchmark described by command line arguments
+
+    :param args: parsed command line arguments
+    :param settings: (dict) app settings from ini file, can be empty with --sqlite or --url
+    :return: (dict) summary, see `report`
+    """
+    if args.replay:
+        messages = read_messages(args.replay)
+    else:
+        messages = synthetic_messages(args.messages, args.positions, seed=args.seed)
+        if args.save:
+            write_messages(args.save, messages)
+    messages = add_duplicates(messages, args.duplicate_ratio, seed=args.seed)
+
+    if args.url:
+        post = http_poster(args.url, args.secret or settings['secret_key'])
+        latencies, outcomes, elapsed = run(post, messages, args.concurrency)
+        return report(latencies, outcomes, elapsed)
+
+    settings = dict(settings)
+    tmpdir = None
+    try:
+        if args.sqlite:
+            tmpdir = tempfile.mkdtemp()
+            settings.update({
+                'sqlalchemy.url': 'sqlite://',
+                'secret_key': args.secret or settings.get('secret_key', 'benchmark'),
+                'alert_too_old': settings.get('alert_too_old', '26'),
+                # stand-in is attached after app is made
+                'db.warm_up': '0',
+            })
+        if args.write_path:
+            settings['write_path'] = args.write_path
+        if args.location:
+            settings['location'] = args.location
+        if args.prepare:
+            settings['db.prepare'] = args.prepare
+        app = make_app({}, **settings)
+        if args.sqlite:
+            use_sqlite_standin(app.registry.engine, os.path.join(tmpdir, 'sms.sqlite'))
+        counter = StatementCounter(app.registry.engine)
+        post = wsgi_poster(app, settings['secret_key'])
+        latencies, outcomes, elapsed = run(post, messages, args.concurrency)
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
+    return report(latencies, outcomes, elapsed, counter.count)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    settings = {}
+    if args.config_uri:
+        setup_logging(args.config_uri)
+        settings = environ_settings(dict(get_appsettings(args.config_uri, name=args.app)))
+    summary = benchmark(args, settings)
+    if args.json:
+        print(json.dumps(summary, sort_keys=True))
+    else:
+        print(format_report(summary))
@@ -0,0 +1,85 @@
+"""Serves the receiver with gevent, so many slow gateway connections can be in flight in one process.
+
+Each request runs in a greenlet instead of a thread.
+The standard library and psycopg2 are patched to yield to other greenlets while waiting on sockets,
+so a request waiting for the database or a slow client does not hold up the others.
+The app, its /messages and /status contract and the parsing are the same as when served by waitress.
+
+Connections to the database are still limited by the `sqlalchemy.pool_size` and `sqlalchemy.max_overflow` settings,
+greenlets wait for a free connection without blocking the process.
+
+Requires gevent and psycogreen, install with `pip install eEcology-SMS-reciever[gevent]`.
+
+Usage::
+
+    sms_gevent production.ini --listen 0.0.0.0:6566 --max-connections 10000
+"""
+import argparse
+
+from pyramid.paster import get_app, setup_logging
+from sqlalchemy.util import ThreadLocalRegistry
+
+from ..models import DBSession, ReadSession
+
+
+def patch():
+    """Makes standard library and psycopg2 cooperative, must be called before the app is loaded"""
+    from gevent import monkey
+    monkey.patch_all()
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+    # session registry was made at import, before threading.local was patched, remake it so each greenlet has a session
+    DBSession.registry = ThreadLocalRegistry(DBSession.session_factory)
+    ReadSession.registry = ThreadLocalRegistry(ReadSession.session_factory)
+
+
+def remove_session(app):
+    """WSGI middleware which removes the sessions of a request when it is done
+
+    Greenlets are not reused like threads are, so a session is not left behind for the next request.
+    """
+    def middleware(environ, start_response):
+        try:
+            return app(environ, start_response)
+        finally:
+            DBSession.remove()
+            ReadSession.remove()
+    return middleware
+
+
+def parse_listen(listen):
+    """(host, port) of a `host:port` string"""
+    host, _, port = listen.rpartition(':')
+    return host or '0.0.0.0', int(port)
+
+
+def make_server(app, listen='0.0.0.0:6566', max_connections=10000):
+    """gevent WSGI server for app
+
+    :param app: WSGI app
+    :param listen: (str) host:port to listen on
+    :param max_connections: (int) maximum nr of concurrent connections, more connections wait in the listen backlog
+    :return: (gevent.pywsgi.WSGIServer)
+    """
+    from gevent.pool import Pool
+    from gevent.pywsgi import WSGIServer
+    # no access log, like waitress
+    return WSGIServer(parse_listen(listen), remove_session(app), spawn=Pool(max_connections), log=None)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('config_uri', help='Configuration file, e.g. production.ini')
+    parser.add_argument('--app', default='main', help='Name of app section in ini file (default: %(default)s)')
+    parser.add_argument('--listen', default='0.0.0.0:6566', help='host:port to listen on (default: %(default)s)')
+    parser.add_argument('--max-connections', type=int, default=10000,
+                        help='Maximum nr of concurrent connections (default: %(default)s)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    patch()
+    setup_logging(args.config_uri)
+    app = get_app(args.config_uri, name=args.app)
+    make_server(app, args.listen, args.max_connections).serve_forever()
@@ -0,0 +1,205 @@
+"""Measures parser speed and allocations for realistic message bodies and checks a fuzz corpus.
+
+Bodies per second are measured for each body shape, header only, with debug columns and with 1 to 30 positions,
+for the parser (`parse_body`) and for the ORM adapter (`Message.from_body`).
+Allocations are measured with tracemalloc (Python >= 3.4) as blocks and bytes retained by a parsed body.
+
+The corpus contains well formed bodies of each shape and malformed bodies derived from them.
+Parsing a body must either succeed or raise IndexError or ValueError, which the receiver reports as "Invalid message".
+
+Usage::
+
+    sms_parser_benchmark --number 20000
+    sms_parser_benchmark --corpus-only
+"""
+from __future__ import print_function
+import argparse
+import random
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from ..models import Message
+from ..parser import parse_body
+
+HEADER = u'1607,4099,0000'
+DEBUG = u'014022,031,00820202020204020200,0,722'
+POSITION_COUNTS = (1, 2, 5, 10, 20, 30)
+INVALID_ERRORS = (IndexError, ValueError)
+
+
+def position_columns(nr_positions, first_seconds=52797):
+    cols = []
+    for i in range(nr_positions):
+        cols += [u'15133', u'{0}'.format(first_seconds + i * 60), u'49561568', u'523572094']
+    return u','.join(cols)
+
+
+def body_shapes():
+    """Well formed bodies by shape name
+
+    :return: (list) of (name, body) tuples
+    """
+    shapes = [
+        ('header', HEADER),
+        ('debug', u','.join([HEADER, DEBUG])),
+        ('debug_nofix', u','.join([HEADER, DEBUG, u',,,'])),
+    ]
+    for nr_positions in POSITION_COUNTS:
+        shapes.append(('positions_{0}'.format(nr_positions),
+                       u','.join([HEADER, DEBUG, position_columns(nr_positions)])))
+    return shapes
+
+
+def malformed_bodies():
+    """Hand written malformed bodies which are rejected
+
+    :return: (list) of (name, body) tuples
+    """
+    return [
+        ('empty', u''),
+        ('text', u'hallo'),
+        ('short_header', u'1607,4099'),
+        ('nonnumeric_serial', u'abc,4099,0000'),
+        ('nonnumeric_battery', u'1607,x,0000'),
+        ('partial_debug', u','.join([HEADER, u'014022,031,00820202020204020200'])),
+        ('nonnumeric_date', u','.join([HEADER, DEBUG, u'15x33,52797,49561568,523572094'])),
+        ('short_date', u','.join([HEADER, DEBUG, u'1,52797,49561568,523572094'])),
+        ('empty_time', u','.join([HEADER, DEBUG, u'15133,,49561568,523572094'])),
+        ('nonnumeric_lon', u','.join([HEADER, DEBUG, u'15133,52797,east,523572094'])),
+        ('time_out_of_range', u','.join([HEADER, DEBUG, u'15133,99999999999999,49561568,523572094'])),
+    ]
+
+
+def mutations(body, rng, nr_mutations):
+    """Bodies derived from `body` by truncating, dropping a column or replacing a character"""
+    result = []
+    for _ in range(nr_mutations):
+        kind = rng.randint(0, 2)
+        if kind == 0:
+            result.append(body[:rng.randint(0, len(body))])
+        elif kind == 1:
+            cols = body.split(u',')
+            del cols[rng.randrange(len(cols))]
+            result.append(u','.join(cols))
+        else:
+            i = rng.randrange(len(body))
+            result.append(body[:i] + rng.choice(u',-.x 9\u00e9') + body[i + 1:])
+    return result
+
+
+def corpus(seed=0, nr_mutations=50):
+    """Well formed, malformed and fuzzed bodies
+
+    :return: (list) of (name, body) tuples
+    """
+    rng = random.Random(seed)
+    bodies = body_shapes() + malformed_bodies()
+    for name, body in body_shapes():
+        for i, mutated in enumerate(mutations(body, rng, nr_mutations)):
+            bodies.append(('{0}_fuzz{1}'.format(name, i), mutated))
+    return bodies
+
+
+def check_corpus(bodies, parse=parse_body):
+    """Parses each body of corpus
+
+    :return: (tuple) nr of valid bodies, nr of invalid bodies and
+        list of (name, body, exception) of bodies which raised something else than IndexError or ValueError
+    """
+    nr_valid = 0
+    nr_invalid = 0
+    unexpected = []
+    for name, body in bodies:
+        try:
+            parse(body)
+            nr_valid += 1
+        except INVALID_ERRORS:
+            nr_invalid += 1
+        except Exception as e:
+            unexpected.append((name, body, e))
+    return nr_valid, nr_invalid, unexpected
+
+
+def bodies_per_second(parse, body, number):
+    start = time.time()
+    for _ in range(number):
+        parse(body)
+    elapsed = time.time() - start
+    return number / elapsed if elapsed else float('inf')
+
+
+def retained_allocations(parse, body, number=1000):
+    """Blocks and bytes allocated per parsed body, which are still referenced by the result
+
+    :return: (tuple) of blocks and bytes per body or None when tracemalloc is not available
+    """
+    if tracemalloc is None:
+        return None
+    parse(body)  # warm up caches
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        results = [parse(body) for _ in range(number)]
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    stats = after.compare_to(before, 'filename')
+    nr_blocks = sum(stat.count_diff for stat in stats)
+    nr_bytes = sum(stat.size_diff for stat in stats)
+    del results
+    return float(nr_blocks) / number, float(nr_bytes) / number
+
+
+TARGETS = {
+    'parser': parse_body,
+    'model': Message.from_body,
+}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--target', choices=sorted(TARGETS), action='append',
+                        help='Function to measure, parser or model (default: both)')
+    parser.add_argument('--number', type=int, default=10000,
+                        help='Nr of times each body is parsed (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of fuzz corpus (default: %(default)s)')
+    parser.add_argument('--corpus-only', action='store_true', help='Only check the corpus')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    targets = args.target or sorted(TARGETS)
+    bodies = corpus(args.seed)
+    failed = False
+    for target in targets:
+        nr_valid, nr_invalid, unexpected = check_corpus(bodies, TARGETS[target])
+        print('{0} corpus: {1} valid, {2} invalid, {3} unexpected errors'.format(
+            target, nr_valid, nr_invalid, len(unexpected)))
+        for name, body, error in unexpected:
+            print('  {0}: {1!r} raised {2!r}'.format(name, body, error))
+            failed = True
+    if args.corpus_only:
+        return 1 if failed else 0
+
+    print('{0:<8} {1:<14} {2:>12} {3:>10} {4:>12} {5:>12}'.format(
+        'target', 'shape', 'bodies/s', 'us/body', 'blocks/body', 'bytes/body'))
+    for target in targets:
+        parse = TARGETS[target]
+        for name, body in body_shapes():
+            rate = bodies_per_second(parse, body, args.number)
+            allocations = retained_allocations(parse, body)
+            blocks, size = allocations if allocations is not None else ('-', '-')
+            print('{0:<8} {1:<14} {2:>12.0f} {3:>10.2f} {4:>12} {5:>12}'.format(
+                target, name, rate, 1e6 / rate, format_allocation(blocks), format_allocation(size)))
+    return 1 if failed else 0
+
+
+def format_allocation(value):
+    if isinstance(value, float):
+        return '{0:.1f}'.format(value)
+    return value
@@ -0,0 +1,162 @@
+"""Maintains the monthly partitions of sms.position.
+
+Creates partitions for the coming months and detaches (or drops) partitions older than the retention period.
+Requires the partitioned position table of the `4a1c6e2d9b7f` alembic migration.
+
+Usage::
+
+    sms_partitions production.ini --months-ahead 3 --retention-months 24
+"""
+from __future__ import print_function
+import argparse
+from datetime import date, datetime
+import logging
+import re
+
+from sqlalchemy import text
+
+from . import engine_from_config_uri
+from ..models import SMS_SCHEMA
+
+LOGGER = logging.getLogger('eecologysmsreciever')
+
+PARENT = 'position'
+DEFAULT_PARTITION = 'position_default'
+PARTITION_NAME = re.compile(r'^position_y(\d{4})m(\d{2})$')
+POSITION_COLUMNS = ('id', 'device_info_serial', 'date_time', 'lon', 'lat', 'location')
+
+SELECT_GENERATED_COLUMNS = text("""
+SELECT column_name FROM information_schema.columns
+WHERE table_schema = :schema AND table_name = :parent AND is_generated = 'ALWAYS'
+""")
+
+SELECT_PARTITIONS = text("""
+SELECT c.relname
+FROM pg_inherits i
+JOIN pg_class c ON c.oid = i.inhrelid
+JOIN pg_class p ON p.oid = i.inhparent
+JOIN pg_namespace n ON n.oid = p.relnamespace
+WHERE n.nspname = :schema AND p.relname = :parent
+ORDER BY c.relname
+""")
+
+
+def add_months(month, nr_months):
+    """First day of the month `nr_months` after the month of `month`"""
+    index = month.year * 12 + month.month - 1 + nr_months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month):
+    return 'position_y{0:04d}m{1:02d}'.format(month.year, month.month)
+
+
+def partition_month(name):
+    """First day of month of partition or None when name is not a monthly partition"""
+    match = PARTITION_NAME.match(name)
+    if match is None:
+        return None
+    return date(int(match.group(1)), int(match.group(2)), 1)
+
+
+def list_partitions(connection):
+    """Names of partitions of sms.position"""
+    return [row[0] for row in connection.execute(SELECT_PARTITIONS, schema=SMS_SCHEMA, parent=PARENT)]
+
+
+def insertable_columns(connection):
+    """Comma separated columns of sms.position which can be inserted, the location column can be generated"""
+    generated = set(row[0] for row in connection.execute(SELECT_GENERATED_COLUMNS, schema=SMS_SCHEMA, parent=PARENT))
+    return ', '.join(c for c in POSITION_COLUMNS if c not in generated)
+
+
+def create_partition(connection, month):
+    """Creates partition for month.
+
+    Positions of that month in the default partition are moved to the new partition,
+    as a partition can not be created while the default partition has rows for it.
+    """
+    params = {'start': month, 'end': add_months(month, 1)}
+    sql = {
+        'schema': SMS_SCHEMA,
+        'parent': PARENT,
+        'default': DEFAULT_PARTITION,
+        'name': partition_name(month),
+    }
+    create = text('CREATE TABLE {schema}.{name} PARTITION OF {schema}.{parent} '
+                  'FOR VALUES FROM (:start) TO (:end)'.format(**sql))
+    in_default = connection.execute(text(
+        'SELECT 1 FROM {schema}.{default} WHERE date_time >= :start AND date_time < :end LIMIT 1'.format(**sql)
+    ), **params).scalar()
+    if in_default is None:
+        connection.execute(create, **params)
+        return
+    LOGGER.warn('Moving positions of %s from default partition', month)
+    sql['columns'] = insertable_columns(connection)
+    connection.execute('ALTER TABLE {schema}.{parent} DETACH PARTITION {schema}.{default}'.format(**sql))
+    connection.execute(create, **params)
+    connection.execute(text(
+        'INSERT INTO {schema}.{name} ({columns}) SELECT {columns} FROM {schema}.{default} '
+        'WHERE date_time >= :start AND date_time < :end ORDER BY date_time'.format(**sql)
+    ), **params)
+    connection.execute(text(
+        'DELETE FROM {schema}.{default} WHERE date_time >= :start AND date_time < :end'.format(**sql)
+    ), **params)
+    connection.execute('ALTER TABLE {schema}.{parent} ATTACH PARTITION {schema}.{default} DEFAULT'.format(**sql))
+
+
+def detach_partition(connection, name, drop=False):
+    connection.execute('ALTER TABLE {schema}.{parent} DETACH PARTITION {schema}.{name}'.format(
+        schema=SMS_SCHEMA, parent=PARENT, name=name))
+    if drop:
+        connection.execute('DROP TABLE {schema}.{name}'.format(schema=SMS_SCHEMA, name=name))
+
+
+def plan(partitions, today, months_ahead, retention_months=None):
+    """Partitions to create and to detach
+
+    :param partitions: (list) names of existing partitions
+    :param today: (datetime.date)
+    :param months_ahead: (int) nr of months after the current month which should have a partition
+    :param retention_months: (int) nr of months before the current month to keep attached or None to keep all
+    :return: (tuple) list of months to create a partition for and list of partition names to detach
+    """
+    existing = set(partitions)
+    this_month = date(today.year, today.month, 1)
+    to_create = [add_months(this_month, i) for i in range(months_ahead + 1)
+                 if partition_name(add_months(this_month, i)) not in existing]
+    to_detach = []
+    if retention_months is not None:
+        oldest = add_months(this_month, -retention_months)
+        to_detach = [name for name in partitions
+                     if partition_month(name) is not None and partition_month(name) < oldest]
+    return to_create, to_detach
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('config_uri', help='Ini file, for example production.ini')
+    parser.add_argument('--app', default='sms', help='Name of app section in ini file (default: %(default)s)')
+    parser.add_argument('--months-ahead', type=int, default=3,
+                        help='Nr of future months to create partitions for (default: %(default)s)')
+    parser.add_argument('--retention-months', type=int,
+                        help='Detach partitions older than this nr of months, default is to keep all')
+    parser.add_argument('--drop', action='store_true', help='Drop detached partitions')
+    parser.add_argument('--dry-run', action='store_true', help='Print what would be done')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    engine = engine_from_config_uri(args.config_uri, args.app)
+    with engine.begin() as connection:
+        to_create, to_detach = plan(list_partitions(connection), datetime.utcnow().date(),
+                                    args.months_ahead, args.retention_months)
+        for month in to_create:
+            print('Create', partition_name(month))
+            if not args.dry_run:
+                create_partition(connection, month)
+        for name in to_detach:
+            print('Drop' if args.drop else 'Detach', name)
+            if not args.dry_run:
+                detach_partition(connection, name, args.drop)
@@ -0,0 +1,246 @@
+"""Rebuilds sms.message and sms.position from sms.raw_message.
+
+Raw messages are streamed with a server-side cursor in id order and re-parsed in chunks.
+Each chunk replaces the messages and positions of its raw messages in a single transaction,
+after which the last processed id is written to a checkpoint file so an interrupted run can be resumed.
+
+With `--archive` raw messages are read from a columnar archive written by `sms_archive` instead of sms.raw_message.
+
+Usage::
+
+    sms_reparse production.ini --checkpoint reparse.checkpoint
+"""
+from __future__ import print_function
+import argparse
+from datetime import datetime
+import logging
+import os
+
+from psycopg2.extras import execute_values
+from sqlalchemy import engine_from_config, text
+
+from . import settings_from_config_uri
+from ..models import SMS_SCHEMA, ewkt_point, LOCATION_EWKT, LOCATION_SERVER, LOCATION_MODES
+from ..parser import parse_body
+from ..writer import naive_utc
+
+LOGGER = logging.getLogger('eecologysmsreciever')
+
+SELECT_RAW_MESSAGES = """
+SELECT id, body, sent_timestamp FROM {schema}.raw_message
+WHERE id >= :start_id {filters}
+ORDER BY id
+"""
+
+DELETE_POSITIONS = 'DELETE FROM {schema}.position WHERE id = ANY(%s)'.format(schema=SMS_SCHEMA)
+DELETE_MESSAGES = 'DELETE FROM {schema}.message WHERE id = ANY(%s)'.format(schema=SMS_SCHEMA)
+INSERT_MESSAGES = """
+INSERT INTO {schema}.message (id, device_info_serial, date_time, battery_voltage, memory_usage, debug_info)
+VALUES %s
+""".format(schema=SMS_SCHEMA)
+INSERT_POSITIONS = """
+INSERT INTO {schema}.position (id, device_info_serial, date_time, lon, lat{location_column})
+VALUES %s
+ON CONFLICT (device_info_serial, date_time) DO NOTHING
+"""
+# template of a position row by location mode
+POSITION_TEMPLATES = {
+    LOCATION_EWKT: '(%s, %s, %s, %s, %s, ST_GeomFromEWKT(%s))',
+    LOCATION_SERVER: '(%s, %s, %s, %s, %s, ST_SetSRID(ST_MakePoint(%s, %s), 4326))',
+}
+DEFAULT_POSITION_TEMPLATE = '(%s, %s, %s, %s, %s)'
+
+
+def parse_datetime(value):
+    """Datetime from ISO 8601 date or date and time string"""
+    for fmt in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError('Invalid date or date time: {0}'.format(value))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('config_uri', help='Ini file, for example production.ini')
+    parser.add_argument('--app', default='sms', help='Name of app section in ini file (default: %(default)s)')
+    parser.add_argument('--start-id', type=int, default=1, help='First raw message id to re-parse')
+    parser.add_argument('--end-id', type=int, help='Last raw message id to re-parse')
+    parser.add_argument('--since', type=parse_datetime,
+                        help='Only raw messages sent at or after, format YYYY-MM-DD[THH:MM:SS]')
+    parser.add_argument('--until', type=parse_datetime,
+                        help='Only raw messages sent before, format YYYY-MM-DD[THH:MM:SS]')
+    parser.add_argument('--chunk-size', type=int, default=1000,
+                        help='Nr of raw messages per transaction (default: %(default)s)')
+    parser.add_argument('--checkpoint', help='File to resume from and to write last processed id to')
+    parser.add_argument('--location', choices=LOCATION_MODES,
+                        help='How location of positions is constructed, overwrites location setting of ini file')
+    parser.add_argument('--dry-run', action='store_true', help='Parse raw messages, but do not write to database')
+    parser.add_argument('--archive', help='Re-parse raw messages of this sms_archive directory, requires pyarrow')
+    return parser.parse_args(argv)
+
+
+def apply_settings(args, settings):
+    """Fills in arguments which default to a setting of the ini file
+
+    :param args: parsed command line arguments
+    :param settings: (dict) app settings
+    """
+    if args.location is None:
+        args.location = settings.get('location', LOCATION_EWKT)
+
+
+def select_statement(args):
+    """SELECT statement and parameters for the raw messages selected with the command line arguments"""
+    filters = []
+    params = {'start_id': args.start_id}
+    if args.end_id is not None:
+        filters.append('AND id <= :end_id')
+        params['end_id'] = args.end_id
+    if args.since is not None:
+        filters.append('AND sent_timestamp >= :since')
+        params['since'] = args.since
+    if args.until is not None:
+        filters.append('AND sent_timestamp < :until')
+        params['until'] = args.until
+    sql = SELECT_RAW_MESSAGES.format(schema=SMS_SCHEMA, filters=' '.join(filters))
+    return text(sql), params
+
+
+def read_checkpoint(path):
+    """Last processed raw message id from checkpoint file or None when there is no checkpoint"""
+    if path is None or not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return int(f.read())
+
+
+def write_checkpoint(path, last_id):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(str(last_id))
+    os.rename(tmp_path, path)
+
+
+def reparse_chunk(rows, location=LOCATION_EWKT):
+    """Parses a chunk of raw messages
+
+    :param rows: list of (id, body, sent_timestamp) tuples
+    :param location: (str) location mode, position rows have the location columns of its template
+    :return: (tuple) with list of message rows, list of position rows and list of ids of invalid raw messages
+    """
+    messages = []
+    positions = []
+    invalid = []
+    for raw_id, body, sent_timestamp in rows:
+        try:
+            parsed = parse_body(body)
+        except (IndexError, ValueError, AttributeError):
+            # AttributeError when body is NULL
+            invalid.append(raw_id)
+            continue
+        header = parsed.header
+        messages.append((raw_id, header.device_info_serial, sent_timestamp,
+                         header.battery_voltage, header.memory_usage, parsed.debug_info))
+        for fix in parsed.positions:
+            position = (raw_id, header.device_info_serial, naive_utc(fix.date_time), fix.lon, fix.lat)
+            if location == LOCATION_EWKT:
+                position += (ewkt_point(fix.lon, fix.lat),)
+            elif location == LOCATION_SERVER:
+                position += (fix.lon, fix.lat)
+            positions.append(position)
+    return messages, positions, invalid
+
+
+def write_chunk(connection, ids, messages, positions, location=LOCATION_EWKT):
+    """Replaces messages and positions of raw messages with `ids`
+
+    :param connection: SQLAlchemy connection, inside a transaction
+    :param location: (str) location mode used to make position rows
+    """
+    cursor = connection.connection.cursor()
+    try:
+        cursor.execute(DELETE_POSITIONS, (ids,))
+        cursor.execute(DELETE_MESSAGES, (ids,))
+        if messages:
+            execute_values(cursor, INSERT_MESSAGES, messages, page_size=len(messages))
+        if positions:
+            template = POSITION_TEMPLATES.get(location, DEFAULT_POSITION_TEMPLATE)
+            location_column = ', location' if location in POSITION_TEMPLATES else ''
+            sql = INSERT_POSITIONS.format(schema=SMS_SCHEMA, location_column=location_column)
+            execute_values(cursor, sql, positions, template=template, page_size=len(positions))
+    finally:
+        cursor.close()
+
+
+def chunks(iterable, chunk_size):
+    """Lists of at most `chunk_size` items of iterable"""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def archived_chunks(args):
+    """Chunks of (id, body, sent_timestamp) rows of archived raw messages selected with the command line arguments"""
+    from ..archive import Archive
+    archive = Archive(args.archive)
+    rows = archive.raw_messages(start_id=args.start_id, end_id=args.end_id, since=args.since, until=args.until)
+    return chunks(rows, args.chunk_size)
+
+
+def reparse(engine, args):
+    """Re-parses raw messages selected by args
+
+    :return: (dict) with counts of raw messages, messages, positions and invalid raw messages
+    """
+    last_id = read_checkpoint(args.checkpoint)
+    if last_id is not None and last_id >= args.start_id:
+        LOGGER.info('Resuming after raw message %s', last_id)
+        args.start_id = last_id + 1
+    statement, params = select_statement(args)
+    counts = {'raw_messages': 0, 'messages': 0, 'positions': 0, 'invalid': 0}
+
+    read_connection = engine.connect()
+    write_connection = engine.connect()
+    try:
+        if args.archive:
+            rows_chunks = archived_chunks(args)
+            result = None
+        else:
+            # server-side cursor, so only a chunk of rows is in memory
+            result = read_connection.execution_options(stream_results=True).execute(statement, **params)
+            rows_chunks = iter(lambda: result.fetchmany(args.chunk_size), [])
+        for rows in rows_chunks:
+            messages, positions, invalid = reparse_chunk(rows, args.location)
+            ids = [row[0] for row in rows]
+            if not args.dry_run:
+                with write_connection.begin():
+                    write_chunk(write_connection, ids, messages, positions, args.location)
+                if args.checkpoint:
+                    write_checkpoint(args.checkpoint, ids[-1])
+            counts['raw_messages'] += len(rows)
+            counts['messages'] += len(messages)
+            counts['positions'] += len(positions)
+            counts['invalid'] += len(invalid)
+            LOGGER.info('Re-parsed raw messages up to id %s', ids[-1])
+        if result is not None:
+            result.close()
+    finally:
+        write_connection.close()
+        read_connection.close()
+    return counts
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    settings = settings_from_config_uri(args.config_uri, args.app)
+    apply_settings(args, settings)
+    engine = engine_from_config(settings, 'sqlalchemy.')
+    counts = reparse(engine, args)
+    print('{raw_messages} raw messages, {messages} messages, {positions} positions, {invalid} invalid'.format(**counts))
@@ -0,0 +1,328 @@
+"""Durable local spool with asynchronous write-behind to the database.
+
+Accepted messages are appended as JSON lines to an append-only spool file and fsynced before they are acknowledged.
+Concurrent appends share a single fsync (group commit).
+A background thread drains the spool to the database in batches using the core write path,
+the drained offset is checkpointed in a `<spool>.offset` file so draining resumes after a restart.
+Messages can be drained more than once after a crash, which is harmless as the core write path skips duplicates.
+While the database circuit breaker is open the spool is not drained, see `eecologysmsreciever.breaker`.
+When draining fails `max_failures` times in a row, for example because the database user lacks a grant,
+the drainer is failing, messages are then stored directly instead of spooled and /status reports an error,
+so messages are no longer acknowledged while they can not reach the database.
+
+A spool is used by a single process, it is locked so a second process can not corrupt it.
+"""
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+
+from sqlalchemy.exc import DataError, IntegrityError
+
+from .metrics import METRICS
+from .models import RawMessage, LOCATION_EWKT
+from .parser import parse_body
+from .writer import store_message
+
+LOGGER = logging.getLogger('eecologysmsreciever')
+
+DEFAULT_MAX_FAILURES = 10
+
+
+class Spool(object):
+    """Append only file of SMSSync messages
+
+    :param path: (str) path of spool file, created when it does not exist
+    :param compact_size: (int) truncate spool when it is fully drained and larger than this nr of bytes
+    """
+
+    def __init__(self, path, compact_size=1048576):
+        self.path = path
+        self.offset_path = path + '.offset'
+        self.compact_size = compact_size
+        # set when a message is appended, so a drainer can start draining
+        self.appended = threading.Event()
+        self._lock = threading.Lock()
+        self._sync_condition = threading.Condition()
+        self._syncing = False
+        # incremented by each compaction, so a sync knows whether it still concerns the same spool file
+        self._generation = 0
+        self._file = open(path, 'ab')
+        try:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            self._file.close()
+            raise IOError('Spool {0} is used by another process, a spool can only be used by a single process'.format(path))
+        self._written = self._truncate_partial_line()
+        os.fsync(self._file.fileno())
+        self._synced = self._written
+        self.offset = self._read_offset()
+
+    def _truncate_partial_line(self):
+        """Removes a partially written last line, left by a crash during an append.
+
+        A partially written message was never acknowledged, so it is safe to remove.
+        """
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        end = data.rfind(b'\n') + 1
+        if end != len(data):
+            LOGGER.warn('Removing partially written message from spool %s', self.path)
+            self._file.truncate(end)
+        self._file.seek(0, os.SEEK_END)
+        return end
+
+    def _read_offset(self):
+        try:
+            with open(self.offset_path) as f:
+                offset = int(f.read())
+        except (IOError, OSError, ValueError):
+            return 0
+        if offset > self._written:
+            # spool was truncated without writing offset
+            return 0
+        return offset
+
+    def _write_offset(self, offset):
+        tmp_path = self.offset_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(str(offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.offset_path)
+        self.offset = offset
+
+    def append(self, record):
+        """Appends record to spool, returns when record is on disk.
+
+        :param record: (dict) JSON serializable record
+        """
+        line = (json.dumps(record) + '\n').encode('utf-8')
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            self._written += len(line)
+            end = self._written
+            generation = self._generation
+        self._sync(end, generation)
+        self.appended.set()
+
+    def _sync(self, end, generation):
+        """Waits until spool is fsynced up to `end`, the first waiting thread performs the fsync for all waiting threads
+
+        When the spool was compacted after `end` was written, the record was already drained to the database
+        and no fsync is needed anymore.
+        """
+        with self._sync_condition:
+            while self._generation == generation and self._synced < end:
+                if self._syncing:
+                    self._sync_condition.wait()
+                    continue
+                self._syncing = True
+                # everything written so far has been flushed and is covered by this fsync
+                target = self._written
+                self._sync_condition.release()
+                try:
+                    os.fsync(self._file.fileno())
+                finally:
+                    self._sync_condition.acquire()
+                    self._syncing = False
+                    # compaction is skipped during a sync, so target still concerns the current spool file
+                    self._synced = max(self._synced, target)
+                    self._sync_condition.notify_all()
+
+    def read(self, max_records):
+        """Reads records which have not been drained yet
+
+        :param max_records: (int) maximum number of records to read
+        :return: (tuple) list of records and the offset after the last read record
+        """
+        records = []
+        offset = self.offset
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            while len(records) < max_records:
+                line = f.readline()
+                if not line.endswith(b'\n'):
+                    # end of spool or append in progress
+                    break
+                offset += len(line)
+                try:
+                    records.append(json.loads(line.decode('utf-8')))
+                except ValueError as e:
+                    LOGGER.warn('Skipping corrupt spool record: %s', e)
+        return records, offset
+
+    def pending(self):
+        """Nr of bytes of spooled messages which have not been drained yet"""
+        return self._written - self.offset
+
+    def commit(self, offset):
+        """Marks records up to `offset` as drained.
+
+        Spool is truncated when it is fully drained and larger than compact_size and no fsync is in progress.
+        """
+        with self._lock:
+            if offset == self._written and offset > self.compact_size:
+                with self._sync_condition:
+                    if not self._syncing:
+                        # checkpoint first, a crash before truncate only causes a harmless redrain
+                        self._write_offset(0)
+                        self._file.truncate(0)
+                        self._file.seek(0)
+                        self._written = 0
+                        self._synced = 0
+                        self._generation += 1
+                        # appenders waiting for an fsync of the old spool file have been drained already
+                        self._sync_condition.notify_all()
+                        return
+        self._write_offset(offset)
+
+    def close(self):
+        self._file.close()
+
+
+class SpoolDrainer(threading.Thread):
+    """Background thread which drains a spool to the database in batches
+
+    :param spool: (Spool)
+    :param engine: SQLAlchemy engine
+    :param batch_size: (int) nr of messages stored in a single transaction
+    :param interval: (float) seconds to wait before retrying after the spool was empty or the database failed
+    :param watermark: (eecologysmsreciever.watermark.Watermark) raised to latest stored position
+    :param location: (str) how location of positions is constructed, see `eecologysmsreciever.models.LOCATION_MODES`
+    :param device_latest: (bool) also update the latest state of each device in sms.device_latest
+    :param breaker: (eecologysmsreciever.breaker.CircuitBreaker) while open the spool is not drained
+    :param max_failures: (int) nr of consecutive failed batches after which the drainer is failing, None to never fail
+    """
+
+    def __init__(self, spool, engine, batch_size=100, interval=1.0, watermark=None, location=LOCATION_EWKT,
+                 device_latest=False, breaker=None, max_failures=DEFAULT_MAX_FAILURES):
+        super(SpoolDrainer, self).__init__(name='SpoolDrainer')
+        self.daemon = True
+        self.spool = spool
+        self.engine = engine
+        self.batch_size = batch_size
+        self.interval = interval
+        self.watermark = watermark
+        self.location = location
+        self.device_latest = device_latest
+        self.breaker = breaker
+        self.max_failures = max_failures
+        self.failures = 0
+        self.last_error = None
+        self._stopped = threading.Event()
+        METRICS.set('sms_spool_drain_consecutive_failures', 0)
+
+    def run(self):
+        while not self._stopped.is_set():
+            drained = self.drain_guarded()
+            if not drained:
+                self.spool.appended.wait(self.interval)
+                self.spool.appended.clear()
+
+    def stop(self):
+        self._stopped.set()
+        self.spool.appended.set()
+
+    def drain_guarded(self):
+        """Drains next batch when the circuit breaker allows it and records its result in the circuit breaker
+
+        An empty spool does not touch the database, so it is neither a probe nor a success for the breaker.
+
+        :return: (int) nr of drained messages, 0 when the spool was empty, the breaker was open or the database failed
+        """
+        records, offset = self.spool.read(self.batch_size)
+        if not records:
+            return 0
+        if self.breaker is not None and not self.breaker.allow():
+            return 0
+        start = time.time()
+        try:
+            drained = self.store_batch(records, offset)
+        except Exception as e:
+            # database is down, retry later
+            LOGGER.warn(e)
+            if self.breaker is not None:
+                self.breaker.record(False, time.time() - start)
+            self._failed(e)
+            return 0
+        if self.breaker is not None:
+            self.breaker.record(True, time.time() - start)
+        if self.failures:
+            LOGGER.warn('Spool drained again after %s failed batches', self.failures)
+        self.failures = 0
+        METRICS.set('sms_spool_drain_consecutive_failures', 0)
+        return drained
+
+    def _failed(self, error):
+        self.failures += 1
+        self.last_error = str(error)
+        METRICS.inc('sms_spool_drain_failures_total')
+        METRICS.set('sms_spool_drain_consecutive_failures', self.failures)
+        if self.failures == self.max_failures:
+            LOGGER.error('Spool failed to drain %s times in a row, storing messages directly until it drains again',
+                         self.failures)
+
+    @property
+    def failing(self):
+        """Whether the last `max_failures` batches failed, messages should then not be spooled"""
+        return self.max_failures is not None and self.failures >= self.max_failures
+
+    def statistics(self):
+        return {
+            'pending_bytes': self.spool.pending(),
+            'consecutive_failures': self.failures,
+            'failing': self.failing,
+            'last_error': self.last_error,
+        }
+
+    def drain_batch(self):
+        """Stores next batch of spooled messages in a single transaction
+
+        :return: (int) nr of drained messages
+        """
+        records, offset = self.spool.read(self.batch_size)
+        if not records:
+            return 0
+        return self.store_batch(records, offset)
+
+    def store_batch(self, records, offset):
+        """Stores spooled messages in a single transaction and marks them as drained after it is committed
+
+        Each message is stored in its own savepoint,
+        so a message the database refuses is skipped instead of blocking the spool forever.
+
+        :param records: (list) spooled messages
+        :param offset: (int) spool offset after the last message
+        :return: (int) nr of drained messages
+        """
+        latest = None
+        with self.engine.begin() as connection:
+            for record in records:
+                try:
+                    raw_message = RawMessage.from_params(record)
+                except (KeyError, ValueError) as e:
+                    LOGGER.warn('Skipping invalid spool record: %s', e)
+                    continue
+                try:
+                    parsed = parse_body(raw_message.body)
+                except (IndexError, ValueError) as e:
+                    LOGGER.debug(e)
+                    parsed = None
+                try:
+                    with connection.begin_nested():
+                        store_message(connection, raw_message, parsed, self.location, self.device_latest)
+                except (DataError, IntegrityError) as e:
+                    LOGGER.warn('Skipping spool record refused by database: %s', e)
+                    continue
+                if parsed is not None:
+                    for fix in parsed.positions:
+                        if latest is None or fix.date_time > latest:
+                            latest = fix.date_time
+        self.spool.commit(offset)
+        if self.watermark is not None and latest is not None:
+            self.watermark.update(latest)
+        return len(records)
@@ -0,0 +1,62 @@
+"""Startup of the app, timed per phase, and its readiness.
+
+Work the first request would otherwise pay for is done while the app is made, before the server listens:
+
+* configure, mappers are configured and the multi row position INSERT statements of the write path are built
+* warm_up, `db.warm_up` connections of the ingest pool and `read.db.warm_up` of the read pool are opened,
+  which also initializes the dialect and prepares statements when `db.prepare` is set
+
+The duration of each phase is logged and reported by /status/ready,
+which answers 503 Service Unavailable until the app is made and while the database circuit breaker is open,
+so a deploy only routes messages to a container once it can store them.
+"""
+from contextlib import contextmanager
+import logging
+import threading
+import time
+
+LOGGER = logging.getLogger('eecologysmsreciever')
+
+
+class Startup(object):
+    """Durations of startup phases and readiness of the app
+
+    :param started: (float) time at which the app started importing its modules
+    :param imported: (float) time at which the app modules were imported
+    """
+
+    def __init__(self, started, imported):
+        self.started = started
+        self.phases = [('import', imported - started)]
+        self.ready_at = None
+        self._ready = threading.Event()
+
+    @contextmanager
+    def phase(self, name):
+        """Context which is timed as phase `name`"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.time() - start))
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    def mark_ready(self):
+        """Marks the app as made, logs the durations of the phases"""
+        self.ready_at = time.time()
+        self._ready.set()
+        LOGGER.info('Started in %.3f seconds (%s)', self.seconds(),
+                    ', '.join('{0} {1:.3f}'.format(name, seconds) for name, seconds in self.phases))
+
+    def seconds(self):
+        """Seconds from importing the app modules until the app was made, or until now when it is not made yet"""
+        return (self.ready_at or time.time()) - self.started
+
+    def statistics(self):
+        return {
+            'seconds': self.seconds(),
+            'phases': dict(self.phases),
+        }
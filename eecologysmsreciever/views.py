@@ -1,55 +1,367 @@
+import json
 import logging
+import os
+import time
 from datetime import datetime
 from datetime import timedelta
 
+from pyramid.response import Response
 from pyramid.view import view_config
 from pyramid.exceptions import Forbidden
-from pyramid.httpexceptions import HTTPServerError
+from pyramid.httpexceptions import HTTPBadRequest, HTTPNotFound, HTTPNotModified, HTTPServerError, HTTPServiceUnavailable
+from pyramid.settings import asbool
 from sqlalchemy.exc import DBAPIError, IntegrityError, ProgrammingError, SQLAlchemyError
 from sqlalchemy.orm.exc import NoResultFound
 
 from .version import __version__
 
-from .models import DBSession, RawMessage, Message, Position
+from .breaker import OPEN
+from .db import pool_statistics
+from .export import Export
+from .metrics import METRICS, CONTENT_TYPE
+from .models import DBSession, ReadSession, RawMessage, Message, Position, DeviceLatest, LOCATION_EWKT
+from .parser import parse_body
+from .positions import ClosingIterator, PositionsQuery, isoformat
+from .writer import store_message, prepared_location, naive_utc, upsert_device_latest, EXECUTE_LATEST_POSITION
 
 LOGGER = logging.getLogger('eecologysmsreciever')
 
 
+MESSAGE_FIELDS = ('message_id', 'from', 'message', 'sent_to', 'device_id', 'sent_timestamp')
+DATABASE_ERRORS = ('Database error', 'Database ORM error')
+# error of a message rejected by admission control
+BUSY = 'Busy'
+# error of a message rejected while the circuit breaker is open
+UNAVAILABLE = 'Database unavailable'
+# errors of messages which the gateway should resend after Retry-After seconds
+RETRY_LATER = (BUSY, UNAVAILABLE)
+
+
+def payload(success, error=None):
+    return {'success': success, 'error': error}
+
+
+def outcome(name, result):
+    """Counts outcome of a message in the metrics and returns result"""
+    METRICS.inc('sms_messages_total', outcome=name)
+    return result
+
+
 @view_config(route_name='messages', request_method='POST', renderer='json')
 def recieve_message(request):
-    # Make sure db is set to UTC,
-    # db.e-ecology.sara.nl has 'Europe/Amsterdam' as timezone causing date_time to be stored in that timezone
     try:
-        DBSession.execute("SET TIME ZONE 'UTC'")
-        raw_message = RawMessage.from_request(request)
-        DBSession.add(raw_message)
-        DBSession.commit()
+        with METRICS.time('sms_stage_seconds', stage='from_request'):
+            raw_message = RawMessage.from_request(request)
+    except Forbidden as e:
+        LOGGER.debug(e)
+        return {'payload': outcome('forbidden', payload(False, 'Forbidden'))}
+    except KeyError as e:
+        LOGGER.debug(e)
+        return {'payload': outcome('invalid', payload(False, 'Invalid message'))}
+    result = store(request, raw_message)
+    if result['error'] in RETRY_LATER:
+        retry_later(request, [result['error']], 503)
+    return {'payload': result}
+
+
+def retry_later(request, errors, status=None):
+    """Tells gateway to retry messages rejected with `errors` later
+
+    The Retry-After is the seconds of admission control or until the next probe of the circuit breaker,
+    whichever is longer.
+    """
+    if status is not None:
+        request.response.status_int = status
+    seconds = 0
+    if BUSY in errors:
+        seconds = get_admission(request).retry_after
+    if UNAVAILABLE in errors:
+        seconds = max(seconds, get_breaker(request).retry_after())
+    request.response.headers['Retry-After'] = str(seconds)
+
+
+def use_core_write_path(request):
+    return request.registry.settings.get('write_path', 'orm') == 'core'
+
+
+def get_location(request):
+    """How location of positions is constructed, see `eecologysmsreciever.models.LOCATION_MODES`"""
+    return request.registry.settings.get('location', LOCATION_EWKT)
+
+
+def use_device_latest(request):
+    """Whether ingest maintains the latest state of each device, set with the `devices.latest` setting"""
+    return request.registry.settings.get('devices.latest', False)
+
+
+def get_spool(request):
+    """Spool of the worker process, None when it is not configured or while its drainer is failing"""
+    drainer = get_spool_drainer(request)
+    if drainer is not None and drainer.failing:
+        # an acknowledged message must reach the database, so store messages directly until the spool drains again
+        return None
+    return getattr(request.registry, 'spool', None)
+
+
+def get_spool_drainer(request):
+    return getattr(request.registry, 'spool_drainer', None)
+
+
+def get_watermark(request):
+    return getattr(request.registry, 'watermark', None)
+
+
+def get_admission(request):
+    return getattr(request.registry, 'admission', None)
+
+
+def get_breaker(request):
+    return getattr(request.registry, 'breaker', None)
+
+
+def get_recent_messages(request):
+    return getattr(request.registry, 'recent_messages', None)
+
+
+def get_recent_positions(request):
+    return getattr(request.registry, 'recent_positions', None)
+
+
+def recently_seen(recent, kind, key):
+    """Looks up key in recently seen cache and counts hit or miss in the metrics
+
+    :param recent: (eecologysmsreciever.recent.RecentlySeen) or None when cache is disabled
+    :param kind: (str) message or position
+    :param key: key to look up
+    :return: (bool)
+    """
+    if recent is None:
+        return False
+    hit = recent.seen(key)
+    METRICS.inc('sms_recently_seen_total', kind=kind, result='hit' if hit else 'miss')
+    return hit
+
+
+def new_positions(recent, positions, key):
+    """Positions which have not been stored recently
+
+    :param recent: (eecologysmsreciever.recent.RecentlySeen) or None when cache is disabled
+    :param positions: (list) of positions
+    :param key: function returning (device_info_serial, date_time) of a position
+    :return: (list) of positions
+    """
+    if recent is None:
+        return positions
+    return [position for position in positions if not recently_seen(recent, 'position', key(position))]
+
+
+def position_key(position):
+    return position.device_info_serial, position.date_time
+
+
+def remember_positions(recent, keys):
+    if recent is not None:
+        for key in keys:
+            recent.add(key)
+
+
+def store(request, raw_message):
+    """Stores raw message in the spool or using the write path configured with the `write_path` setting.
+
+    :param request: Pyramid request
+    :param raw_message: (RawMessage)
+    :return: (dict) with success and error keys
+    """
+    METRICS.inc('sms_gateway_messages_total', gateway_id=raw_message.gateway_id)
+    recent = get_recent_messages(request)
+    message_id = str(raw_message.message_id)
+    if recently_seen(recent, 'message', message_id):
+        # resend of a message stored by this process, app will treat message as being transferred
+        LOGGER.info('Raw message %s recently stored', message_id)
+        return outcome('duplicate', payload(True))
+    result = None
+    spool = get_spool(request)
+    if spool is not None:
+        result = spool_raw_message(spool, raw_message)
+        # when spool failed, store in db directly, which is what the spool drainer would do
+    if result is None:
+        admission = get_admission(request)
+        if admission is not None:
+            reason = admission.admit(raw_message.gateway_id)
+            if reason is not None:
+                # database is overloaded, reject without touching it, the gateway will resend the message
+                METRICS.inc('sms_admission_rejected_total', reason=reason, gateway_id=raw_message.gateway_id)
+                LOGGER.info('Raw message %s rejected, %s limit exceeded', message_id, reason)
+                return outcome('rejected', payload(False, BUSY))
+        start = None
+        try:
+            breaker = get_breaker(request)
+            if breaker is not None and not breaker.allow():
+                # database is down, fail at once instead of waiting for a connect timeout
+                LOGGER.info('Raw message %s rejected, database circuit breaker is open', message_id)
+                return outcome('unavailable', payload(False, UNAVAILABLE))
+            args = (raw_message, get_watermark(request), get_location(request), get_recent_positions(request),
+                    use_device_latest(request))
+            start = time.time()
+            if spool is not None or use_core_write_path(request):
+                result = store_raw_message_core(*args)
+            else:
+                result = store_raw_message(*args)
+            if breaker is not None:
+                breaker.record(result['error'] not in DATABASE_ERRORS, time.time() - start)
+        finally:
+            if admission is not None:
+                admission.release(raw_message.gateway_id, time.time() - start if start is not None else None)
+    if recent is not None and result['error'] not in DATABASE_ERRORS:
+        # raw message has been stored or spooled, also when its body is invalid
+        recent.add(message_id)
+    return result
+
+
+def spool_raw_message(spool, raw_message):
+    """Appends raw message to spool, the spool drainer will store it in the database.
+
+    :param spool: (eecologysmsreciever.spool.Spool)
+    :param raw_message: (RawMessage)
+    :return: (dict) with success and error keys or None when message could not be spooled
+    """
+    try:
+        with METRICS.time('sms_stage_seconds', stage='parse'):
+            parsed = parse_body(raw_message.body)
+    except (IndexError, ValueError) as e:
+        # raw message is stored even if it can not be parsed
+        LOGGER.debug(e)
+        parsed = None
+    try:
+        with METRICS.time('sms_stage_seconds', stage='spool'):
+            spool.append(raw_message.to_params())
+    except (IOError, OSError) as e:
+        LOGGER.warn(e)
+        return None
+    if parsed is None:
+        return outcome('invalid', payload(False, 'Invalid message'))
+    METRICS.observe('sms_message_positions', len(parsed.positions))
+    return outcome('success', payload(True))
+
+
+def batch_secret(request, messages):
+    """Secret of a batch request, from the POST body only.
+
+    :param request: Pyramid request
+    :param messages: (list) of dicts with SMSSync fields, the secret is removed from them
+    :return: (str) secret or None when it is missing or differs between messages
+    """
+    if request.content_type != 'application/x-ndjson':
+        return request.POST.get('secret')
+    secrets = set(params.pop('secret', None) for params in messages)
+    if len(secrets) != 1:
+        return None
+    return secrets.pop()
+
+
+def batch_params(request):
+    """Parameters of each message in a batch request.
+
+    The batch can be posted as form arrays, each SMSSync field repeated once per message,
+    or as newline delimited JSON (Content-Type: application/x-ndjson) with a SMSSync object per line.
+
+    :param request: Pyramid request
+    :return: (list) of dicts with SMSSync fields
+    :raises ValueError: when batch can not be split into messages
+    """
+    if request.content_type == 'application/x-ndjson':
+        messages = []
+        for line in request.body.decode(request.charset or 'utf-8').splitlines():
+            if not line.strip():
+                continue
+            params = json.loads(line)
+            if not isinstance(params, dict):
+                raise ValueError('Line is not a JSON object')
+            # form posts only contain strings, so JSON numbers like sent_timestamp are converted as well
+            messages.append(dict((k, u'{0}'.format(v)) for k, v in params.items() if v is not None))
+        return messages
+    columns = [request.POST.getall(field) for field in MESSAGE_FIELDS]
+    if len(set(len(column) for column in columns)) > 1:
+        raise ValueError('Form arrays have different lengths')
+    return [dict(zip(MESSAGE_FIELDS, values)) for values in zip(*columns)]
+
+
+@view_config(route_name='messages_batch', request_method='POST', renderer='json')
+def recieve_messages(request):
+    """Stores a batch of messages, for example the queue of a gateway which has been offline.
+
+    The secret is checked once for the whole batch, it is only accepted in the body,
+    as form field or as `secret` of each newline delimited JSON object,
+    so it does not end up in access logs.
+    Each message gets its own result in `payload.results`.
+    """
+    try:
+        messages = batch_params(request)
+        RawMessage.check_secret(request, batch_secret(request, messages))
+    except Forbidden as e:
+        LOGGER.debug(e)
+        return {'payload': outcome('forbidden', payload(False, 'Forbidden'))}
+    except ValueError as e:
+        LOGGER.debug(e)
+        return {'payload': outcome('invalid', payload(False, 'Invalid batch'))}
+
+    results = []
+    for params in messages:
+        try:
+            raw_message = RawMessage.from_params(params)
+        except (KeyError, ValueError) as e:
+            LOGGER.debug(e)
+            result = outcome('invalid', payload(False, 'Invalid message'))
+        else:
+            result = store(request, raw_message)
+        result['message_id'] = params.get('message_id')
+        results.append(result)
+    errors = [result['error'] for result in results if result['error'] in RETRY_LATER]
+    if errors:
+        # other messages of the batch may have been stored, so only the rejected ones must be resent later
+        retry_later(request, errors)
+
+    response = payload(True)
+    response['results'] = results
+    return {'payload': response}
+
+
+def store_raw_message(raw_message, watermark=None, location=LOCATION_EWKT, recent_positions=None, device_latest=False):
+    """Stores raw message and the message and positions parsed from it.
+
+    :param raw_message: (RawMessage)
+    :param watermark: (eecologysmsreciever.watermark.Watermark) raised to latest stored position
+    :param location: (str) how location of positions is constructed
+    :param recent_positions: (eecologysmsreciever.recent.RecentlySeen) recently stored positions, which are skipped
+    :param device_latest: (bool) also update the latest state of the device in sms.device_latest
+    :return: (dict) with success and error keys
+    """
+    try:
+        with METRICS.time('sms_stage_seconds', stage='raw_insert'):
+            DBSession.add(raw_message)
+            DBSession.commit()
     except IntegrityError as e:
         # when raw message already exists then return OK, so app will treat message as being transferred
         DBSession.rollback()
         LOGGER.warn(e)
-        return {'payload': {'success': True, 'error': None}}
+        return outcome('duplicate', payload(True))
     except DBAPIError as e:
         DBSession.rollback()
         LOGGER.warn(e)
-        return {'payload': {'success': False, 'error': 'Database error'}}
+        return outcome('database_error', payload(False, 'Database error'))
     except SQLAlchemyError as e:
         # Catches:
         # StatementError: Can't reconnect until invalid transaction is rolled back
         # (original cause: InvalidRequestError: Can't reconnect until invalid transaction is rolled back)
         DBSession.rollback()
         LOGGER.warn(e)
-        return {'payload': {'success': False, 'error': 'Database ORM error'}}
-    except Forbidden as e:
-        LOGGER.debug(e)
-        return {'payload': {'success': False, 'error': 'Forbidden'}}
-    except KeyError as e:
-        LOGGER.debug(e)
-        return {'payload': {'success': False, 'error': 'Invalid message'}}
+        return outcome('database_error', payload(False, 'Database ORM error'))
     try:
-        message = Message.from_raw(raw_message)
-        DBSession.add(message)
-        DBSession.commit()
+        with METRICS.time('sms_stage_seconds', stage='from_raw'):
+            message = Message.from_raw(raw_message, location)
+        with METRICS.time('sms_stage_seconds', stage='message_insert'):
+            DBSession.add(message)
+            DBSession.commit()
 
         positions = []
         try:
@@ -62,37 +374,96 @@ def recieve_message(request):
             DBSession.rollback()
             LOGGER.warn(e)
 
-        for position in positions:
-            try:
-                with DBSession.begin_nested():
-                    DBSession.merge(position)
-            except IntegrityError as e:
-                LOGGER.warn('Position already stored, skipping it')
-                LOGGER.warn(e)
-        DBSession.commit()
+        with METRICS.time('sms_stage_seconds', stage='positions'):
+            keys = []
+            for position in new_positions(recent_positions, positions, position_key):
+                try:
+                    with DBSession.begin_nested():
+                        DBSession.merge(position)
+                except IntegrityError as e:
+                    LOGGER.warn('Position already stored, skipping it')
+                    LOGGER.warn(e)
+                keys.append(position_key(position))
+            DBSession.commit()
+        remember_positions(recent_positions, keys)
+        if device_latest:
+            with METRICS.time('sms_stage_seconds', stage='device_latest'):
+                upsert_device_latest(DBSession, raw_message, message, positions)
+                DBSession.commit()
+        METRICS.observe('sms_message_positions', len(positions))
+        if watermark is not None and positions:
+            watermark.update(max(position.date_time for position in positions))
 
     except IndexError as e:
         LOGGER.debug(e)
-        return {'payload': {'success': False, 'error': 'Invalid message'}}
+        return outcome('invalid', payload(False, 'Invalid message'))
     except ValueError as e:
         LOGGER.debug(e)
-        return {'payload': {'success': False, 'error': 'Invalid message'}}
+        return outcome('invalid', payload(False, 'Invalid message'))
     except IntegrityError as e:
         DBSession.rollback()
         LOGGER.warn(e)
-        return {'payload': {'success': False, 'error': 'Database error'}}
+        return outcome('database_error', payload(False, 'Database error'))
     except DBAPIError as e:
         DBSession.rollback()
         LOGGER.warn(e)
-        return {'payload': {'success': False, 'error': 'Database error'}}
+        return outcome('database_error', payload(False, 'Database error'))
     except SQLAlchemyError as e:
         # Catches:
         # StatementError: Can't reconnect until invalid transaction is rolled back
         # (original cause: InvalidRequestError: Can't reconnect until invalid transaction is rolled back)
         DBSession.rollback()
         LOGGER.warn(e)
-        return {'payload': {'success': False, 'error': 'Database ORM error'}}
-    return {'payload': {'success': True, 'error': None}}
+        return outcome('database_error', payload(False, 'Database ORM error'))
+    return outcome('success', payload(True))
+
+
+def store_raw_message_core(raw_message, watermark=None, location=LOCATION_EWKT, recent_positions=None,
+                           device_latest=False):
+    """Stores raw message and the message and positions parsed from it in a single transaction.
+
+    :param raw_message: (RawMessage)
+    :param watermark: (eecologysmsreciever.watermark.Watermark) raised to latest stored position
+    :param location: (str) how location of positions is constructed
+    :param recent_positions: (eecologysmsreciever.recent.RecentlySeen) recently stored positions, which are skipped
+    :param device_latest: (bool) also update the latest state of the device in sms.device_latest
+    :return: (dict) with success and error keys
+    """
+    try:
+        with METRICS.time('sms_stage_seconds', stage='parse'):
+            parsed = parse_body(raw_message.body)
+    except (IndexError, ValueError) as e:
+        # raw message is stored even if it can not be parsed
+        LOGGER.debug(e)
+        parsed = None
+    to_store = parsed
+    if parsed is not None:
+        serial = parsed.header.device_info_serial
+        fixes = new_positions(recent_positions, parsed.positions, lambda fix: (serial, fix.date_time))
+        to_store = parsed._replace(positions=fixes)
+    try:
+        with METRICS.time('sms_stage_seconds', stage='store'):
+            raw_id = store_message(DBSession.connection(), raw_message, to_store, location, device_latest)
+            DBSession.commit()
+    except DBAPIError as e:
+        DBSession.rollback()
+        LOGGER.warn(e)
+        return outcome('database_error', payload(False, 'Database error'))
+    except SQLAlchemyError as e:
+        DBSession.rollback()
+        LOGGER.warn(e)
+        return outcome('database_error', payload(False, 'Database ORM error'))
+    if raw_id is None:
+        # when raw message already exists then return OK, so app will treat message as being transferred
+        LOGGER.info('Raw message %s already stored', raw_message.message_id)
+        return outcome('duplicate', payload(True))
+    if parsed is None:
+        return outcome('invalid', payload(False, 'Invalid message'))
+    remember_positions(recent_positions, ((serial, fix.date_time) for fix in to_store.positions))
+    METRICS.observe('sms_message_positions', len(parsed.positions))
+    if watermark is not None and parsed.positions:
+        watermark.update(max(fix.date_time for fix in parsed.positions))
+    return outcome('success', payload(True))
 
 
 def utcnow():
@@ -105,18 +476,234 @@ def utcnow():
 
 @view_config(route_name='status', request_method='GET', renderer='json')
 def status(request):
-    try:
-        DBSession.execute("SET TIME ZONE 'UTC'")
-        alert_too_old = request.registry.settings['alert_too_old']
-        latest_dt = utcnow() - timedelta(hours=alert_too_old)
-        last_position = DBSession.query(Position.date_time).filter(Position.date_time >= latest_dt).limit(1).scalar()
-        DBSession.commit()
-        if last_position is None:
+    drainer = get_spool_drainer(request)
+    if drainer is not None and drainer.failing:
+        raise HTTPServerError('Spooled messages can not be stored in the database: {0}'.format(drainer.last_error))
+    alert_too_old = request.registry.settings['alert_too_old']
+    latest_dt = utcnow() - timedelta(hours=alert_too_old)
+    watermark = get_watermark(request)
+    if watermark is not None:
+        last_seen = watermark.get()
+        if last_seen is not None and last_seen >= latest_dt:
+            return status_body(request)
+        if not watermark.fallback_due():
+            # database was checked recently and had no recent positions either
             raise HTTPServerError('Positions have not been received recently')
-        return {'version': __version__}
+
+    # watermark is unknown after a restart or positions could have been stored by another process
+    try:
+        connection = ReadSession.connection()
+        if prepared_location(connection) is not None:
+            last_position = connection.execute(EXECUTE_LATEST_POSITION, date_time=naive_utc(latest_dt)).scalar()
+        else:
+            last_position = ReadSession.query(Position.date_time).filter(Position.date_time >= latest_dt).limit(1).scalar()
+        ReadSession.commit()
     except DBAPIError as e:
-        DBSession.rollback()
+        ReadSession.rollback()
         LOGGER.warn(e)
         raise e
     except NoResultFound:
+        last_position = None
+    if watermark is not None:
+        watermark.checked(last_position)
+    if last_position is None:
         raise HTTPServerError('Positions have not been received recently')
+    return status_body(request)
+
+
+def status_body(request):
+    """Version and, when enabled, the state of the database circuit breaker and the spool of the worker process"""
+    body = {'version': __version__}
+    breaker = get_breaker(request)
+    if breaker is not None:
+        body['circuit_breaker'] = breaker.state
+    drainer = get_spool_drainer(request)
+    if drainer is not None:
+        body['spool'] = drainer.statistics()
+    return body
+
+
+DEFAULT_MIN_BATTERY_VOLTAGE = 3.7
+
+
+@view_config(route_name='device_status', request_method='GET', renderer='json')
+def device_status(request):
+    """Devices which have not sent a fix recently or have a low battery, from the latest state of each device.
+
+    A device is stale when its latest fix is older than `devices.max_age` hours (default is `alert_too_old`)
+    and has a low battery when its voltage is below `devices.min_battery_voltage`.
+    Thresholds can be overridden per device in the max_age and min_battery_voltage columns of sms.device_latest.
+    With `?all=true` all devices are listed.
+    """
+    settings = request.registry.settings
+    if not settings.get('devices.latest', False):
+        raise HTTPNotFound('Latest state of devices is not maintained, enable with devices.latest setting')
+    max_age = float(settings.get('devices.max_age', settings['alert_too_old']))
+    min_battery_voltage = float(settings.get('devices.min_battery_voltage', DEFAULT_MIN_BATTERY_VOLTAGE))
+    list_all = asbool(request.params.get('all', False))
+    now = naive_utc(utcnow())
+    try:
+        rows = ReadSession.query(DeviceLatest.device_info_serial,
+                               DeviceLatest.date_time,
+                               DeviceLatest.lon,
+                               DeviceLatest.lat,
+                               DeviceLatest.battery_voltage,
+                               DeviceLatest.memory_usage,
+                               DeviceLatest.gateway_id,
+                               DeviceLatest.message_date_time,
+                               DeviceLatest.max_age,
+                               DeviceLatest.min_battery_voltage,
+                               ).order_by(DeviceLatest.device_info_serial).all()
+        ReadSession.commit()
+    except DBAPIError as e:
+        ReadSession.rollback()
+        LOGGER.warn(e)
+        raise e
+
+    devices = []
+    for row in rows:
+        device_max_age = row.max_age if row.max_age is not None else max_age
+        device_min_battery_voltage = row.min_battery_voltage if row.min_battery_voltage is not None else min_battery_voltage
+        stale = row.date_time is None or row.date_time < now - timedelta(hours=device_max_age)
+        low_battery = row.battery_voltage is not None and row.battery_voltage < device_min_battery_voltage
+        if not (list_all or stale or low_battery):
+            continue
+        devices.append({
+            'device_info_serial': row.device_info_serial,
+            'date_time': isoformat(row.date_time),
+            'lon': row.lon,
+            'lat': row.lat,
+            'battery_voltage': row.battery_voltage,
+            'memory_usage': row.memory_usage,
+            'gateway_id': row.gateway_id,
+            'message_date_time': isoformat(row.message_date_time),
+            'max_age': device_max_age,
+            'min_battery_voltage': device_min_battery_voltage,
+            'stale': stale,
+            'low_battery': low_battery,
+        })
+    return {'devices': devices}
+
+
+@view_config(route_name='positions', request_method='GET')
+def positions(request):
+    """Page of positions of a device in a time range, as JSON or GeoJSON
+
+    Parameters are device_info_serial, start and optional end, after, limit and format,
+    see `eecologysmsreciever.positions.PositionsQuery`.
+    The `next` cursor at the end of a full page is the `after` parameter of the next page.
+    Responds with 304 Not Modified when the If-None-Match header matches the ETag of the page.
+    """
+    try:
+        query = PositionsQuery.from_params(request.params)
+    except ValueError as e:
+        raise HTTPBadRequest(str(e))
+    connection = None
+    try:
+        connection = request.registry.read_engine.connect()
+        count, last_date_time, last_id = connection.execute(query.summary()).first()
+        etag = query.etag(count, last_date_time, last_id)
+        if etag in request.if_none_match:
+            connection.close()
+            return HTTPNotModified(etag=etag)
+        # server-side cursor, so rows are fetched while streaming instead of all at once
+        result = connection.execution_options(stream_results=True).execute(query.rows())
+    except SQLAlchemyError as e:
+        if connection is not None:
+            connection.close()
+        LOGGER.warn(e)
+        raise e
+    response = Response(content_type=query.content_type, charset='utf-8',
+                        app_iter=ClosingIterator(query.stream(result), connection.close))
+    response.etag = etag
+    # clients must revalidate, which is cheap when the page is unchanged
+    response.cache_control = 'no-cache'
+    return response
+
+
+@view_config(route_name='export', request_method='GET')
+def export(request):
+    """Gzipped CSV or GeoJSON of positions of devices in a time range
+
+    Parameters are device_info_serial, repeated or comma separated, start and optional end, message and format,
+    see `eecologysmsreciever.export.Export`.
+    Responds with 503 Service Unavailable when `export.concurrency` exports are already in progress.
+    """
+    try:
+        query = Export.from_params(request.params)
+    except ValueError as e:
+        raise HTTPBadRequest(str(e))
+    exports = request.registry.exports
+    if not exports.acquire():
+        METRICS.inc('sms_bulkhead_rejected_total', request_class='export')
+        raise HTTPServiceUnavailable('Too many exports in progress, try again later')
+    connection = None
+    try:
+        connection = request.registry.read_engine.connect()
+        # server-side cursor, so rows are fetched while streaming instead of all at once
+        result = connection.execution_options(stream_results=True).execute(query.select())
+    except SQLAlchemyError as e:
+        if connection is not None:
+            connection.close()
+        exports.release()
+        LOGGER.warn(e)
+        raise e
+    # no content length, so the body is sent with chunked transfer encoding
+    return Response(content_type='application/gzip',
+                    content_disposition='attachment; filename="{0}"'.format(query.filename),
+                    app_iter=ClosingIterator(query.stream(result), connection.close, exports.release))
+
+
+@view_config(route_name='ready', request_method='GET', renderer='json')
+def ready(request):
+    """Whether the worker process is ready to store messages, with the durations of its startup phases
+
+    Responds with 503 Service Unavailable until the app is made and while the database circuit breaker is open.
+    """
+    registry = request.registry
+    startup = getattr(registry, 'startup', None)
+    breaker = get_breaker(request)
+    is_ready = startup is not None and startup.ready and (breaker is None or breaker.state != OPEN)
+    body = {'ready': is_ready}
+    if startup is not None:
+        body['startup'] = startup.statistics()
+    if breaker is not None:
+        body['circuit_breaker'] = breaker.state
+    if not is_ready:
+        request.response.status_int = 503
+    return body
+
+
+@view_config(route_name='pool_status', request_method='GET', renderer='json')
+def pool_status(request):
+    """Size, usage and checkout wait times of the database connection pools of the worker process serving the request
+
+    The ingest pool is reported at the top level, the pool of read requests under `read`,
+    the concurrency of each request class under `bulkheads`, the database load measured by admission control
+    under `admission`, the database circuit breaker under `circuit_breaker` and the spool drainer under `spool`.
+    """
+    registry = request.registry
+    stats = pool_statistics(registry.engine.pool)
+    stats['pid'] = os.getpid()
+    read_engine = getattr(registry, 'read_engine', None)
+    if read_engine is not None:
+        stats['read'] = pool_statistics(read_engine.pool)
+    bulkheads = getattr(registry, 'bulkheads', None)
+    if bulkheads is not None:
+        stats['bulkheads'] = {name: bulkhead.statistics() for name, bulkhead in bulkheads.items()}
+    admission = getattr(registry, 'admission', None)
+    if admission is not None:
+        stats['admission'] = admission.statistics()
+    breaker = getattr(registry, 'breaker', None)
+    if breaker is not None:
+        stats['circuit_breaker'] = breaker.statistics()
+    drainer = get_spool_drainer(request)
+    if drainer is not None:
+        stats['spool'] = drainer.statistics()
+    return stats
+
+
+@view_config(route_name='metrics', request_method='GET')
+def metrics(request):
+    """Ingest metrics in Prometheus text format"""
+    return Response(text=METRICS.render(), content_type=CONTENT_TYPE, charset='utf-8')
@@ -0,0 +1,102 @@
+"""Watermark of the latest position stored by the receiver.
+
+Updated on successful ingest, so /status can answer without querying the position table.
+The watermark can be shared between worker processes through a small memory mapped file.
+"""
+import calendar
+from datetime import datetime
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+
+_FORMAT = 'd'
+_SIZE = struct.calcsize(_FORMAT)
+
+
+def to_timestamp(date_time):
+    """Seconds since epoch of a naive UTC or time zone aware datetime"""
+    return calendar.timegm(date_time.utctimetuple()) + date_time.microsecond / 1e6
+
+
+class Watermark(object):
+    """Latest position date time seen by ingest
+
+    :param path: (str) file to share watermark between processes or None to keep it in this process only
+    :param fallback_interval: (float) minimum seconds between database checks when watermark is unknown or too old
+    """
+
+    def __init__(self, path=None, fallback_interval=300):
+        self.fallback_interval = fallback_interval
+        # seconds since epoch, 0 when unknown
+        self._value = 0.0
+        self._checked_at = None
+        self._lock = threading.Lock()
+        self._fd = None
+        self._map = None
+        if path:
+            self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            if os.fstat(self._fd).st_size < _SIZE:
+                os.ftruncate(self._fd, _SIZE)
+            self._map = mmap.mmap(self._fd, _SIZE)
+
+    def _read_shared(self):
+        return struct.unpack(_FORMAT, self._map[:_SIZE])[0]
+
+    def update(self, date_time):
+        """Raises watermark to `date_time` when it is later than current watermark
+
+        :param date_time: (datetime.datetime) naive UTC or time zone aware
+        """
+        value = to_timestamp(date_time)
+        if value <= self._value:
+            # shared watermark only increases, so it is also later
+            return
+        with self._lock:
+            if self._map is None:
+                self._value = max(self._value, value)
+                return
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                shared = self._read_shared()
+                if value > shared:
+                    self._map[:_SIZE] = struct.pack(_FORMAT, value)
+                self._value = max(value, shared)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def get(self):
+        """Latest position date time seen by any process sharing the watermark
+
+        :return: (datetime.datetime) naive UTC or None when unknown
+        """
+        if self._map is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_SH)
+            try:
+                self._value = max(self._value, self._read_shared())
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        if not self._value:
+            return None
+        return datetime.utcfromtimestamp(self._value)
+
+    def fallback_due(self):
+        """Whether the database should be checked, because it was not checked in the last `fallback_interval` seconds"""
+        return self._checked_at is None or time.time() - self._checked_at >= self.fallback_interval
+
+    def checked(self, date_time=None):
+        """Records a database check
+
+        :param date_time: (datetime.datetime) position date time found in database or None when none was found
+        """
+        self._checked_at = time.time()
+        if date_time is not None:
+            self.update(date_time)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            os.close(self._fd)
+            self._map = None
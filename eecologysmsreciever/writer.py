@@ -0,0 +1,325 @@
+"""Core level write path.
+
+Stores a raw message, its message and all its positions in a single transaction
+with at most three INSERT statements, instead of a commit per table and a SAVEPOINT + merge per position.
+
+Duplicates are skipped with INSERT ... ON CONFLICT DO NOTHING, which requires PostgreSQL >= 9.5.
+
+With the `db.prepare` setting each connection prepares the statements once when it is opened,
+a message is then stored with a single EXECUTE of a data modifying WITH query, which is planned once per connection.
+"""
+from sqlalchemy import text
+
+from .models import SMS_SCHEMA, ewkt_point, LOCATION_EWKT, LOCATION_SERVER, LOCATION_DATABASE, LOCATION_MODES
+
+INSERT_RAW_MESSAGE = text("""
+INSERT INTO {schema}.raw_message (message_id, sent_from, body, sent_to, gateway_id, sent_timestamp)
+VALUES (:message_id, :sent_from, :body, :sent_to, :gateway_id, :sent_timestamp)
+ON CONFLICT (message_id) DO NOTHING
+RETURNING id
+""".format(schema=SMS_SCHEMA))
+
+INSERT_MESSAGE = text("""
+INSERT INTO {schema}.message (id, device_info_serial, date_time, battery_voltage, memory_usage, debug_info)
+VALUES (:id, :device_info_serial, :date_time, :battery_voltage, :memory_usage, :debug_info)
+""".format(schema=SMS_SCHEMA))
+
+INSERT_POSITIONS = """
+INSERT INTO {schema}.position (id, device_info_serial, date_time, lon, lat{location_column})
+VALUES {values}
+ON CONFLICT (device_info_serial, date_time) DO NOTHING
+"""
+
+POSITION_VALUES = '(:id, :device_info_serial, :date_time_{0}, :lon_{0}, :lat_{0}{location_value})'
+
+# location column value by location mode
+LOCATION_VALUES = {
+    LOCATION_EWKT: ', ST_GeomFromEWKT(:location_{0})',
+    LOCATION_SERVER: ', ST_SetSRID(ST_MakePoint(:lon_{0}, :lat_{0}), 4326)',
+    LOCATION_DATABASE: '',
+}
+
+_insert_positions_statements = {}
+# nr of positions of messages whose INSERT statements are built at startup
+WARM_POSITIONS = 20
+
+# columns of sms.device_latest from latest message and from latest fix
+DEVICE_MESSAGE_COLUMNS = ('message_date_time', 'battery_voltage', 'memory_usage', 'gateway_id')
+DEVICE_FIX_COLUMNS = ('date_time', 'lon', 'lat', 'location')
+
+
+def _update_when(condition, columns):
+    return ',\n    '.join('{0} = CASE WHEN {1} THEN EXCLUDED.{0} ELSE d.{0} END'.format(column, condition)
+                          for column in columns)
+
+
+# a message or fix which arrives out of order does not overwrite a later one
+UPSERT_DEVICE_LATEST = text("""
+INSERT INTO {schema}.device_latest AS d (device_info_serial, message_date_time, battery_voltage, memory_usage, gateway_id,
+                                         date_time, lon, lat, location)
+VALUES (:device_info_serial, :message_date_time, :battery_voltage, :memory_usage, :gateway_id,
+        :date_time, :lon, :lat, ST_SetSRID(ST_MakePoint(:lon, :lat), 4326))
+ON CONFLICT (device_info_serial) DO UPDATE SET
+    {message_updates},
+    {fix_updates}
+""".format(schema=SMS_SCHEMA,
+           message_updates=_update_when('d.message_date_time IS NULL OR EXCLUDED.message_date_time >= d.message_date_time',
+                                        DEVICE_MESSAGE_COLUMNS),
+           fix_updates=_update_when('EXCLUDED.date_time IS NOT NULL AND (d.date_time IS NULL OR EXCLUDED.date_time > d.date_time)',
+                                    DEVICE_FIX_COLUMNS),
+           ))
+
+
+def insert_positions_statement(nr_positions, location=LOCATION_EWKT):
+    """Multi row INSERT statement for `nr_positions` positions of a single message.
+
+    Statements are cached by number of positions and location mode.
+    """
+    key = (nr_positions, location)
+    try:
+        return _insert_positions_statements[key]
+    except KeyError:
+        location_value = LOCATION_VALUES[location]
+        values = ', '.join(POSITION_VALUES.format(i, location_value=location_value.format(i))
+                           for i in range(nr_positions))
+        location_column = ', location' if location_value else ''
+        statement = text(INSERT_POSITIONS.format(schema=SMS_SCHEMA, values=values, location_column=location_column))
+        _insert_positions_statements[key] = statement
+        return statement
+
+
+def warm_statements(location=LOCATION_EWKT, max_positions=WARM_POSITIONS):
+    """Builds the INSERT statements of messages with up to `max_positions` positions, so the first messages do not"""
+    for nr_positions in range(1, max_positions + 1):
+        insert_positions_statement(nr_positions, location)
+
+
+# key in connection info, value is location mode statements were prepared for
+PREPARED = 'sms_prepared'
+
+PREPARE_STORE_MESSAGE = """
+PREPARE sms_store_message (uuid, text, text, text, text, timestamp,
+                           integer, double precision, double precision, text,
+                           timestamp[], double precision[], double precision[]{location_type}) AS
+WITH raw AS (
+    INSERT INTO {schema}.raw_message (message_id, sent_from, body, sent_to, gateway_id, sent_timestamp)
+    VALUES ($1, $2, $3, $4, $5, $6)
+    ON CONFLICT (message_id) DO NOTHING
+    RETURNING id
+), msg AS (
+    INSERT INTO {schema}.message (id, device_info_serial, date_time, battery_voltage, memory_usage, debug_info)
+    SELECT id, $7, $6, $8, $9, $10 FROM raw WHERE $7 IS NOT NULL
+    RETURNING id
+), positions AS (
+    INSERT INTO {schema}.position (id, device_info_serial, date_time, lon, lat{location_column})
+    SELECT msg.id, $7, p.date_time, p.lon, p.lat{location_value}
+    FROM msg, unnest($11, $12, $13{location_array}) AS p (date_time, lon, lat{location_alias})
+    ON CONFLICT (device_info_serial, date_time) DO NOTHING
+)
+SELECT id FROM raw
+"""
+
+# location column value by location mode, in the prepared statement
+PREPARED_LOCATION_VALUES = {
+    LOCATION_EWKT: ', ST_GeomFromEWKT(p.location)',
+    LOCATION_SERVER: ', ST_SetSRID(ST_MakePoint(p.lon, p.lat), 4326)',
+    LOCATION_DATABASE: '',
+}
+
+PREPARE_LATEST_POSITION = """
+PREPARE sms_latest_position (timestamp) AS
+SELECT date_time FROM {schema}.position WHERE date_time >= $1 LIMIT 1
+""".format(schema=SMS_SCHEMA)
+
+EXECUTE_STORE_MESSAGE = """
+EXECUTE sms_store_message (:message_id, :sent_from, :body, :sent_to, :gateway_id, :sent_timestamp,
+                           :device_info_serial, :battery_voltage, :memory_usage, :debug_info,
+                           :date_times, :lons, :lats{location_param})
+"""
+
+# only ewkt mode sends locations
+EXECUTE_STORE_MESSAGE_STATEMENTS = {
+    location: text(EXECUTE_STORE_MESSAGE.format(location_param=', :locations' if location == LOCATION_EWKT else ''))
+    for location in LOCATION_MODES
+}
+
+EXECUTE_LATEST_POSITION = text('EXECUTE sms_latest_position (:date_time)')
+
+
+def prepare_store_message(location=LOCATION_EWKT):
+    """PREPARE statement of sms_store_message for location mode"""
+    is_ewkt = location == LOCATION_EWKT
+    return PREPARE_STORE_MESSAGE.format(
+        schema=SMS_SCHEMA,
+        location_type=', text[]' if is_ewkt else '',
+        location_column='' if location == LOCATION_DATABASE else ', location',
+        location_value=PREPARED_LOCATION_VALUES[location],
+        location_array=', $14' if is_ewkt else '',
+        location_alias=', location' if is_ewkt else '',
+    )
+
+
+def prepare_statements(location=LOCATION_EWKT):
+    """Connect event listener which prepares the ingest statements on each new connection
+
+    :param location: (str) how location of positions is constructed, one of `eecologysmsreciever.models.LOCATION_MODES`
+    """
+    store_message_statement = prepare_store_message(location)
+
+    def prepare(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute(store_message_statement)
+        cursor.execute(PREPARE_LATEST_POSITION)
+        cursor.close()
+        dbapi_connection.commit()
+        connection_record.info[PREPARED] = location
+
+    return prepare
+
+
+def prepared_location(connection):
+    """Location mode the statements of connection were prepared for
+
+    :param connection: SQLAlchemy connection
+    :return: (str) location mode or None when statements have not been prepared
+    """
+    location = connection.info.get(PREPARED)
+    return location if location in LOCATION_MODES else None
+
+
+def naive_utc(value):
+    """Datetime without time zone so the database session time zone is not used for conversion"""
+    if value is not None and value.tzinfo is not None:
+        value = value.replace(tzinfo=None) - value.utcoffset()
+    return value
+
+
+def store_message(connection, raw_message, parsed=None, location=LOCATION_EWKT, device_latest=False):
+    """Stores raw message, message and positions.
+
+    Should be called inside a transaction, the caller is responsible for committing.
+
+    When the raw message already exists nothing is stored,
+    a resend is treated as being stored already.
+
+    Positions which already exist are skipped.
+
+    :param connection: SQLAlchemy connection
+    :param raw_message: (RawMessage) raw message to store
+    :param parsed: (eecologysmsreciever.parser.ParsedBody) body of raw message or None when it could not be parsed
+    :param location: (str) how location of positions is constructed, one of `eecologysmsreciever.models.LOCATION_MODES`
+    :param device_latest: (bool) also update the latest state of the device in sms.device_latest
+    :return: (int) id of the stored raw message or None when it already existed
+    """
+    if prepared_location(connection) == location:
+        return store_message_prepared(connection, raw_message, parsed, location, device_latest)
+    result = connection.execute(INSERT_RAW_MESSAGE,
+                                message_id=str(raw_message.message_id),
+                                sent_from=raw_message.sent_from,
+                                body=raw_message.body,
+                                sent_to=raw_message.sent_to,
+                                gateway_id=raw_message.gateway_id,
+                                sent_timestamp=naive_utc(raw_message.sent_timestamp),
+                                )
+    # pysqlite, used by the benchmark stand-in, does not describe an empty RETURNING result
+    raw_id = result.scalar() if result.returns_rows else None
+    if raw_id is None or parsed is None:
+        return raw_id
+
+    header = parsed.header
+    connection.execute(INSERT_MESSAGE,
+                       id=raw_id,
+                       device_info_serial=header.device_info_serial,
+                       date_time=naive_utc(raw_message.sent_timestamp),
+                       battery_voltage=header.battery_voltage,
+                       memory_usage=header.memory_usage,
+                       debug_info=parsed.debug_info,
+                       )
+
+    params = {'id': raw_id, 'device_info_serial': header.device_info_serial}
+    fixes = unique_fixes(parsed.positions)
+    for i, fix in enumerate(fixes):
+        params['date_time_{0}'.format(i)] = naive_utc(fix.date_time)
+        params['lon_{0}'.format(i)] = fix.lon
+        params['lat_{0}'.format(i)] = fix.lat
+        if location == LOCATION_EWKT:
+            params['location_{0}'.format(i)] = ewkt_point(fix.lon, fix.lat)
+    if fixes:
+        connection.execute(insert_positions_statement(len(fixes), location), **params)
+    if device_latest:
+        upsert_device_latest(connection, raw_message, header, fixes)
+
+    return raw_id
+
+
+def upsert_device_latest(connection, raw_message, header, fixes):
+    """Updates latest state of device in sms.device_latest
+
+    :param connection: SQLAlchemy connection or session
+    :param raw_message: (RawMessage)
+    :param header: parsed header or message, with device_info_serial, battery_voltage and memory_usage
+    :param fixes: (list) of fixes or positions, with date_time, lon and lat
+    """
+    params = {
+        'device_info_serial': header.device_info_serial,
+        'message_date_time': naive_utc(raw_message.sent_timestamp),
+        'battery_voltage': header.battery_voltage,
+        'memory_usage': header.memory_usage,
+        'gateway_id': raw_message.gateway_id,
+        'date_time': None,
+        'lon': None,
+        'lat': None,
+    }
+    if fixes:
+        latest = max(fixes, key=lambda fix: fix.date_time)
+        params['date_time'] = naive_utc(latest.date_time)
+        params['lon'] = latest.lon
+        params['lat'] = latest.lat
+    connection.execute(UPSERT_DEVICE_LATEST, params)
+
+
+def unique_fixes(fixes):
+    """Fixes without repeats of the same time, a body can contain the same fix twice"""
+    seen = set()
+    unique = []
+    for fix in fixes:
+        if fix.date_time not in seen:
+            seen.add(fix.date_time)
+            unique.append(fix)
+    return unique
+
+
+def store_message_prepared(connection, raw_message, parsed=None, location=LOCATION_EWKT, device_latest=False):
+    """Stores raw message, message and positions with a single EXECUTE of the prepared sms_store_message statement
+
+    Same as `store_message`, connection must have been prepared with `prepare_statements` for `location`.
+    """
+    params = {
+        'message_id': str(raw_message.message_id),
+        'sent_from': raw_message.sent_from,
+        'body': raw_message.body,
+        'sent_to': raw_message.sent_to,
+        'gateway_id': raw_message.gateway_id,
+        'sent_timestamp': naive_utc(raw_message.sent_timestamp),
+        'device_info_serial': None,
+        'battery_voltage': None,
+        'memory_usage': None,
+        'debug_info': None,
+    }
+    fixes = []
+    if parsed is not None:
+        header = parsed.header
+        params['device_info_serial'] = header.device_info_serial
+        params['battery_voltage'] = header.battery_voltage
+        params['memory_usage'] = header.memory_usage
+        params['debug_info'] = parsed.debug_info
+        fixes = unique_fixes(parsed.positions)
+    params['date_times'] = [naive_utc(fix.date_time) for fix in fixes]
+    params['lons'] = [fix.lon for fix in fixes]
+    params['lats'] = [fix.lat for fix in fixes]
+    if location == LOCATION_EWKT:
+        params['locations'] = [ewkt_point(fix.lon, fix.lat) for fix in fixes]
+    raw_id = connection.execute(EXECUTE_STORE_MESSAGE_STATEMENTS[location], **params).scalar()
+    if device_latest and raw_id is not None and parsed is not None:
+        upsert_device_latest(connection, raw_message, parsed.header, fixes)
+    return raw_id
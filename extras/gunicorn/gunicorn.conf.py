@@ -0,0 +1,27 @@
+# Gunicorn configuration to run the receiver with a worker process per core.
+#
+#   gunicorn --paste production.ini -c extras/gunicorn/gunicorn.conf.py
+#
+# Each worker loads the app after it is forked, so it creates its own engine and connection pool.
+# Set in the app section of the ini file:
+#   status.watermark_path, to share the latest position between workers for /status
+#   metrics.dir, to sum metrics of all workers in /metrics
+# spool.path can not be used, a spool can only be used by a single process.
+import multiprocessing
+import os
+import shutil
+
+bind = os.environ.get('BIND', '0.0.0.0:6566')
+workers = int(os.environ.get('WORKERS', multiprocessing.cpu_count()))
+# threads per worker, a request waits on the database most of the time
+threads = int(os.environ.get('THREADS', 4))
+# app must be loaded in each worker, not in the master before fork
+preload_app = False
+# same as metrics.dir in ini file
+metrics_dir = os.environ.get('METRICS_DIR')
+
+
+def on_starting(server):
+    # snapshots of a previous run would be summed with the new workers
+    if metrics_dir and os.path.isdir(metrics_dir):
+        shutil.rmtree(metrics_dir)
@@ -42,8 +42,25 @@ setup(name='eEcology-SMS-reciever',
       zip_safe=False,
       test_suite='eecologysmsreciever',
       install_requires=requires,
+      extras_require={
+          # eecologysmsreciever.bulk
+          'bulk': ['numpy'],
+          # sms_gevent
+          'gevent': ['gevent', 'psycogreen'],
+          # worker process per core, threads of gunicorn need futures on Python 2
+          'gunicorn': ['gunicorn', 'futures; python_version < "3"'],
+          # sms_archive and sms_reparse --archive
+          'archive': ['pyarrow'],
+      },
       entry_points="""\
       [paste.app_factory]
       main = eecologysmsreciever:main
+      [console_scripts]
+      sms_reparse = eecologysmsreciever.scripts.reparse:main
+      sms_partitions = eecologysmsreciever.scripts.partitions:main
+      sms_benchmark = eecologysmsreciever.scripts.benchmark:main
+      sms_parser_benchmark = eecologysmsreciever.scripts.parser_benchmark:main
+      sms_gevent = eecologysmsreciever.scripts.gevent_server:main
+      sms_archive = eecologysmsreciever.scripts.archive:main
       """,
       )
@@ -45,6 +45,12 @@ CREATE TABLE IF NOT EXISTS sms.position (
 
 CREATE INDEX idx_position_location ON sms.position USING GIST (location);
 
+-- This schema is alembic revision 340b921f3d41, mark a new database with `alembic stamp 340b921f3d41`
+-- and add sms.device_latest with `alembic upgrade 9b2f4c6d8e1a`, which grants smswriter the privileges it needs
+-- On PostgreSQL >= 11 the position table can be partitioned by month with the opt-in `alembic upgrade partitioning@head`
+-- Before archiving raw messages with sms_archive drop the foreign key of sms.message with `alembic upgrade c4e8a1f2b3d5`,
+-- after stamping, it also applies 9b2f4c6d8e1a and does not need partitioning
+
 -- create user to insert sms messages
 --
 -- CREATE USER smswriter WITH LOGIN PASSWORD '<please change me>';
@@ -52,6 +58,8 @@ CREATE INDEX idx_position_location ON sms.position USING GIST (location);
 -- GRANT INSERT ON sms.raw_message TO smswriter;
 -- GRANT SELECT (id) ON sms.raw_message TO smswriter;
 -- GRANT SELECT (date_time) ON sms.position TO smswriter;
+-- GRANT SELECT (message_id) ON sms.raw_message TO smswriter;
+-- GRANT SELECT (device_info_serial) ON sms.position TO smswriter;
 -- GRANT INSERT ON sms.message TO smswriter;
 -- GRANT INSERT ON sms.position TO smswriter;
 -- GRANT USAGE on SEQUENCE sms.raw_message_id_seq TO smswriter;
@@ -0,0 +1,124 @@
+import threading
+from unittest import TestCase
+
+from mock import Mock, patch
+from sqlalchemy.pool import QueuePool
+
+from eecologysmsreciever.admission import AdmissionControl, DecayingAverage, Limits
+from eecologysmsreciever.db import PoolStats
+
+
+class DecayingAverageTest(TestCase):
+
+    @patch('eecologysmsreciever.admission.time')
+    def test_halvesafterhalflife(self, mocked_time):
+        mocked_time.time.return_value = 100.0
+        average = DecayingAverage(half_life=10.0, weight=0.5)
+        average.add(8.0)
+
+        mocked_time.time.return_value = 110.0
+
+        self.assertEqual(average.value(), 2.0)
+
+    def test_empty_zero(self):
+        self.assertEqual(DecayingAverage().value(), 0.0)
+
+
+class AdmissionControlTest(TestCase):
+
+    def test_belowlimits_admitted(self):
+        admission = AdmissionControl(Limits(2, 1.0, 5.0), pool_stats=PoolStats())
+
+        self.assertIsNone(admission.admit('gw1'))
+        self.assertEqual(admission.admitted, 1)
+
+    def test_inflight_rejected(self):
+        admission = AdmissionControl(Limits(1, None, None))
+
+        self.assertIsNone(admission.admit('gw1'))
+        self.assertEqual(admission.admit('gw2'), 'in_flight')
+
+        admission.release('gw1')
+        self.assertIsNone(admission.admit('gw2'))
+        self.assertEqual(admission.rejected, 1)
+
+    def test_gatewayinflight_rejected(self):
+        admission = AdmissionControl(Limits(10, None, None), {'gw1': Limits(1, None, None)})
+
+        self.assertIsNone(admission.admit('gw1'))
+
+        self.assertEqual(admission.admit('gw1'), 'gateway_in_flight')
+        self.assertIsNone(admission.admit('gw2'))
+
+    def test_poolwait_rejected(self):
+        pool_stats = PoolStats()
+        pool_stats.record_wait(30.0)
+        admission = AdmissionControl(Limits(None, 1.0, None), pool_stats=pool_stats)
+
+        self.assertEqual(admission.admit('gw1'), 'pool_wait')
+
+    def test_latency_gatewaythreshold(self):
+        admission = AdmissionControl(Limits(None, None, 5.0), {'gw1': Limits(None, None, 0.5)})
+        admission.latency.add(10.0)
+
+        self.assertEqual(admission.admit('gw1'), 'latency')
+        self.assertIsNone(admission.admit('gw2'))
+
+    def test_release_notinflight(self):
+        admission = AdmissionControl(Limits(1, None, None))
+        admission.admit('gw1')
+
+        admission.release('gw1', 2.0)
+
+        self.assertEqual(admission.in_flight, 0)
+        self.assertEqual(admission.gateway_in_flight, {})
+        self.assertGreater(admission.latency.value(), 0.0)
+
+    def test_concurrentadmit_limited(self):
+        admission = AdmissionControl(Limits(5, None, None))
+        reasons = []
+
+        def admit():
+            reasons.append(admission.admit('gw1'))
+
+        threads = [threading.Thread(target=admit) for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(reasons.count(None), 5)
+        self.assertEqual(admission.in_flight, 5)
+
+
+class from_settingsTest(TestCase):
+
+    def test_defaults_poolcapacity(self):
+        pool = QueuePool(Mock(), pool_size=5, max_overflow=10)
+
+        admission = AdmissionControl.from_settings({}, pool)
+
+        self.assertEqual(admission.limits, Limits(15, 1.0, None))
+        self.assertEqual(admission.retry_after, 30)
+
+    def test_gateways(self):
+        settings = {
+            'admission.max_latency': '2',
+            'admission.retry_after': '60',
+            'admission.gateway.gw.example.max_in_flight': '2',
+            'admission.gateway.gw.example.max_latency': '0.5',
+            'admission.gateway.slow.max_pool_wait': '',
+        }
+
+        admission = AdmissionControl.from_settings(settings)
+
+        self.assertEqual(admission.limits, Limits(None, 1.0, 2.0))
+        self.assertEqual(admission.gateway_limits, {
+            'gw.example': Limits(2, 1.0, 0.5),
+            'slow': Limits(None, None, 2.0),
+        })
+        self.assertEqual(admission.retry_after, 60)
+
+    def test_unknownlimit(self):
+        with self.assertRaises(ValueError):
+            AdmissionControl.from_settings({'admission.gateway.gw1.max_speed': '1'})
@@ -0,0 +1,182 @@
+from datetime import datetime
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase, skipIf
+
+from mock import MagicMock
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+if pyarrow is not None:
+    from eecologysmsreciever.archive import Archive, merge_by_id
+    from eecologysmsreciever.scripts.archive import parse_args, archive_raw_messages, write_archive
+    from eecologysmsreciever.scripts.reparse import parse_args as reparse_parse_args, reparse
+
+
+def raw_row(raw_id, sent_timestamp, body=u'1608,4108,0000'):
+    return (raw_id, u'0a0b0c0d-0000-0000-0000-{0:012d}'.format(raw_id), u'+31612345678', body,
+            u'+31687654321', u'gateway', sent_timestamp)
+
+
+@skipIf(pyarrow is None, 'pyarrow not installed')
+class ArchiveTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.archive = Archive(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, month, rows, row_group_size=2):
+        writer = self.archive.writer(month, rows[0][0], row_group_size)
+        for row in rows:
+            writer.write(row)
+        entry = writer.close()
+        self.archive.add([entry])
+        return entry
+
+    def test_write_manifest(self):
+        entry = self.write('2015-06', [raw_row(1, datetime(2015, 6, 2)), raw_row(3, datetime(2015, 6, 1))])
+
+        with open(os.path.join(self.directory, 'manifest.json')) as f:
+            manifest = json.load(f)
+        self.assertEqual(manifest['files'], [entry])
+        self.assertEqual(entry['path'], os.path.join('2015-06', 'raw_message-1.parquet'))
+        self.assertEqual(entry['rows'], 2)
+        self.assertEqual((entry['first_id'], entry['last_id']), (1, 3))
+        self.assertEqual(entry['first_sent_timestamp'], '2015-06-01T00:00:00')
+        self.assertFalse(entry['deleted'])
+        self.assertTrue(self.archive.verify(entry))
+
+    def test_ids_perrowgroup(self):
+        entry = self.write('2015-06', [raw_row(i, datetime(2015, 6, 1)) for i in range(1, 6)])
+
+        self.assertEqual(list(self.archive.ids(entry)), [[1, 2], [3, 4], [5]])
+
+    def test_table(self):
+        self.write('2015-06', [raw_row(1, datetime(2015, 6, 1))])
+        self.write('2015-06', [raw_row(5, datetime(2015, 6, 2))])
+
+        table = self.archive.table('2015-06', columns=['id', 'body'])
+
+        self.assertEqual(table.to_pydict()['id'], [1, 5])
+
+    def test_raw_messages_mergedbyid(self):
+        self.write('2015-06', [raw_row(1, datetime(2015, 6, 30)), raw_row(4, datetime(2015, 6, 30))])
+        self.write('2015-07', [raw_row(2, datetime(2015, 7, 1)), raw_row(3, datetime(2015, 7, 1))])
+
+        ids = [row[0] for row in self.archive.raw_messages()]
+
+        self.assertEqual(ids, [1, 2, 3, 4])
+
+    def test_raw_messages_filters(self):
+        self.write('2015-06', [raw_row(1, datetime(2015, 6, 1)), raw_row(2, datetime(2015, 6, 20))])
+        self.write('2015-07', [raw_row(3, datetime(2015, 7, 1)), raw_row(4, datetime(2015, 7, 2))])
+
+        rows = list(self.archive.raw_messages(columns=('id',), start_id=2, end_id=3, since=datetime(2015, 6, 10)))
+
+        self.assertEqual(rows, [(2,), (3,)])
+
+    def test_remove_incomplete(self):
+        entry = self.write('2015-06', [raw_row(1, datetime(2015, 6, 1))])
+        self.archive.writer('2015-07', 7)
+        orphan = os.path.join(self.directory, '2015-06', 'raw_message-9.parquet')
+        shutil.copy(self.archive.path(entry), orphan)
+
+        removed = self.archive.remove_incomplete()
+
+        self.assertEqual(sorted(os.path.basename(path) for path in removed),
+                         ['raw_message-7.parquet.tmp', 'raw_message-9.parquet'])
+        self.assertTrue(os.path.exists(self.archive.path(entry)))
+
+
+@skipIf(pyarrow is None, 'pyarrow not installed')
+class merge_by_idTest(TestCase):
+
+    def test_it(self):
+        iterators = [iter([(1,), (5,)]), iter([]), iter([(2,), (3,)]), iter([(6,)])]
+
+        self.assertEqual(list(merge_by_id(iterators, [1, 2, 2, 6])), [(1,), (2,), (3,), (5,), (6,)])
+
+
+@skipIf(pyarrow is None, 'pyarrow not installed')
+class archive_raw_messagesTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.engine = MagicMock()
+        self.connection = self.engine.connect.return_value
+        # no foreign key from sms.message
+        self.connection.execute.return_value.first.return_value = None
+        self.connection.execute.return_value.rowcount = 2
+        result = self.connection.execution_options.return_value.execute.return_value
+        result.fetchmany.side_effect = [
+            [raw_row(1, datetime(2015, 6, 1)), raw_row(2, datetime(2015, 7, 1))],
+            [raw_row(3, datetime(2015, 6, 2))],
+            [],
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_writesanddeletes(self):
+        args = parse_args(['production.ini', '--before', '2016-01-01', '--directory', self.directory])
+
+        counts = archive_raw_messages(self.engine, args)
+
+        self.assertEqual(counts, {'archived': 3, 'files': 2, 'deleted': 4})
+        archive = Archive(self.directory)
+        self.assertEqual([entry['month'] for entry in archive.files], ['2015-06', '2015-07'])
+        self.assertEqual(archive.pending(), [])
+        delete_ids = [c[1]['ids'] for c in self.connection.execute.call_args_list if 'ids' in c[1]]
+        self.assertEqual(delete_ids, [[1, 3], [2]])
+
+    def test_keep_nodelete(self):
+        args = parse_args(['production.ini', '--before', '2016-01-01', '--directory', self.directory, '--keep'])
+
+        counts = archive_raw_messages(self.engine, args)
+
+        self.assertEqual(counts['deleted'], 0)
+        self.assertEqual(len(Archive(self.directory).pending()), 2)
+
+    def test_foreignkey_refuses(self):
+        self.connection.execute.return_value.first.return_value = (1,)
+        args = parse_args(['production.ini', '--before', '2016-01-01', '--directory', self.directory])
+
+        with self.assertRaises(SystemExit):
+            archive_raw_messages(self.engine, args)
+
+        self.assertEqual(Archive(self.directory).files, [])
+
+
+@skipIf(pyarrow is None, 'pyarrow not installed')
+class reparse_archiveTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        archive = Archive(self.directory)
+        connection = MagicMock()
+        result = connection.execution_options.return_value.execute.return_value
+        result.fetchmany.side_effect = [
+            [raw_row(1, datetime(2015, 6, 1)), raw_row(2, datetime(2015, 7, 1), u'hallo')],
+            [],
+        ]
+        write_archive(connection, archive, datetime(2016, 1, 1), 10)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_readsarchive(self):
+        engine = MagicMock()
+        args = reparse_parse_args(['production.ini', '--archive', self.directory, '--dry-run'])
+
+        counts = reparse(engine, args)
+
+        self.assertEqual(counts, {'raw_messages': 2, 'messages': 1, 'positions': 0, 'invalid': 1})
+        self.assertFalse(engine.connect.return_value.execution_options.called)
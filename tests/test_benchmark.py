@@ -0,0 +1,95 @@
+from unittest import TestCase
+
+from eecologysmsreciever.parser import parse_body
+from eecologysmsreciever.scripts.benchmark import parse_args, synthetic_messages, add_duplicates, percentile
+from eecologysmsreciever.scripts.benchmark import run, report, benchmark
+
+
+class synthetic_messagesTest(TestCase):
+
+    def test_parsable_uniquepositions(self):
+        messages = synthetic_messages(250, nr_positions=3, nr_devices=100, seed=1)
+
+        fixes = set()
+        for message in messages:
+            parsed = parse_body(message['message'])
+            self.assertEqual(len(parsed.positions), 3)
+            for fix in parsed.positions:
+                fixes.add((parsed.header.device_info_serial, fix.date_time))
+        self.assertEqual(len(fixes), 750)
+        self.assertEqual(len(set(m['message_id'] for m in messages)), 250)
+
+    def test_seed_reproducible(self):
+        self.assertEqual(synthetic_messages(5, seed=42), synthetic_messages(5, seed=42))
+
+
+class add_duplicatesTest(TestCase):
+
+    def test_ratio(self):
+        messages = synthetic_messages(1000, seed=1)
+
+        result = add_duplicates(messages, 0.2, seed=1)
+
+        self.assertEqual(len(result), 1000)
+        nr_unique = len(set(m['message_id'] for m in result))
+        self.assertTrue(750 < nr_unique < 850)
+
+    def test_noduplicates(self):
+        messages = synthetic_messages(10, seed=1)
+
+        self.assertEqual(add_duplicates(messages, 0.0), messages)
+
+
+class percentileTest(TestCase):
+
+    def test_it(self):
+        values = list(range(1, 101))
+
+        self.assertEqual(percentile(values, 0.5), 50)
+        self.assertEqual(percentile(values, 0.95), 95)
+        self.assertEqual(percentile(values, 0.99), 99)
+
+    def test_empty(self):
+        self.assertIsNone(percentile([], 0.5))
+
+
+class runTest(TestCase):
+
+    def test_outcomes(self):
+        def post(params):
+            if params == 'bad':
+                return {'success': False, 'error': 'Invalid message'}
+            if params == 'down':
+                raise IOError('connection refused')
+            return {'success': True, 'error': None}
+
+        latencies, outcomes, elapsed = run(post, ['good', 'bad', 'good', 'down'], concurrency=2)
+
+        self.assertEqual(len(latencies), 4)
+        self.assertEqual(outcomes, {'success': 2, 'Invalid message': 1, 'request error': 1})
+
+    def test_report(self):
+        summary = report([0.001, 0.002, 0.003, 0.004], {'success': 4}, 2.0, 10)
+
+        self.assertEqual(summary['requests'], 4)
+        self.assertEqual(summary['throughput'], 2.0)
+        self.assertEqual(summary['p50'], 2.0)
+        self.assertEqual(summary['statements_per_request'], 2.5)
+
+
+class benchmarkTest(TestCase):
+
+    def assertStored(self, write_path):
+        args = parse_args(['--sqlite', '--messages', '20', '--duplicate-ratio', '0.2', '--seed', '1',
+                           '--concurrency', '2', '--write-path', write_path])
+
+        summary = benchmark(args, {})
+
+        self.assertEqual(summary['outcomes'], {'success': 20})
+        self.assertGreater(summary['statements_per_request'], 0)
+
+    def test_sqlite_orm(self):
+        self.assertStored('orm')
+
+    def test_sqlite_core(self):
+        self.assertStored('core')
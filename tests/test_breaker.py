@@ -0,0 +1,124 @@
+from unittest import TestCase
+
+from mock import patch
+
+from eecologysmsreciever.breaker import CircuitBreaker, CLOSED, OPEN, HALF_OPEN
+from eecologysmsreciever.metrics import METRICS
+
+
+@patch('eecologysmsreciever.breaker.time')
+class CircuitBreakerTest(TestCase):
+
+    def breaker(self, mocked_time):
+        mocked_time.time.return_value = 100.0
+        return CircuitBreaker(failure_threshold=2, slow_call=1.0, reset_timeout=30.0)
+
+    def test_consecutivefailures_opens(self, mocked_time):
+        breaker = self.breaker(mocked_time)
+
+        breaker.record(False, 0.1)
+        self.assertEqual(breaker.state, CLOSED)
+        breaker.record(False, 0.1)
+
+        self.assertEqual(breaker.state, OPEN)
+        self.assertFalse(breaker.allow())
+        self.assertEqual(breaker.rejected, 1)
+
+    def test_success_resetsfailures(self, mocked_time):
+        breaker = self.breaker(mocked_time)
+
+        breaker.record(False, 0.1)
+        breaker.record(True, 0.1)
+        breaker.record(False, 0.1)
+
+        self.assertEqual(breaker.state, CLOSED)
+        self.assertTrue(breaker.allow())
+
+    def test_slowcall_failure(self, mocked_time):
+        breaker = self.breaker(mocked_time)
+
+        breaker.record(True, 5.0)
+        breaker.record(True, 5.0)
+
+        self.assertEqual(breaker.state, OPEN)
+
+    def test_afterresettimeout_singleprobe(self, mocked_time):
+        breaker = self.breaker(mocked_time)
+        breaker.record(False, 0.1)
+        breaker.record(False, 0.1)
+
+        mocked_time.time.return_value = 130.0
+
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, HALF_OPEN)
+        self.assertFalse(breaker.allow())
+
+    def test_probesuccess_closes(self, mocked_time):
+        breaker = self.breaker(mocked_time)
+        breaker.record(False, 0.1)
+        breaker.record(False, 0.1)
+        mocked_time.time.return_value = 130.0
+        breaker.allow()
+
+        breaker.record(True, 0.1)
+
+        self.assertEqual(breaker.state, CLOSED)
+        self.assertTrue(breaker.allow())
+
+    def test_probefailure_reopens(self, mocked_time):
+        breaker = self.breaker(mocked_time)
+        breaker.record(False, 0.1)
+        breaker.record(False, 0.1)
+        mocked_time.time.return_value = 130.0
+        breaker.allow()
+
+        breaker.record(False, 0.1)
+
+        self.assertEqual(breaker.state, OPEN)
+        self.assertEqual(breaker.retry_after(), 30)
+
+    def test_lostprobe_replaced(self, mocked_time):
+        breaker = self.breaker(mocked_time)
+        breaker.record(False, 0.1)
+        breaker.record(False, 0.1)
+        mocked_time.time.return_value = 130.0
+        breaker.allow()
+
+        mocked_time.time.return_value = 160.0
+
+        self.assertTrue(breaker.allow())
+
+    def test_retryafter_untilprobe(self, mocked_time):
+        breaker = self.breaker(mocked_time)
+        breaker.record(False, 0.1)
+        breaker.record(False, 0.1)
+
+        mocked_time.time.return_value = 119.5
+
+        self.assertEqual(breaker.retry_after(), 11)
+
+    def test_statemetric(self, mocked_time):
+        breaker = self.breaker(mocked_time)
+        breaker.record(False, 0.1)
+        breaker.record(False, 0.1)
+
+        gauges = METRICS.gauges()
+
+        self.assertEqual(gauges[('sms_circuit_breaker_state', (('state', 'open'),))], 1)
+        self.assertEqual(gauges[('sms_circuit_breaker_state', (('state', 'closed'),))], 0)
+
+
+class from_settingsTest(TestCase):
+
+    def test_defaults(self):
+        breaker = CircuitBreaker.from_settings({})
+
+        self.assertEqual(breaker.failure_threshold, 5)
+        self.assertEqual(breaker.slow_call, 10.0)
+        self.assertEqual(breaker.reset_timeout, 30.0)
+
+    def test_noslowcall(self):
+        breaker = CircuitBreaker.from_settings({'breaker.slow_call': '', 'breaker.failure_threshold': '3'})
+
+        self.assertIsNone(breaker.slow_call)
+        self.assertEqual(breaker.failure_threshold, 3)
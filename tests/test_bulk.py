@@ -0,0 +1,70 @@
+from datetime import datetime
+from unittest import TestCase, skipIf
+
+try:
+    import numpy as np
+    from eecologysmsreciever.bulk import decode_bodies
+except ImportError:
+    np = None
+
+from eecologysmsreciever.parser import parse_body
+from eecologysmsreciever.scripts.parser_benchmark import corpus
+
+
+@skipIf(np is None, 'NumPy is not installed')
+class decode_bodiesTest(TestCase):
+
+    def test_it(self):
+        bodies = [
+            u'1608,4108,0000',
+            u'1607,4099,0000,014022,031,00820202020204020200,0,722,15133,52797,49561568,523572094,15133,53335,49694351,523804057',
+            u'Meet you at the bar tonight',
+            u'1608,4108,0000,14261,45780,49842689,524984249',
+        ]
+
+        decoded = decode_bodies(bodies)
+
+        np.testing.assert_array_equal(decoded.messages.device_info_serial, [1608, 1607, -1, 1608])
+        np.testing.assert_array_almost_equal(decoded.messages.battery_voltage, [4.108, 4.099, np.nan, 4.108])
+        np.testing.assert_array_equal(decoded.invalid, [2])
+        np.testing.assert_array_equal(decoded.valid, [True, True, False, True])
+        positions = decoded.positions
+        np.testing.assert_array_equal(positions.message_index, [1, 1, 3])
+        expected_date_times = np.array(['2015-05-13T14:39:57', '2015-05-13T14:48:55', '2014-09-18T12:43:00'],
+                                       dtype='datetime64[s]')
+        np.testing.assert_array_equal(positions.date_time, expected_date_times)
+        np.testing.assert_array_almost_equal(positions.lon, [4.9561568, 4.9694351, 4.9842689])
+        np.testing.assert_array_almost_equal(positions.lat, [52.3572094, 52.3804057, 52.4984249])
+
+    def test_empty(self):
+        decoded = decode_bodies([])
+
+        self.assertEqual(len(decoded.messages.device_info_serial), 0)
+        self.assertEqual(len(decoded.positions.date_time), 0)
+
+    def test_none_invalid(self):
+        decoded = decode_bodies([None])
+
+        np.testing.assert_array_equal(decoded.invalid, [0])
+
+    def test_sameasparser(self):
+        bodies = [body for name, body in corpus(seed=2)]
+
+        decoded = decode_bodies(bodies)
+
+        index = 0
+        for i, body in enumerate(bodies):
+            try:
+                parsed = parse_body(body)
+            except (IndexError, ValueError):
+                self.assertIn(i, decoded.invalid, body)
+                continue
+            self.assertNotIn(i, decoded.invalid, body)
+            self.assertEqual(decoded.messages.device_info_serial[i], parsed.header.device_info_serial)
+            for fix in parsed.positions:
+                self.assertEqual(decoded.positions.message_index[index], i)
+                date_time = fix.date_time.replace(tzinfo=None)
+                self.assertEqual(decoded.positions.date_time[index].astype(datetime), date_time)
+                self.assertAlmostEqual(decoded.positions.lon[index], fix.lon)
+                index += 1
+        self.assertEqual(index, len(decoded.positions.message_index))
@@ -0,0 +1,142 @@
+import threading
+from unittest import TestCase
+
+from mock import Mock
+from pyramid import testing
+from pyramid.response import Response
+
+from eecologysmsreciever.bulkhead import Bulkhead, bulkheads_from_settings, bulkhead_tween_factory
+from eecologysmsreciever.positions import ClosingIterator
+
+
+class BulkheadTest(TestCase):
+
+    def test_acquire_belowconcurrency(self):
+        bulkhead = Bulkhead(2, 0, 0.1)
+
+        self.assertTrue(bulkhead.acquire())
+        self.assertTrue(bulkhead.acquire())
+        self.assertEqual(bulkhead.active, 2)
+
+    def test_acquire_queuefull_rejected(self):
+        bulkhead = Bulkhead(1, 0, 1.0)
+        bulkhead.acquire()
+
+        self.assertFalse(bulkhead.acquire())
+        self.assertEqual(bulkhead.rejected, 1)
+
+    def test_acquire_timeout_rejected(self):
+        bulkhead = Bulkhead(1, 1, 0.01)
+        bulkhead.acquire()
+
+        self.assertFalse(bulkhead.acquire())
+        self.assertEqual(bulkhead.rejected, 1)
+        self.assertEqual(bulkhead.waiting, 0)
+
+    def test_acquire_waitsforrelease(self):
+        bulkhead = Bulkhead(1, 1, 5.0)
+        bulkhead.acquire()
+        acquired = []
+        waiter = threading.Thread(target=lambda: acquired.append(bulkhead.acquire()))
+        waiter.start()
+
+        bulkhead.release()
+        waiter.join()
+
+        self.assertEqual(acquired, [True])
+        self.assertEqual(bulkhead.active, 1)
+
+    def test_statistics(self):
+        bulkhead = Bulkhead(2, 3, 1.0)
+        bulkhead.acquire()
+
+        expected = {'concurrency': 2, 'queue': 3, 'active': 1, 'waiting': 0, 'rejected': 0}
+        self.assertEqual(bulkhead.statistics(), expected)
+
+
+class bulkheads_from_settingsTest(TestCase):
+
+    def test_defaults(self):
+        bulkheads = bulkheads_from_settings({})
+
+        self.assertEqual(bulkheads['ingest'].concurrency, 4)
+        self.assertEqual(bulkheads['ingest'].queue, 1)
+        self.assertEqual(bulkheads['read'].concurrency, 2)
+        self.assertEqual(bulkheads['read'].queue, 0)
+
+    def test_settings(self):
+        settings = {
+            'bulkhead.read.concurrency': '1',
+            'bulkhead.read.queue': '0',
+            'bulkhead.read.timeout': '0.5',
+        }
+
+        bulkheads = bulkheads_from_settings(settings)
+
+        self.assertEqual(bulkheads['read'].concurrency, 1)
+        self.assertEqual(bulkheads['read'].queue, 0)
+        self.assertEqual(bulkheads['read'].timeout, 0.5)
+        self.assertEqual(bulkheads['ingest'].concurrency, 4)
+
+
+class bulkhead_tween_factoryTest(TestCase):
+
+    def setUp(self):
+        self.registry = Mock()
+        self.registry.bulkheads = {'ingest': Bulkhead(1, 0, 0.1), 'read': Bulkhead(1, 0, 0.1)}
+        self.handler = Mock(return_value='response')
+        self.tween = bulkhead_tween_factory(self.handler, self.registry)
+
+    def test_ingest(self):
+        request = testing.DummyRequest(path='/messages')
+
+        response = self.tween(request)
+
+        self.assertEqual(response, 'response')
+        self.assertEqual(self.registry.bulkheads['ingest'].active, 0)
+
+    def test_readbusy_rejected(self):
+        self.registry.bulkheads['read'].acquire()
+        request = testing.DummyRequest(path='/status')
+
+        response = self.tween(request)
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json_body, {'payload': {'success': False, 'error': 'Busy'}})
+        self.assertEqual(response.headers['Retry-After'], '1')
+        self.assertFalse(self.handler.called)
+
+    def test_readbusy_ingestserved(self):
+        self.registry.bulkheads['read'].acquire()
+        request = testing.DummyRequest(path='/messages/batch')
+
+        response = self.tween(request)
+
+        self.assertEqual(response, 'response')
+
+    def test_readbusy_readyserved(self):
+        self.registry.bulkheads['read'].acquire()
+        request = testing.DummyRequest(path='/status/ready')
+
+        response = self.tween(request)
+
+        self.assertEqual(response, 'response')
+
+    def test_handlererror_released(self):
+        self.handler.side_effect = ValueError()
+        request = testing.DummyRequest(path='/messages')
+
+        with self.assertRaises(ValueError):
+            self.tween(request)
+
+        self.assertEqual(self.registry.bulkheads['ingest'].active, 0)
+
+    def test_streamed_releasedonclose(self):
+        self.handler.return_value = Response(app_iter=ClosingIterator([b'[]']))
+        request = testing.DummyRequest(path='/positions')
+
+        response = self.tween(request)
+
+        self.assertEqual(self.registry.bulkheads['read'].active, 1)
+        response.app_iter.close()
+        self.assertEqual(self.registry.bulkheads['read'].active, 0)
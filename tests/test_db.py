@@ -0,0 +1,172 @@
+from unittest import TestCase
+from mock import Mock, call, patch
+from sqlalchemy import exc
+from sqlalchemy.pool import QueuePool
+
+from eecologysmsreciever.db import engine_from_settings, warm_up, pool_statistics, set_utc, ping, check_pid
+from eecologysmsreciever.db import read_settings
+from eecologysmsreciever.db import TimedQueuePool
+
+
+class engine_from_settingsTest(TestCase):
+
+    def test_postgresql_timedpool(self):
+        settings = {
+            'sqlalchemy.url': 'postgresql://localhost/eecology',
+            'sqlalchemy.pool_size': '3',
+            'sqlalchemy.max_overflow': '2',
+        }
+
+        engine = engine_from_settings(settings)
+
+        self.assertIsInstance(engine.pool, TimedQueuePool)
+        self.assertEqual(engine.pool.size(), 3)
+        self.assertEqual(engine.pool._max_overflow, 2)
+
+    def test_sqlite_defaultpool(self):
+        engine = engine_from_settings({'sqlalchemy.url': 'sqlite://'})
+
+        self.assertNotIsInstance(engine.pool, TimedQueuePool)
+
+    def test_prepare_listensonconnect(self):
+        settings = {
+            'sqlalchemy.url': 'postgresql://localhost/eecology',
+            'db.prepare': 'true',
+        }
+
+        engine = engine_from_settings(settings)
+        unprepared = engine_from_settings({'sqlalchemy.url': 'postgresql://localhost/eecology'})
+
+        self.assertEqual(len(engine.pool.dispatch.connect), len(unprepared.pool.dispatch.connect) + 1)
+
+    def test_prepingsqlite(self):
+        engine = engine_from_settings({'sqlalchemy.url': 'sqlite://', 'db.pre_ping': 'true'})
+
+        self.assertEqual(engine.execute('SELECT 2').scalar(), 2)
+
+
+class check_pidTest(TestCase):
+
+    def test_otherprocess_disconnectionerror(self):
+        connection_record = Mock()
+        connection_record.info = {'pid': -1}
+        connection_proxy = Mock()
+
+        with self.assertRaises(exc.DisconnectionError):
+            check_pid(Mock(), connection_record, connection_proxy)
+
+        # socket is not closed, parent process still uses it
+        self.assertIsNone(connection_record.connection)
+        self.assertIsNone(connection_proxy.connection)
+
+    def test_afterfork_newconnection(self):
+        engine = engine_from_settings({'sqlalchemy.url': 'sqlite://'})
+        parent_connection = engine.connect()
+        parent_dbapi_connection = parent_connection.connection.connection
+        parent_connection.close()
+
+        with patch('eecologysmsreciever.db.os.getpid', return_value=-1):
+            child_connection = engine.connect()
+
+        self.assertIsNot(child_connection.connection.connection, parent_dbapi_connection)
+
+
+class set_utcTest(TestCase):
+
+    def test_committed(self):
+        dbapi_connection = Mock()
+
+        set_utc(dbapi_connection, None)
+
+        dbapi_connection.cursor.return_value.execute.assert_called_once_with("SET TIME ZONE 'UTC'")
+        dbapi_connection.commit.assert_called_once_with()
+
+
+class pingTest(TestCase):
+
+    def test_stale_disconnectionerror(self):
+        dbapi_connection = Mock()
+        dbapi_connection.cursor.return_value.execute.side_effect = Exception('server closed the connection')
+
+        with self.assertRaises(exc.DisconnectionError):
+            ping(dbapi_connection, None, None)
+
+
+class warm_upTest(TestCase):
+
+    def test_opensandcloses(self):
+        engine = Mock()
+
+        nr = warm_up(engine, 3)
+
+        self.assertEqual(nr, 3)
+        self.assertEqual(engine.connect.return_value.close.call_count, 3)
+
+    def test_atmostpoolsize(self):
+        engine = Mock()
+        engine.pool = QueuePool(Mock(), pool_size=2, max_overflow=10)
+
+        self.assertEqual(warm_up(engine, 5), 2)
+
+    def test_dbdown_nocrash(self):
+        engine = Mock()
+        engine.connect.side_effect = exc.OperationalError('SELECT 1', {}, Exception('down'))
+
+        self.assertEqual(warm_up(engine, 3), 0)
+
+
+class read_settingsTest(TestCase):
+
+    def test_postgresql_smallpool(self):
+        settings = {
+            'sqlalchemy.url': 'postgresql://localhost/eecology',
+            'sqlalchemy.pool_size': '10',
+            'db.pre_ping': 'true',
+        }
+
+        engine = engine_from_settings(read_settings(settings))
+
+        self.assertEqual(engine.pool.size(), 2)
+        self.assertEqual(engine.pool._max_overflow, 2)
+        self.assertEqual(engine.pool._timeout, 5)
+        self.assertEqual(settings['sqlalchemy.pool_size'], '10')
+
+    def test_overrides(self):
+        settings = {
+            'sqlalchemy.url': 'postgresql://localhost/eecology',
+            'read.sqlalchemy.url': 'postgresql://reader@localhost/eecology',
+            'read.sqlalchemy.pool_size': '1',
+            'read.db.prepare': 'true',
+        }
+
+        result = read_settings(settings)
+
+        self.assertEqual(result['sqlalchemy.url'], 'postgresql://reader@localhost/eecology')
+        self.assertEqual(result['sqlalchemy.pool_size'], '1')
+        self.assertEqual(result['sqlalchemy.max_overflow'], '2')
+        self.assertEqual(result['db.prepare'], 'true')
+
+    def test_sqlite_nopoolsize(self):
+        result = read_settings({'sqlalchemy.url': 'sqlite://'})
+
+        self.assertNotIn('sqlalchemy.pool_size', result)
+
+
+class pool_statisticsTest(TestCase):
+
+    def test_it(self):
+        connections = []
+        pool = TimedQueuePool(lambda: Mock(), pool_size=2, max_overflow=2)
+        connections.append(pool.connect())
+
+        stats = pool_statistics(pool)
+
+        self.assertEqual(stats['size'], 2)
+        self.assertEqual(stats['checked_out'], 1)
+        self.assertEqual(stats['saturation'], 0.25)
+        self.assertEqual(stats['checkouts'], 1)
+        self.assertGreaterEqual(stats['wait_max'], 0.0)
+        self.assertGreaterEqual(stats['wait_recent'], 0.0)
+
+    def test_nonqueuepool_empty(self):
+        self.assertEqual(pool_statistics(Mock()), {})
@@ -0,0 +1,77 @@
+from datetime import datetime
+import gzip
+import io
+import json
+from unittest import TestCase
+
+from mock import Mock
+from sqlalchemy.dialects import postgresql
+from webob.multidict import MultiDict
+
+from eecologysmsreciever.export import Export
+
+
+def gunzip(chunks):
+    return gzip.GzipFile(fileobj=io.BytesIO(b''.join(chunks))).read().decode('utf-8')
+
+
+class ExportTest(TestCase):
+
+    def test_from_params(self):
+        params = MultiDict([('device_info_serial', '1608,1609'),
+                            ('device_info_serial', '1610'),
+                            ('start', '2015-06-01'),
+                            ('end', '2015-09-01'),
+                            ('message', 'true'),
+                            ])
+
+        export = Export.from_params(params)
+
+        self.assertEqual(export.device_info_serials, [1608, 1609, 1610])
+        self.assertEqual(export.start, datetime(2015, 6, 1))
+        self.assertEqual(export.end, datetime(2015, 9, 1))
+        self.assertTrue(export.message)
+        self.assertEqual(export.filename, 'positions-20150601.csv.gz')
+
+    def test_from_params_nodevices(self):
+        with self.assertRaises(ValueError):
+            Export.from_params(MultiDict([('start', '2015-06-01')]))
+
+    def test_from_params_toomanydevices(self):
+        params = MultiDict([('device_info_serial', ','.join(str(i) for i in range(1000))), ('start', '2015-06-01')])
+
+        with self.assertRaises(ValueError):
+            Export.from_params(params)
+
+    def test_select_message(self):
+        export = Export([1608, 1609], datetime(2015, 6, 1), message=True)
+
+        sql = str(export.select().compile(dialect=postgresql.dialect()))
+
+        self.assertIn('sms.message.battery_voltage', sql)
+        self.assertIn('sms.message.id = sms.position.id', sql)
+        self.assertIn('ORDER BY sms.position.device_info_serial, sms.position.date_time', sql)
+
+    def test_stream_csv(self):
+        export = Export([1608], datetime(2015, 6, 1), message=True)
+        result = Mock()
+        result.fetchmany.side_effect = [[(1608, datetime(2015, 6, 1, 10), 4.1, 52.2, 3.9, 12.5)], []]
+
+        body = gunzip(export.stream(result))
+
+        expected = ('device_info_serial,date_time,lon,lat,battery_voltage,memory_usage\n'
+                    '1608,2015-06-01T10:00:00,4.1,52.2,3.9,12.5\n')
+        self.assertEqual(body, expected)
+
+    def test_stream_geojson(self):
+        export = Export([1608], datetime(2015, 6, 1), format='geojson')
+        result = Mock()
+        result.fetchmany.side_effect = [[(1608, datetime(2015, 6, 1, 10), 4.1, 52.2)],
+                                        [(1608, datetime(2015, 6, 1, 11), 4.2, 52.3)],
+                                        []]
+
+        body = json.loads(gunzip(export.stream(result)))
+
+        self.assertEqual(len(body['features']), 2)
+        self.assertEqual(body['features'][1]['geometry'], {'type': 'Point', 'coordinates': [4.2, 52.3]})
+        self.assertEqual(body['features'][1]['properties']['date_time'], '2015-06-01T11:00:00')
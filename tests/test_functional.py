@@ -10,9 +10,16 @@ from webtest import TestApp, AppError
 from eecologysmsreciever import main, DBSession
 
 
+def smswriter_grants():
+    """GRANT statements of the smswriter user in the comments of sms.sql"""
+    with open('sms.sql') as f:
+        return ''.join(line[3:] for line in f if line.startswith('-- GRANT '))
+
+
 @attr('functional')
 class TestFunctional(object):
     db_root_url = ''
+    extra_settings = {}
 
     def setupDb(self):
         self.db_root_url = os.environ['DB_URL']
@@ -23,17 +30,9 @@ class TestFunctional(object):
         cursor.execute(open('sms.sql').read())
         connection.commit()
 
-        # Create sms user
-        cursor.execute('''
-        CREATE USER smswriter WITH LOGIN PASSWORD 'smspw';
-        GRANT USAGE ON SCHEMA sms TO smswriter;
-        GRANT INSERT ON sms.raw_message TO smswriter;
-        GRANT SELECT (id) ON sms.raw_message TO smswriter;
-        GRANT SELECT (date_time) ON sms.position TO smswriter;
-        GRANT INSERT ON sms.message TO smswriter;
-        GRANT INSERT ON sms.position TO smswriter;
-        GRANT USAGE on SEQUENCE sms.raw_message_id_seq TO smswriter;
-        ''')
+        # Create sms user with only the grants documented in sms.sql
+        cursor.execute("CREATE USER smswriter WITH LOGIN PASSWORD 'smspw'")
+        cursor.execute(smswriter_grants())
         connection.commit()
 
         connection.close()
@@ -59,6 +58,7 @@ class TestFunctional(object):
             'secret_key': 'supersecretkey',
             'alert_too_old': '26',
         }
+        self.settings.update(self.extra_settings)
         app = main({}, **self.settings)
         self.testapp = TestApp(app)
         self.connection = create_engine(self.db_root_url).raw_connection()
@@ -139,6 +139,27 @@ class TestFunctional(object):
         expected_positions = []
         self.expected_sms(expected_raw_messages, expected_messages, expected_positions)
 
+    def test_batch(self):
+        message = {
+            'from': u'1234567890',
+            'message': u'1607,4099,0000,014022,031,00820202020204020200,0,722',
+            'message_id': u'7ba817ec-0c78-41cd-be10-7907ff787d39',
+            'sent_to': u'0987654321',
+            'device_id': u'a gateway id',
+            'sent_timestamp': u'1424873155000'
+        }
+        # second message is a resend of the first
+        params = [('secret', u'supersecretkey')] + sorted(message.items()) + sorted(message.items())
+        response = self.testapp.post('/messages/batch', params)
+
+        results = response.json['payload']['results']
+        eq_(results, [{'success': True, 'error': None, 'message_id': u'7ba817ec-0c78-41cd-be10-7907ff787d39'}] * 2)
+        # assert rows inserted
+        expected_raw_messages = [(1, '7ba817ec-0c78-41cd-be10-7907ff787d39', u'1234567890', u'1607,4099,0000,014022,031,00820202020204020200,0,722', u'0987654321', u'a gateway id', datetime.datetime(2015, 2, 25, 14, 5, 55))]
+        expected_messages = [(1, 1607, datetime.datetime(2015, 2, 25, 14, 5, 55), 4.099, 0.0, u'014022,031,00820202020204020200,0,722')]
+        expected_positions = []
+        self.expected_sms(expected_raw_messages, expected_messages, expected_positions)
+
     def test_status_empty_toooldalert(self):
         with assert_raises(AppError) as ex:
             self.testapp.get('/status')
@@ -162,3 +183,19 @@ class TestFunctional(object):
         response = self.testapp.get('/status')
 
         eq_(response.status_int, 200)
+
+    def test_ready(self):
+        response = self.testapp.get('/status/ready')
+
+        eq_(response.json['ready'], True)
+        assert 'warm_up' in response.json['startup']['phases']
+
+
+@attr('functional')
+class TestFunctionalCoreWritePath(TestFunctional):
+    extra_settings = {'write_path': 'core'}
+
+
+@attr('functional')
+class TestFunctionalPreparedStatements(TestFunctional):
+    extra_settings = {'write_path': 'core', 'db.prepare': 'true'}
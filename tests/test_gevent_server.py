@@ -0,0 +1,51 @@
+from unittest import TestCase, skipIf
+from mock import patch, Mock
+
+try:
+    import gevent
+except ImportError:
+    gevent = None
+
+from eecologysmsreciever.scripts.gevent_server import parse_listen, remove_session, make_server
+
+
+class parse_listenTest(TestCase):
+
+    def test_hostport(self):
+        self.assertEqual(parse_listen('127.0.0.1:6566'), ('127.0.0.1', 6566))
+
+    def test_portonly(self):
+        self.assertEqual(parse_listen(':6566'), ('0.0.0.0', 6566))
+
+
+class remove_sessionTest(TestCase):
+
+    @patch('eecologysmsreciever.scripts.gevent_server.ReadSession')
+    @patch('eecologysmsreciever.scripts.gevent_server.DBSession')
+    def test_removed(self, mocked_DBSession, mocked_ReadSession):
+        app = Mock(return_value=['body'])
+
+        response = remove_session(app)({}, None)
+
+        self.assertEqual(response, ['body'])
+        mocked_DBSession.remove.assert_called_once_with()
+        mocked_ReadSession.remove.assert_called_once_with()
+
+    @patch('eecologysmsreciever.scripts.gevent_server.DBSession')
+    def test_error_removed(self, mocked_DBSession):
+        app = Mock(side_effect=ValueError())
+
+        with self.assertRaises(ValueError):
+            remove_session(app)({}, None)
+
+        mocked_DBSession.remove.assert_called_once_with()
+
+
+@skipIf(gevent is None, 'gevent not installed')
+class make_serverTest(TestCase):
+
+    def test_it(self):
+        server = make_server(Mock(), '127.0.0.1:6566', max_connections=50)
+
+        self.assertEqual(server.address, ('127.0.0.1', 6566))
+        self.assertEqual(server.pool.size, 50)
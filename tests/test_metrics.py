@@ -0,0 +1,159 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+from unittest import TestCase
+
+from eecologysmsreciever.metrics import Metrics
+
+
+class MetricsTest(TestCase):
+
+    def setUp(self):
+        self.metrics = Metrics()
+        self.metrics.counter('sms_messages_total', 'Messages')
+        self.metrics.histogram('sms_stage_seconds', 'Stages', (0.1, 1.0))
+
+    def test_inc(self):
+        self.metrics.inc('sms_messages_total', outcome='success')
+        self.metrics.inc('sms_messages_total', outcome='success')
+        self.metrics.inc('sms_messages_total', outcome='invalid')
+
+        counters, histograms = self.metrics.collect()
+
+        expected = {
+            ('sms_messages_total', (('outcome', 'success'),)): 2,
+            ('sms_messages_total', (('outcome', 'invalid'),)): 1,
+        }
+        self.assertEqual(counters, expected)
+
+    def test_collect_sumsthreads(self):
+        def record():
+            for _ in range(100):
+                self.metrics.inc('sms_messages_total', outcome='success')
+        threads = [threading.Thread(target=record) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        counters, histograms = self.metrics.collect()
+
+        self.assertEqual(counters[('sms_messages_total', (('outcome', 'success'),))], 400)
+
+    def test_render(self):
+        self.metrics.inc('sms_messages_total', outcome='success')
+        self.metrics.observe('sms_stage_seconds', 0.05, stage='parse')
+        self.metrics.observe('sms_stage_seconds', 0.5, stage='parse')
+        self.metrics.observe('sms_stage_seconds', 5, stage='parse')
+
+        text = self.metrics.render()
+
+        expected = u'''# HELP sms_messages_total Messages
+# TYPE sms_messages_total counter
+sms_messages_total{outcome="success"} 1
+# HELP sms_stage_seconds Stages
+# TYPE sms_stage_seconds histogram
+sms_stage_seconds_bucket{stage="parse",le="0.1"} 1
+sms_stage_seconds_bucket{stage="parse",le="1.0"} 2
+sms_stage_seconds_bucket{stage="parse",le="+Inf"} 3
+sms_stage_seconds_sum{stage="parse"} 5.55
+sms_stage_seconds_count{stage="parse"} 3
+'''
+        self.assertEqual(text, expected)
+
+    def test_render_escapeslabels(self):
+        self.metrics.inc('sms_messages_total', gateway_id=u'a "gateway"')
+
+        text = self.metrics.render()
+
+        self.assertIn(u'sms_messages_total{gateway_id="a \\"gateway\\""} 1', text)
+
+    def test_gauge_lastvalue(self):
+        self.metrics.gauge('sms_circuit_breaker_state', 'State')
+        self.metrics.set('sms_circuit_breaker_state', 1, state='open')
+        self.metrics.set('sms_circuit_breaker_state', 0, state='open')
+
+        text = self.metrics.render()
+
+        self.assertIn('# TYPE sms_circuit_breaker_state gauge\nsms_circuit_breaker_state{state="open"} 0\n', text)
+
+    def test_time(self):
+        with self.metrics.time('sms_stage_seconds', stage='parse'):
+            pass
+
+        counters, histograms = self.metrics.collect()
+
+        self.assertEqual(histograms[('sms_stage_seconds', (('stage', 'parse'),))][0], 1)
+
+
+class SharedMetricsTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.metrics = Metrics()
+        self.metrics.counter('sms_messages_total', 'Messages')
+        self.metrics.histogram('sms_stage_seconds', 'Stages', (0.1, 1.0))
+        self.metrics.directory = self.directory
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_other_worker(self):
+        snapshot = {
+            'counters': [['sms_messages_total', [['outcome', 'success']], 2]],
+            'histograms': [['sms_stage_seconds', [['stage', 'parse']], [1, 0, 0, 0.05]]],
+        }
+        with open(os.path.join(self.directory, 'metrics-1.json'), 'w') as f:
+            json.dump(snapshot, f)
+
+    def test_dump(self):
+        self.metrics.inc('sms_messages_total', outcome='success')
+
+        self.metrics.dump()
+
+        with open(self.metrics.snapshot_path()) as f:
+            snapshot = json.load(f)
+        self.assertEqual(snapshot['counters'], [['sms_messages_total', [['outcome', 'success']], 1]])
+
+    def test_collect_shared_sumsworkers(self):
+        self.write_other_worker()
+        self.metrics.inc('sms_messages_total', outcome='success')
+        self.metrics.observe('sms_stage_seconds', 0.5, stage='parse')
+
+        counters, histograms = self.metrics.collect_shared()
+
+        self.assertEqual(counters[('sms_messages_total', (('outcome', 'success'),))], 3)
+        self.assertEqual(histograms[('sms_stage_seconds', (('stage', 'parse'),))], [1, 1, 0, 0.55])
+
+    def test_collect_shared_skipscorrupt(self):
+        with open(os.path.join(self.directory, 'metrics-1.json'), 'w') as f:
+            f.write('{')
+        self.metrics.inc('sms_messages_total', outcome='success')
+
+        counters, histograms = self.metrics.collect_shared()
+
+        self.assertEqual(counters[('sms_messages_total', (('outcome', 'success'),))], 1)
+
+    def test_collect_shared_gauges_runningworkers(self):
+        self.metrics.gauge('sms_circuit_breaker_state', 'State')
+        self.metrics.set('sms_circuit_breaker_state', 1, state='open')
+        snapshot = {'counters': [], 'histograms': [],
+                    'gauges': [['sms_circuit_breaker_state', [['state', 'open']], 1]]}
+        # pid 1 is always running, a pid above pid_max never is
+        for pid in (1, 999999999):
+            with open(self.metrics.snapshot_path(pid), 'w') as f:
+                json.dump(snapshot, f)
+        self.metrics.dump()
+
+        gauges = self.metrics.collect_shared_gauges()
+
+        self.assertEqual(gauges, {('sms_circuit_breaker_state', (('state', 'open'),)): 2})
+
+    def test_render_shared(self):
+        self.write_other_worker()
+
+        text = self.metrics.render()
+
+        self.assertIn('sms_messages_total{outcome="success"} 2', text)
@@ -0,0 +1,62 @@
+import ast
+import glob
+import os
+from unittest import TestCase
+
+VERSIONS = os.path.join(os.path.dirname(__file__), '..', 'alembic', 'versions')
+
+
+def load_revisions():
+    """Revision identifiers of each migration by revision, read without importing alembic"""
+    revisions = {}
+    for path in glob.glob(os.path.join(VERSIONS, '*.py')):
+        with open(path) as f:
+            tree = ast.parse(f.read())
+        identifiers = {}
+        for node in tree.body:
+            if isinstance(node, ast.Assign) and isinstance(node.targets[0], ast.Name):
+                identifiers[node.targets[0].id] = ast.literal_eval(node.value)
+        revisions[identifiers['revision']] = identifiers
+    return revisions
+
+
+def ancestors(revisions, revision):
+    result = []
+    down_revision = revisions[revision]['down_revision']
+    while down_revision is not None:
+        result.append(down_revision)
+        down_revision = revisions[down_revision]['down_revision']
+    return result
+
+
+class MigrationsTest(TestCase):
+
+    def setUp(self):
+        self.revisions = load_revisions()
+
+    def test_mainline_withoutgeneratedlocation(self):
+        for revision in self.revisions:
+            if revision == '7d3e5f1a2c84':
+                continue
+            self.assertNotIn('7d3e5f1a2c84', ancestors(self.revisions, revision), revision)
+
+    def test_archive_onmainline(self):
+        self.assertEqual(ancestors(self.revisions, 'c4e8a1f2b3d5'), ['9b2f4c6d8e1a', '340b921f3d41'])
+
+    def test_archive_withoutpartitioning(self):
+        self.assertNotIn('4a1c6e2d9b7f', ancestors(self.revisions, 'c4e8a1f2b3d5'))
+
+    def test_devicelatest_withoutpartitioning(self):
+        self.assertEqual(ancestors(self.revisions, '9b2f4c6d8e1a'), ['340b921f3d41'])
+
+    def test_mainline_withoutpartitioning(self):
+        for revision in self.revisions:
+            if revision in ('4a1c6e2d9b7f', '7d3e5f1a2c84'):
+                continue
+            self.assertNotIn('4a1c6e2d9b7f', ancestors(self.revisions, revision), revision)
+
+    def test_partitioning_branch(self):
+        self.assertEqual(self.revisions['4a1c6e2d9b7f']['branch_labels'], ('partitioning',))
+
+    def test_generatedlocation_branch(self):
+        self.assertEqual(self.revisions['7d3e5f1a2c84']['branch_labels'], ('generated_location',))
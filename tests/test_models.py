@@ -4,8 +4,11 @@ from unittest import TestCase
 from pyramid import testing
 from pyramid.exceptions import Forbidden
 from pytz import utc
-from eecologysmsreciever.models import RawMessage, Message
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session
+from eecologysmsreciever.models import RawMessage, Message, Position
 from eecologysmsreciever.models import dump_ddl
+from eecologysmsreciever.parser import parse_body
 
 
 class RawMessageTest(TestCase):
@@ -49,6 +52,27 @@ class RawMessageTest(TestCase):
 
         self.assertEqual(e.exception.message, 'Invalid secret')
 
+    def test_from_params(self):
+        del self.body['secret']
+
+        message = RawMessage.from_params(self.body)
+
+        self.assertEqual(message.message_id, uuid.UUID('7ba817ec-0c78-41cd-be10-7907ff787d39'))
+        self.assertEqual(message.gateway_id, 'a gateway id')
+        self.assertEqual(message.sent_timestamp, datetime(2015, 2, 25, 14, 5, 55))
+
+    def test_to_params(self):
+        del self.body['secret']
+        message = RawMessage.from_params(self.body)
+
+        self.assertEqual(message.to_params(), self.body)
+
+    def test_from_params_missingfield_KeyError(self):
+        del self.body['sent_to']
+
+        with self.assertRaises(KeyError):
+            RawMessage.from_params(self.body)
+
 
 class MessageTest(TestCase):
 
@@ -250,6 +274,64 @@ class MessageTest(TestCase):
         self.assertIsNone(message.debug_info)
         self.assertEqual(len(message.positions), 0)
 
+    def test_fromBody_serverlocation(self):
+        body = u'1608,4108,0000,14261,45780,49842689,524984249'
+
+        message = Message.from_body(body, 'server')
+
+        location = message.positions[0].location
+        self.assertEqual(str(location), 'ST_SetSRID(ST_MakePoint(:param_1, :param_2), :param_3)')
+        self.assertEqual(location.compile().params, {'param_1': 4.9842689, 'param_2': 52.4984249, 'param_3': 4326})
+
+    def test_fromBody_databaselocation(self):
+        body = u'1608,4108,0000,14261,45780,49842689,524984249'
+
+        message = Message.from_body(body, 'database')
+
+        self.assertIsNone(message.positions[0].location)
+        self.assertEqual(message.positions[0].lon, 4.9842689)
+
+
+class PositionInsertTest(TestCase):
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        self.connection = self.engine.connect()
+        self.connection.execute("ATTACH DATABASE ':memory:' AS sms")
+        self.connection.execute('CREATE TABLE sms.position '
+                                '(id INTEGER, device_info_serial INTEGER, date_time DATETIME, '
+                                'lon FLOAT, lat FLOAT, location TEXT, PRIMARY KEY (id, date_time))')
+        # stand-in of the PostGIS function
+        self.connection.connection.create_function('GeomFromEWKT', 1, lambda value: value)
+        self.statements = []
+        event.listen(self.connection, 'before_cursor_execute', self.record)
+
+    def tearDown(self):
+        self.connection.close()
+
+    def record(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    def insert(self, location):
+        parsed = parse_body(u'1608,4108,0000,14261,45780,49842689,524984249')
+        position = Position.from_fix(1608, parsed.positions[0], location)
+        position.id = 1
+        session = Session(bind=self.connection)
+        session.add(position)
+        session.flush()
+        return [statement for statement in self.statements if statement.startswith('INSERT')][0]
+
+    def test_databaselocation_leftout(self):
+        statement = self.insert('database')
+
+        self.assertNotIn('location', statement)
+        self.assertIn('lat', statement)
+
+    def test_ewktlocation_sent(self):
+        statement = self.insert('ewkt')
+
+        self.assertIn('location', statement)
+
 
 class DumpDDLTest(TestCase):
     def test_it(self):
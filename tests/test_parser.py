@@ -0,0 +1,79 @@
+from datetime import datetime
+from unittest import TestCase
+from pytz import utc
+
+from eecologysmsreciever.parser import parse_body, day_start, Header, Debug, Fix
+
+
+class parse_bodyTest(TestCase):
+
+    def test_nodebugnogps(self):
+        parsed = parse_body(u'1608,4108,0000')
+
+        self.assertEqual(parsed.header, Header(1608, 4.108, 0.0))
+        self.assertIsNone(parsed.debug)
+        self.assertIsNone(parsed.debug_info)
+        self.assertEqual(parsed.positions, ())
+
+    def test_debugnogps(self):
+        parsed = parse_body(u'1608,4108,0000,014023,019,00820202020204020200,3,842')
+
+        self.assertEqual(parsed.debug, Debug(u'014023', u'019', u'00820202020204020200', u'3', u'842'))
+        self.assertEqual(parsed.debug_info, u'014023,019,00820202020204020200,3,842')
+        self.assertEqual(parsed.positions, ())
+
+    def test_nogpsyet(self):
+        parsed = parse_body(u'1608,4108,0000,014023,019,00820202020204020200,3,842,,,,')
+
+        self.assertEqual(parsed.positions, ())
+
+    def test_debug2gps(self):
+        parsed = parse_body(u'1608,4108,0000,014023,019,00820202020204020200,3,842,14261,45780,49842689,524984249,15133,53335,49694351,523804057')
+
+        expected = (
+            Fix(datetime(2014, 9, 18, 12, 43, tzinfo=utc), 4.9842689, 52.4984249),
+            Fix(datetime(2015, 5, 13, 14, 48, 55, tzinfo=utc), 4.9694351, 52.3804057),
+        )
+        self.assertEqual(parsed.positions, expected)
+
+    def test_gpsnodebug(self):
+        parsed = parse_body(u'1608,4108,0000,14261,45780,49842689,524984249')
+
+        self.assertIsNone(parsed.debug)
+        self.assertEqual(parsed.positions, (Fix(datetime(2014, 9, 18, 12, 43, tzinfo=utc), 4.9842689, 52.4984249),))
+
+    def test_incompletedebug_IndexError(self):
+        with self.assertRaises(IndexError):
+            parse_body(u'1608,4108,0000,10101719,25,00820202020')
+
+    def test_noheader_IndexError(self):
+        with self.assertRaises(IndexError):
+            parse_body(u'1608')
+
+    def test_text_ValueError(self):
+        with self.assertRaises(ValueError):
+            parse_body(u'Meet you at the bar tonight')
+
+    def test_badtime_ValueError(self):
+        with self.assertRaises(ValueError):
+            parse_body(u'1608,4108,0000,14261,noon,49842689,524984249')
+
+    def test_timeoutofrange_ValueError(self):
+        with self.assertRaises(ValueError):
+            parse_body(u'1608,4108,0000,14261,99999999999999,49842689,524984249')
+
+
+class day_startTest(TestCase):
+
+    def test_firstday(self):
+        self.assertEqual(day_start(u'15001'), datetime(2015, 1, 1, tzinfo=utc))
+
+    def test_leapyear(self):
+        self.assertEqual(day_start(u'16366'), datetime(2016, 12, 31, tzinfo=utc))
+
+    def test_cached(self):
+        self.assertIs(day_start(u'14261'), day_start(u'14261'))
+
+    def test_baddate_ValueError(self):
+        with self.assertRaises(ValueError):
+            day_start(u'1')
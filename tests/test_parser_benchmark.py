@@ -0,0 +1,69 @@
+from datetime import datetime
+from unittest import TestCase
+from mock import patch
+
+from eecologysmsreciever.models import RawMessage
+from eecologysmsreciever.parser import parse_body
+from eecologysmsreciever.scripts.parser_benchmark import body_shapes, malformed_bodies, corpus, check_corpus
+from eecologysmsreciever.scripts.parser_benchmark import TARGETS, bodies_per_second, main
+from eecologysmsreciever.views import store_raw_message, store_raw_message_core
+
+
+class corpusTest(TestCase):
+
+    def test_shapes_valid(self):
+        for name, body in body_shapes():
+            parsed = parse_body(body)
+            if name.startswith('positions_'):
+                self.assertEqual(len(parsed.positions), int(name.split('_')[1]))
+
+    def test_malformed_invalid(self):
+        nr_valid, nr_invalid, unexpected = check_corpus(malformed_bodies())
+
+        self.assertEqual(nr_valid, 0)
+        self.assertEqual(unexpected, [])
+
+    def test_fuzz_onlyindexorvalueerror(self):
+        for target, parse in TARGETS.items():
+            nr_valid, nr_invalid, unexpected = check_corpus(corpus(seed=1), parse)
+
+            self.assertEqual(unexpected, [], target)
+            self.assertGreater(nr_invalid, 0)
+
+    def test_corpus_reproducible(self):
+        self.assertEqual(corpus(seed=3), corpus(seed=3))
+
+
+class invalid_messageTest(TestCase):
+
+    def raw_message(self, body):
+        raw_message = RawMessage()
+        raw_message.message_id = '7ba817ec-0c78-41cd-be10-7907ff787d39'
+        raw_message.body = body
+        raw_message.sent_timestamp = datetime(2015, 2, 25, 14, 5, 55)
+        return raw_message
+
+    @patch('eecologysmsreciever.views.DBSession')
+    def test_orm_invalidmessage(self, mocked_DBSession):
+        for name, body in malformed_bodies():
+            result = store_raw_message(self.raw_message(body))
+
+            self.assertEqual(result, {'success': False, 'error': 'Invalid message'}, name)
+
+    @patch('eecologysmsreciever.views.store_message')
+    @patch('eecologysmsreciever.views.DBSession')
+    def test_core_invalidmessage(self, mocked_DBSession, mocked_store_message):
+        mocked_store_message.return_value = 1
+        for name, body in malformed_bodies():
+            result = store_raw_message_core(self.raw_message(body))
+
+            self.assertEqual(result, {'success': False, 'error': 'Invalid message'}, name)
+
+
+class benchmarkTest(TestCase):
+
+    def test_bodies_per_second(self):
+        self.assertGreater(bodies_per_second(parse_body, body_shapes()[0][1], 10), 0)
+
+    def test_main_corpusonly(self):
+        self.assertEqual(main(['--corpus-only']), 0)
@@ -0,0 +1,79 @@
+from datetime import date
+from unittest import TestCase
+from mock import MagicMock, Mock
+
+from eecologysmsreciever.scripts.partitions import add_months, partition_name, partition_month, plan
+from eecologysmsreciever.scripts.partitions import create_partition
+
+
+class add_monthsTest(TestCase):
+
+    def test_nextyear(self):
+        self.assertEqual(add_months(date(2015, 11, 1), 3), date(2016, 2, 1))
+
+    def test_previousyear(self):
+        self.assertEqual(add_months(date(2015, 2, 1), -3), date(2014, 11, 1))
+
+
+class partition_nameTest(TestCase):
+
+    def test_roundtrip(self):
+        self.assertEqual(partition_name(date(2015, 5, 1)), 'position_y2015m05')
+        self.assertEqual(partition_month('position_y2015m05'), date(2015, 5, 1))
+
+    def test_default_notmonthly(self):
+        self.assertIsNone(partition_month('position_default'))
+
+
+class planTest(TestCase):
+
+    def test_createsmissingfuturemonths(self):
+        partitions = ['position_default', 'position_y2015m05', 'position_y2015m06']
+
+        to_create, to_detach = plan(partitions, date(2015, 6, 18), 2)
+
+        self.assertEqual(to_create, [date(2015, 7, 1), date(2015, 8, 1)])
+        self.assertEqual(to_detach, [])
+
+    def test_detachesoldmonths(self):
+        partitions = ['position_default', 'position_y2015m01', 'position_y2015m02', 'position_y2015m03', 'position_y2015m04']
+
+        to_create, to_detach = plan(partitions, date(2015, 4, 18), 0, retention_months=2)
+
+        self.assertEqual(to_create, [])
+        self.assertEqual(to_detach, ['position_y2015m01'])
+
+
+class create_partitionTest(TestCase):
+
+    def test_emptydefault_createsonly(self):
+        connection = Mock()
+        connection.execute.return_value.scalar.return_value = None
+
+        create_partition(connection, date(2015, 5, 1))
+
+        self.assertEqual(connection.execute.call_count, 2)
+        self.assertIn('CREATE TABLE sms.position_y2015m05 PARTITION OF sms.position', str(connection.execute.call_args[0][0]))
+
+    def test_rowsindefault_moved(self):
+        connection = MagicMock()
+        connection.execute.return_value.scalar.return_value = 1
+
+        create_partition(connection, date(2015, 5, 1))
+
+        statements = [str(c[0][0]) for c in connection.execute.call_args_list]
+        self.assertIn('DETACH PARTITION sms.position_default', statements[2])
+        expected = 'INSERT INTO sms.position_y2015m05 (id, device_info_serial, date_time, lon, lat, location) SELECT'
+        self.assertIn(expected, statements[4])
+        self.assertIn('ATTACH PARTITION sms.position_default DEFAULT', statements[6])
+
+    def test_generatedlocation_notcopied(self):
+        connection = MagicMock()
+        connection.execute.return_value.scalar.return_value = 1
+        connection.execute.return_value.__iter__.return_value = iter([('location',)])
+
+        create_partition(connection, date(2015, 5, 1))
+
+        statements = [str(c[0][0]) for c in connection.execute.call_args_list]
+        expected = 'INSERT INTO sms.position_y2015m05 (id, device_info_serial, date_time, lon, lat) SELECT'
+        self.assertIn(expected, statements[4])
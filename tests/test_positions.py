@@ -0,0 +1,143 @@
+from collections import namedtuple
+from datetime import datetime
+import json
+from unittest import TestCase
+
+from mock import Mock
+from sqlalchemy.dialects import postgresql
+
+from eecologysmsreciever.positions import PositionsQuery, ClosingIterator, parse_date_time, encode_cursor, decode_cursor
+
+Row = namedtuple('Row', ['id', 'device_info_serial', 'date_time', 'lon', 'lat'])
+
+
+class PositionsQueryTest(TestCase):
+
+    def test_from_params(self):
+        params = {
+            'device_info_serial': '1608',
+            'start': '2015-06-01T00:00:00Z',
+            'end': '2015-06-02',
+            'after': '2015-06-01T10:00:00_3',
+            'limit': '10',
+            'format': 'geojson',
+        }
+
+        query = PositionsQuery.from_params(params)
+
+        self.assertEqual(query.device_info_serial, 1608)
+        self.assertEqual(query.start, datetime(2015, 6, 1))
+        self.assertEqual(query.end, datetime(2015, 6, 2))
+        self.assertEqual(query.after, (datetime(2015, 6, 1, 10), 3))
+        self.assertEqual(query.limit, 10)
+        self.assertEqual(query.content_type, 'application/geo+json')
+
+    def test_from_params_missingstart(self):
+        with self.assertRaises(ValueError):
+            PositionsQuery.from_params({'device_info_serial': '1608'})
+
+    def test_from_params_limittoobig(self):
+        with self.assertRaises(ValueError):
+            PositionsQuery.from_params({'device_info_serial': '1608', 'start': '2015-06-01', 'limit': '100000'})
+
+    def test_from_params_badformat(self):
+        with self.assertRaises(ValueError):
+            PositionsQuery.from_params({'device_info_serial': '1608', 'start': '2015-06-01', 'format': 'xml'})
+
+    def test_rows_keyset(self):
+        query = PositionsQuery(1608, datetime(2015, 6, 1), after=(datetime(2015, 6, 1, 10), 3), limit=2)
+
+        sql = str(query.rows().compile(dialect=postgresql.dialect()))
+
+        self.assertIn('(sms.position.date_time, sms.position.id) > (%(param_1)s, %(param_2)s)', sql)
+        self.assertIn('ORDER BY sms.position.date_time, sms.position.id', sql)
+        self.assertNotIn('OFFSET', sql)
+
+    def test_etag_changeswithpage(self):
+        query = PositionsQuery(1608, datetime(2015, 6, 1))
+
+        etag = query.etag(2, datetime(2015, 6, 1, 10), 3)
+
+        self.assertEqual(etag, query.etag(2, datetime(2015, 6, 1, 10), 3))
+        self.assertNotEqual(etag, query.etag(3, datetime(2015, 6, 1, 11), 4))
+
+    def test_stream_fullpage_hasnext(self):
+        query = PositionsQuery(1608, datetime(2015, 6, 1), limit=2)
+        rows = [Row(1, 1608, datetime(2015, 6, 1, 10), 4.1, 52.2), Row(2, 1608, datetime(2015, 6, 1, 11), 4.2, 52.3)]
+        result = Mock()
+        result.fetchmany.side_effect = [rows, []]
+
+        body = json.loads(b''.join(query.stream(result)).decode('utf-8'))
+
+        expected = {
+            'positions': [
+                {'id': 1, 'device_info_serial': 1608, 'date_time': '2015-06-01T10:00:00', 'lon': 4.1, 'lat': 52.2},
+                {'id': 2, 'device_info_serial': 1608, 'date_time': '2015-06-01T11:00:00', 'lon': 4.2, 'lat': 52.3},
+            ],
+            'next': '2015-06-01T11:00:00_2',
+        }
+        self.assertEqual(body, expected)
+
+    def test_stream_geojson_partialpage_nonext(self):
+        query = PositionsQuery(1608, datetime(2015, 6, 1), limit=2, format='geojson')
+        result = Mock()
+        result.fetchmany.side_effect = [[Row(1, 1608, datetime(2015, 6, 1, 10), 4.1, 52.2)], []]
+
+        body = json.loads(b''.join(query.stream(result)).decode('utf-8'))
+
+        self.assertEqual(body['type'], 'FeatureCollection')
+        self.assertEqual(body['features'][0]['geometry'], {'type': 'Point', 'coordinates': [4.1, 52.2]})
+        self.assertIsNone(body['next'])
+
+
+class ClosingIteratorTest(TestCase):
+
+    def test_iterated_closed(self):
+        callback = Mock()
+        body = ClosingIterator(iter([b'a', b'b']), callback)
+
+        self.assertEqual(list(body), [b'a', b'b'])
+        body.close()
+
+        callback.assert_called_once_with()
+
+    def test_neveriterated_closed(self):
+        callback = Mock()
+        chunks = (chunk for chunk in [b'a'])
+
+        ClosingIterator(chunks, callback).close()
+
+        callback.assert_called_once_with()
+
+    def test_closedtwice_calledonce(self):
+        callback = Mock()
+        body = ClosingIterator([b'a'], callback)
+
+        body.close()
+        body.close()
+
+        callback.assert_called_once_with()
+
+
+class parse_date_timeTest(TestCase):
+
+    def test_formats(self):
+        self.assertEqual(parse_date_time('2015-06-01T12:30:00Z'), datetime(2015, 6, 1, 12, 30))
+        self.assertEqual(parse_date_time('2015-06-01T12:30:00'), datetime(2015, 6, 1, 12, 30))
+        self.assertEqual(parse_date_time('2015-06-01'), datetime(2015, 6, 1))
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            parse_date_time('yesterday')
+
+
+class cursorTest(TestCase):
+
+    def test_roundtrip(self):
+        key = (datetime(2015, 6, 1, 12, 30), 42)
+
+        self.assertEqual(decode_cursor(encode_cursor(key)), key)
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            decode_cursor('2015-06-01_x')
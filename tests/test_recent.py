@@ -0,0 +1,45 @@
+from unittest import TestCase
+from mock import patch
+
+from eecologysmsreciever.recent import RecentlySeen
+
+
+class RecentlySeenTest(TestCase):
+
+    def test_unknownkey_miss(self):
+        recent = RecentlySeen()
+
+        self.assertFalse(recent.seen('a'))
+        self.assertEqual(recent.misses, 1)
+
+    def test_addedkey_hit(self):
+        recent = RecentlySeen()
+
+        recent.add('a')
+
+        self.assertTrue(recent.seen('a'))
+        self.assertEqual(recent.hits, 1)
+
+    def test_full_evictsleastrecentlyused(self):
+        recent = RecentlySeen(size=2)
+        recent.add('a')
+        recent.add('b')
+        recent.seen('a')
+
+        recent.add('c')
+
+        self.assertEqual(len(recent), 2)
+        self.assertTrue(recent.seen('a'))
+        self.assertFalse(recent.seen('b'))
+        self.assertTrue(recent.seen('c'))
+
+    @patch('eecologysmsreciever.recent.time')
+    def test_expiredkey_miss(self, mocked_time):
+        recent = RecentlySeen(ttl=60)
+        mocked_time.time.return_value = 1000
+        recent.add('a')
+
+        mocked_time.time.return_value = 1061
+
+        self.assertFalse(recent.seen('a'))
+        self.assertEqual(len(recent), 0)
@@ -0,0 +1,174 @@
+from datetime import datetime
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from mock import MagicMock, patch
+
+from eecologysmsreciever.scripts.reparse import parse_args, apply_settings, select_statement, reparse_chunk, reparse
+from eecologysmsreciever.scripts.reparse import read_checkpoint, write_checkpoint
+
+
+class parse_argsTest(TestCase):
+
+    def test_defaults(self):
+        args = parse_args(['production.ini'])
+
+        self.assertEqual(args.config_uri, 'production.ini')
+        self.assertEqual(args.start_id, 1)
+        self.assertEqual(args.chunk_size, 1000)
+        self.assertFalse(args.dry_run)
+
+    def test_range(self):
+        args = parse_args(['production.ini', '--since', '2015-02-25', '--until', '2015-03-01T12:00:00'])
+
+        self.assertEqual(args.since, datetime(2015, 2, 25))
+        self.assertEqual(args.until, datetime(2015, 3, 1, 12))
+
+    def test_location_fromsettings(self):
+        args = parse_args(['production.ini'])
+
+        apply_settings(args, {'location': 'database'})
+
+        self.assertEqual(args.location, 'database')
+
+    def test_location_nosetting_ewkt(self):
+        args = parse_args(['production.ini'])
+
+        apply_settings(args, {})
+
+        self.assertEqual(args.location, 'ewkt')
+
+    def test_location_overwritessetting(self):
+        args = parse_args(['production.ini', '--location', 'server'])
+
+        apply_settings(args, {'location': 'database'})
+
+        self.assertEqual(args.location, 'server')
+
+
+class select_statementTest(TestCase):
+
+    def test_nofilters(self):
+        statement, params = select_statement(parse_args(['production.ini']))
+
+        self.assertIn('ORDER BY id', str(statement))
+        self.assertEqual(params, {'start_id': 1})
+
+    def test_filters(self):
+        args = parse_args(['production.ini', '--end-id', '10', '--since', '2015-02-25'])
+
+        statement, params = select_statement(args)
+
+        self.assertIn('AND id <= :end_id AND sent_timestamp >= :since', str(statement))
+        self.assertEqual(params, {'start_id': 1, 'end_id': 10, 'since': datetime(2015, 2, 25)})
+
+
+class reparse_chunkTest(TestCase):
+
+    def test_it(self):
+        sent = datetime(2015, 2, 25, 14, 5, 55)
+        rows = [
+            (1, u'1607,4099,0000,014022,031,00820202020204020200,0,722,15133,52797,49561568,523572094', sent),
+            (2, u'hallo', sent),
+            (3, None, sent),
+            (4, u'1608,4108,0000', sent),
+        ]
+
+        messages, positions, invalid = reparse_chunk(rows)
+
+        expected_messages = [
+            (1, 1607, sent, 4.099, 0.0, u'014022,031,00820202020204020200,0,722'),
+            (4, 1608, sent, 4.108, 0.0, None),
+        ]
+        self.assertEqual(messages, expected_messages)
+        expected_positions = [
+            (1, 1607, datetime(2015, 5, 13, 14, 39, 57), 4.9561568, 52.3572094, 'SRID=4326;POINT(4.9561568 52.3572094)'),
+        ]
+        self.assertEqual(positions, expected_positions)
+        self.assertEqual(invalid, [2, 3])
+
+    def test_serverlocation(self):
+        sent = datetime(2015, 2, 25, 14, 5, 55)
+        rows = [(1, u'1607,4099,0000,15133,52797,49561568,523572094', sent)]
+
+        messages, positions, invalid = reparse_chunk(rows, 'server')
+
+        self.assertEqual(positions, [(1, 1607, datetime(2015, 5, 13, 14, 39, 57), 4.9561568, 52.3572094, 4.9561568, 52.3572094)])
+
+    def test_databaselocation(self):
+        sent = datetime(2015, 2, 25, 14, 5, 55)
+        rows = [(1, u'1607,4099,0000,15133,52797,49561568,523572094', sent)]
+
+        messages, positions, invalid = reparse_chunk(rows, 'database')
+
+        self.assertEqual(positions, [(1, 1607, datetime(2015, 5, 13, 14, 39, 57), 4.9561568, 52.3572094)])
+
+
+class CheckpointTest(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'reparse.checkpoint')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_nocheckpoint(self):
+        self.assertIsNone(read_checkpoint(self.path))
+        self.assertIsNone(read_checkpoint(None))
+
+    def test_roundtrip(self):
+        write_checkpoint(self.path, 1234)
+
+        self.assertEqual(read_checkpoint(self.path), 1234)
+
+
+class reparseTest(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.checkpoint = os.path.join(self.tmpdir, 'reparse.checkpoint')
+        self.engine = MagicMock()
+        self.connection = self.engine.connect.return_value
+        result = self.connection.execution_options.return_value.execute.return_value
+        sent = datetime(2015, 2, 25, 14, 5, 55)
+        result.fetchmany.side_effect = [
+            [(5, u'1608,4108,0000', sent), (6, u'hallo', sent)],
+            [(7, u'1608,4108,0000,14261,45780,49842689,524984249', sent)],
+            [],
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    @patch('eecologysmsreciever.scripts.reparse.write_chunk')
+    def test_writesChunksAndCheckpoints(self, mocked_write_chunk):
+        args = parse_args(['production.ini', '--chunk-size', '2', '--checkpoint', self.checkpoint])
+
+        counts = reparse(self.engine, args)
+
+        self.assertEqual(counts, {'raw_messages': 3, 'messages': 2, 'positions': 1, 'invalid': 1})
+        self.assertEqual(mocked_write_chunk.call_count, 2)
+        self.assertEqual(mocked_write_chunk.call_args_list[0][0][1], [5, 6])
+        self.assertEqual(read_checkpoint(self.checkpoint), 7)
+
+    @patch('eecologysmsreciever.scripts.reparse.write_chunk')
+    def test_dryrun_writesNothing(self, mocked_write_chunk):
+        args = parse_args(['production.ini', '--dry-run', '--checkpoint', self.checkpoint])
+
+        counts = reparse(self.engine, args)
+
+        self.assertEqual(counts['raw_messages'], 3)
+        self.assertFalse(mocked_write_chunk.called)
+        self.assertIsNone(read_checkpoint(self.checkpoint))
+
+    @patch('eecologysmsreciever.scripts.reparse.write_chunk')
+    def test_resumesFromCheckpoint(self, mocked_write_chunk):
+        write_checkpoint(self.checkpoint, 4)
+        args = parse_args(['production.ini', '--checkpoint', self.checkpoint])
+
+        reparse(self.engine, args)
+
+        execute = self.connection.execution_options.return_value.execute
+        self.assertEqual(execute.call_args[1], {'start_id': 5})
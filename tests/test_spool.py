@@ -0,0 +1,277 @@
+from datetime import datetime
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from mock import MagicMock, patch
+from sqlalchemy.exc import DataError
+
+from eecologysmsreciever.breaker import CircuitBreaker, OPEN
+from eecologysmsreciever.metrics import METRICS
+from eecologysmsreciever.spool import Spool, SpoolDrainer
+from eecologysmsreciever.watermark import Watermark
+
+
+def sms(message_id=u'7ba817ec-0c78-41cd-be10-7907ff787d39', message=u'1607,4099,0000'):
+    return {
+        'from': u'1234567890',
+        'message': message,
+        'message_id': message_id,
+        'sent_to': u'0987654321',
+        'device_id': u'a gateway id',
+        'sent_timestamp': u'1424873155000'
+    }
+
+
+class SpoolTest(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'spool.ndjson')
+        self.spool = Spool(self.path)
+
+    def tearDown(self):
+        self.spool.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_append_read(self):
+        self.spool.append(sms())
+
+        records, offset = self.spool.read(10)
+
+        self.assertEqual(records, [sms()])
+        self.assertEqual(offset, os.path.getsize(self.path))
+
+    def test_read_maxrecords(self):
+        self.spool.append(sms())
+        self.spool.append(sms(u'8ba817ec-0c78-41cd-be10-7907ff787d39'))
+
+        records, offset = self.spool.read(1)
+
+        self.assertEqual(records, [sms()])
+
+    def test_commit_survivesrestart(self):
+        self.spool.append(sms())
+        self.spool.append(sms(u'8ba817ec-0c78-41cd-be10-7907ff787d39'))
+        records, offset = self.spool.read(1)
+        self.spool.commit(offset)
+        self.spool.close()
+
+        self.spool = Spool(self.path)
+        records, offset = self.spool.read(10)
+
+        self.assertEqual(records, [sms(u'8ba817ec-0c78-41cd-be10-7907ff787d39')])
+
+    def test_usedbyotherprocess_ioerror(self):
+        with self.assertRaises(IOError):
+            Spool(self.path)
+
+    def test_partialline_removedonrestart(self):
+        self.spool.append(sms())
+        self.spool.close()
+        with open(self.path, 'ab') as f:
+            f.write(b'{"message_id": "8ba8')
+
+        self.spool = Spool(self.path)
+        self.spool.append(sms(u'9ba817ec-0c78-41cd-be10-7907ff787d39'))
+        records, offset = self.spool.read(10)
+
+        self.assertEqual(records, [sms(), sms(u'9ba817ec-0c78-41cd-be10-7907ff787d39')])
+
+    def test_commit_fullydrained_compacts(self):
+        self.spool.compact_size = 0
+        self.spool.append(sms())
+        records, offset = self.spool.read(10)
+
+        self.spool.commit(offset)
+
+        self.assertEqual(os.path.getsize(self.path), 0)
+        self.assertEqual(self.spool.offset, 0)
+        self.spool.append(sms(u'8ba817ec-0c78-41cd-be10-7907ff787d39'))
+        records, offset = self.spool.read(10)
+        self.assertEqual(records, [sms(u'8ba817ec-0c78-41cd-be10-7907ff787d39')])
+
+    def test_commit_notfullydrained_keepsspool(self):
+        self.spool.compact_size = 0
+        self.spool.append(sms())
+        records, offset = self.spool.read(10)
+        self.spool.append(sms(u'8ba817ec-0c78-41cd-be10-7907ff787d39'))
+
+        self.spool.commit(offset)
+
+        self.assertEqual(self.spool.offset, offset)
+        records, offset = self.spool.read(10)
+        self.assertEqual(records, [sms(u'8ba817ec-0c78-41cd-be10-7907ff787d39')])
+
+    def test_commit_duringsync_keepsspool(self):
+        self.spool.compact_size = 0
+        self.spool.append(sms())
+        records, offset = self.spool.read(10)
+        self.spool._syncing = True
+
+        self.spool.commit(offset)
+
+        self.assertEqual(self.spool.offset, offset)
+        self.assertEqual(os.path.getsize(self.path), offset)
+
+    @patch('eecologysmsreciever.spool.os.fsync')
+    def test_sync_aftercompaction_returns(self, mocked_fsync):
+        self.spool.compact_size = 0
+        self.spool.append(sms())
+        generation = self.spool._generation
+        end = self.spool._written
+        records, offset = self.spool.read(10)
+        self.spool.commit(offset)
+        mocked_fsync.reset_mock()
+
+        # appender which wrote the drained record before the compaction
+        self.spool._sync(end, generation)
+
+        self.assertFalse(mocked_fsync.called)
+        self.assertEqual(self.spool._synced, 0)
+
+
+class SpoolDrainerTest(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.spool = Spool(os.path.join(self.tmpdir, 'spool.ndjson'))
+        self.engine = MagicMock()
+        self.drainer = SpoolDrainer(self.spool, self.engine, batch_size=2)
+
+    def tearDown(self):
+        self.spool.close()
+        shutil.rmtree(self.tmpdir)
+
+    @patch('eecologysmsreciever.spool.store_message')
+    def test_drain_batch(self, mocked_store_message):
+        self.spool.append(sms())
+        self.spool.append(sms(u'8ba817ec-0c78-41cd-be10-7907ff787d39', u'hallo'))
+        self.spool.append(sms(u'9ba817ec-0c78-41cd-be10-7907ff787d39'))
+
+        drained = self.drainer.drain_batch()
+
+        self.assertEqual(drained, 2)
+        self.assertEqual(mocked_store_message.call_count, 2)
+        connection = self.engine.begin.return_value.__enter__.return_value
+        args = mocked_store_message.call_args_list
+        self.assertEqual(args[0][0][0], connection)
+        self.assertEqual(args[0][0][2].header.device_info_serial, 1607)
+        # unparsable body is stored as raw message only
+        self.assertIsNone(args[1][0][2])
+        self.assertEqual(self.spool.read(10)[0], [sms(u'9ba817ec-0c78-41cd-be10-7907ff787d39')])
+
+    @patch('eecologysmsreciever.spool.store_message')
+    def test_drain_batch_dberror_keepsoffset(self, mocked_store_message):
+        mocked_store_message.side_effect = Exception('db down')
+        self.spool.append(sms())
+
+        with self.assertRaises(Exception):
+            self.drainer.drain_batch()
+
+        self.assertEqual(self.spool.offset, 0)
+
+    @patch('eecologysmsreciever.spool.store_message')
+    def test_drain_batch_poisonrecord_skipped(self, mocked_store_message):
+        self.drainer.batch_size = 3
+        mocked_store_message.side_effect = [None, DataError('INSERT', {}, Exception('out of range')), None]
+        self.spool.append(sms())
+        self.spool.append(sms(u'8ba817ec-0c78-41cd-be10-7907ff787d39'))
+        self.spool.append(sms(u'9ba817ec-0c78-41cd-be10-7907ff787d39'))
+
+        drained = self.drainer.drain_batch()
+
+        self.assertEqual(drained, 3)
+        self.assertEqual(mocked_store_message.call_count, 3)
+        connection = self.engine.begin.return_value.__enter__.return_value
+        self.assertEqual(connection.begin_nested.call_count, 3)
+        self.assertEqual(self.spool.read(10)[0], [])
+
+    @patch('eecologysmsreciever.spool.store_message')
+    def test_drain_batch_raiseswatermark(self, mocked_store_message):
+        self.drainer.watermark = Watermark()
+        self.spool.append(sms(message=u'1607,4099,0000,15133,52797,49561568,523572094,15133,53335,49694351,523804057'))
+
+        self.drainer.drain_batch()
+
+        self.assertEqual(self.drainer.watermark.get(), datetime(2015, 5, 13, 14, 48, 55))
+
+    def test_drain_batch_empty(self):
+        self.assertEqual(self.drainer.drain_batch(), 0)
+        self.assertFalse(self.engine.begin.called)
+
+    @patch('eecologysmsreciever.spool.store_message')
+    def test_drain_guarded_dberror_opensbreaker(self, mocked_store_message):
+        mocked_store_message.side_effect = Exception('db down')
+        self.drainer.breaker = CircuitBreaker(failure_threshold=1)
+        self.spool.append(sms())
+
+        drained = self.drainer.drain_guarded()
+
+        self.assertEqual(drained, 0)
+        self.assertEqual(self.drainer.breaker.state, OPEN)
+        self.assertEqual(self.spool.offset, 0)
+
+    def test_drain_guarded_empty_leavesbreaker(self):
+        self.drainer.breaker = MagicMock()
+
+        drained = self.drainer.drain_guarded()
+
+        self.assertEqual(drained, 0)
+        self.assertFalse(self.drainer.breaker.allow.called)
+        self.assertFalse(self.drainer.breaker.record.called)
+        self.assertFalse(self.engine.begin.called)
+
+    @patch('eecologysmsreciever.spool.store_message')
+    def test_drain_guarded_breakeropen_keepsoffset(self, mocked_store_message):
+        self.drainer.breaker = MagicMock()
+        self.drainer.breaker.allow.return_value = False
+        self.spool.append(sms())
+
+        drained = self.drainer.drain_guarded()
+
+        self.assertEqual(drained, 0)
+        self.assertFalse(mocked_store_message.called)
+        self.assertFalse(self.drainer.breaker.record.called)
+        self.assertEqual(self.spool.offset, 0)
+
+    @patch('eecologysmsreciever.spool.store_message')
+    def test_drain_guarded_recordssuccessaftercommit(self, mocked_store_message):
+        self.drainer.breaker = MagicMock()
+        self.spool.append(sms())
+
+        drained = self.drainer.drain_guarded()
+
+        self.assertEqual(drained, 1)
+        self.assertEqual(self.drainer.breaker.record.call_count, 1)
+        self.assertTrue(self.drainer.breaker.record.call_args[0][0])
+        self.assertEqual(self.spool.read(10)[0], [])
+
+    @patch('eecologysmsreciever.spool.store_message')
+    def test_drain_guarded_repeatedfailures_failing(self, mocked_store_message):
+        mocked_store_message.side_effect = Exception('permission denied for table raw_message')
+        self.drainer.max_failures = 2
+        self.spool.append(sms())
+
+        self.drainer.drain_guarded()
+        self.assertFalse(self.drainer.failing)
+        self.drainer.drain_guarded()
+
+        self.assertTrue(self.drainer.failing)
+        stats = self.drainer.statistics()
+        self.assertEqual(stats['consecutive_failures'], 2)
+        self.assertEqual(stats['last_error'], 'permission denied for table raw_message')
+        self.assertGreater(stats['pending_bytes'], 0)
+        gauges = METRICS.gauges()
+        self.assertEqual(gauges[('sms_spool_drain_consecutive_failures', ())], 2)
+
+    @patch('eecologysmsreciever.spool.store_message')
+    def test_drain_guarded_success_notfailing(self, mocked_store_message):
+        self.drainer.max_failures = 1
+        self.drainer.failures = 1
+        self.spool.append(sms())
+
+        self.drainer.drain_guarded()
+
+        self.assertFalse(self.drainer.failing)
+        self.assertEqual(self.drainer.statistics()['pending_bytes'], 0)
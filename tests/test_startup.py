@@ -0,0 +1,60 @@
+from unittest import TestCase
+
+from mock import patch
+
+from eecologysmsreciever import main
+from eecologysmsreciever.startup import Startup
+
+
+class StartupTest(TestCase):
+
+    @patch('eecologysmsreciever.startup.time')
+    def test_phases(self, mocked_time):
+        startup = Startup(100.0, 100.5)
+        mocked_time.time.side_effect = [101.0, 101.25, 102.0]
+
+        with startup.phase('warm_up'):
+            pass
+        startup.mark_ready()
+
+        self.assertTrue(startup.ready)
+        self.assertEqual(startup.statistics(), {'seconds': 2.0, 'phases': {'import': 0.5, 'warm_up': 0.25}})
+
+    def test_notready(self):
+        startup = Startup(100.0, 100.5)
+
+        self.assertFalse(startup.ready)
+
+
+class mainTest(TestCase):
+
+    def test_ready(self):
+        app = main({}, **{'sqlalchemy.url': 'sqlite://', 'secret_key': 'supersecretkey', 'alert_too_old': '26'})
+
+        startup = app.registry.startup
+        self.assertTrue(startup.ready)
+        self.assertEqual([name for name, _ in startup.phases], ['import', 'configure', 'warm_up', 'scan'])
+
+    def test_admission_offbydefault(self):
+        app = main({}, **{'sqlalchemy.url': 'sqlite://', 'secret_key': 'supersecretkey', 'alert_too_old': '26'})
+
+        self.assertIsNone(getattr(app.registry, 'admission', None))
+
+    def test_admission_enabled(self):
+        app = main({}, **{'sqlalchemy.url': 'sqlite://', 'secret_key': 'supersecretkey', 'alert_too_old': '26',
+                          'admission.enabled': 'true'})
+
+        self.assertIsNotNone(app.registry.admission)
+
+    def test_breakerandrecent_offbydefault(self):
+        app = main({}, **{'sqlalchemy.url': 'sqlite://', 'secret_key': 'supersecretkey', 'alert_too_old': '26'})
+
+        self.assertIsNone(getattr(app.registry, 'breaker', None))
+        self.assertIsNone(getattr(app.registry, 'recent_messages', None))
+
+    def test_breakerandrecent_enabled(self):
+        app = main({}, **{'sqlalchemy.url': 'sqlite://', 'secret_key': 'supersecretkey', 'alert_too_old': '26',
+                          'breaker.enabled': 'true', 'recent.size': '100'})
+
+        self.assertIsNotNone(app.registry.breaker)
+        self.assertIsNotNone(app.registry.recent_messages)
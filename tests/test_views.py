@@ -1,15 +1,26 @@
+import json
+import os
 from datetime import datetime
 from unittest import TestCase
-from mock import patch, DEFAULT, call
-from pyramid.httpexceptions import HTTPServerError
+from mock import patch, DEFAULT, call, Mock
+from pyramid.httpexceptions import HTTPBadRequest, HTTPNotFound, HTTPNotModified, HTTPServerError, HTTPServiceUnavailable
 from pytz import utc
 
 from pyramid import testing
+from pyramid.request import Request
 from nose.tools import eq_
-from sqlalchemy.exc import DBAPIError, IntegrityError
+from sqlalchemy.exc import DBAPIError, IntegrityError, ResourceClosedError
 from sqlalchemy.orm.exc import NoResultFound
+from eecologysmsreciever.admission import AdmissionControl, Limits
+from eecologysmsreciever.breaker import CircuitBreaker, OPEN
+from eecologysmsreciever.bulkhead import Bulkhead
 from eecologysmsreciever.models import DBSession, Position
-from eecologysmsreciever.views import recieve_message, status
+from eecologysmsreciever.metrics import METRICS
+from eecologysmsreciever.recent import RecentlySeen
+from eecologysmsreciever.views import recieve_message, recieve_messages, status, pool_status, metrics, device_status
+from eecologysmsreciever.views import positions, export, ready
+from eecologysmsreciever.startup import Startup
+from eecologysmsreciever.watermark import Watermark
 
 
 class recieve_messageTest(TestCase):
@@ -34,12 +45,13 @@ class recieve_messageTest(TestCase):
         testing.tearDown()
 
     @patch('eecologysmsreciever.views.DBSession')
-    def test_sets_timezone2utc(self, mocked_DBSession):
+    def test_timezone_notsetperrequest(self, mocked_DBSession):
+        # time zone is set once per connection, see eecologysmsreciever.db.set_utc
         request = testing.DummyRequest(post=self.body)
 
         recieve_message(request)
 
-        mocked_DBSession.execute.assert_called_once_with("SET TIME ZONE 'UTC'")
+        self.assertFalse(mocked_DBSession.execute.called)
 
     @patch('eecologysmsreciever.views.DBSession')
     def test_returnsSuccess(self, mocked_DBSession):
@@ -61,6 +73,19 @@ class recieve_messageTest(TestCase):
         assert mocked_DBSession.begin_nested.times_called(3)
         # TODO assert what add() was called with
 
+    @patch('eecologysmsreciever.views.upsert_device_latest')
+    @patch('eecologysmsreciever.views.DBSession')
+    def test_devicelatest_upserted(self, mocked_DBSession, mocked_upsert):
+        self.config.registry.settings['devices.latest'] = True
+        request = testing.DummyRequest(post=self.body)
+
+        recieve_message(request)
+
+        args = mocked_upsert.call_args[0]
+        self.assertIs(args[0], mocked_DBSession)
+        self.assertEqual(args[2].device_info_serial, 1607)
+        self.assertEqual(len(args[3]), 3)
+
     @patch('eecologysmsreciever.views.DBSession')
     def test_badSecret_returnsUnsuccess(self, mocked_DBSession):
         self.body['secret'] = 'the wrong secret'
@@ -154,11 +179,530 @@ class recieve_messageTest(TestCase):
         self.assertEquals(response, expected)
 
 
+class recieve_messageCoreWritePathTest(TestCase):
+
+    def setUp(self):
+        self.settings = {
+            'secret_key': 'supersecretkey',
+            'write_path': 'core',
+        }
+        self.config = testing.setUp(settings=self.settings)
+        self.body = {
+            'from': u'1234567890',
+            'message': u'1607,4099,0000,014022,031,00820202020204020200,0,722,15133,52797,49561568,523572094,15133,53335,49694351,523804057,15133,53161,49624783,523701953',
+            'message_id': u'7ba817ec-0c78-41cd-be10-7907ff787d39',
+            'sent_to': u'0987654321',
+            'secret': u'supersecretkey',
+            'device_id': u'a gateway id',
+            'sent_timestamp': u'1424873155000'
+        }
+
+    def tearDown(self):
+        DBSession.remove()
+        testing.tearDown()
+
+    @patch('eecologysmsreciever.views.DBSession')
+    def test_returnsSuccess(self, mocked_DBSession):
+        request = testing.DummyRequest(post=self.body)
+
+        response = recieve_message(request)
+
+        expected = {'payload': {'success': True, 'error': None}}
+        self.assertEquals(response, expected)
+        mocked_DBSession.commit.assert_called_once_with()
+        self.assertFalse(mocked_DBSession.execute.called)
+        self.assertFalse(mocked_DBSession.begin_nested.called)
+
+    @patch('eecologysmsreciever.views.DBSession')
+    def test_insertsInOneTransaction(self, mocked_DBSession):
+        request = testing.DummyRequest(post=self.body)
+
+        recieve_message(request)
+
+        connection = mocked_DBSession.connection.return_value
+        self.assertEqual(connection.execute.call_count, 3)
+        mocked_DBSession.commit.assert_called_once_with()
+
+    @patch('eecologysmsreciever.views.DBSession')
+    def test_rawmessagealreadyexists_returnsSuccess(self, mocked_DBSession):
+        connection = mocked_DBSession.connection.return_value
+        connection.execute.return_value.scalar.return_value = None
+        request = testing.DummyRequest(post=self.body)
+
+        response = recieve_message(request)
+
+        expected = {'payload': {'success': True, 'error': None}}
+        self.assertEquals(response, expected)
+        self.assertEqual(connection.execute.call_count, 1)
+
+    @patch('eecologysmsreciever.views.DBSession')
+    def test_badText_storesRawAndReturnsUnsuccess(self, mocked_DBSession):
+        self.body['message'] = u'hallo'
+        request = testing.DummyRequest(post=self.body)
+
+        response = recieve_message(request)
+
+        expected = {'payload': {'success': False, 'error': 'Invalid message'}}
+        self.assertEquals(response, expected)
+        connection = mocked_DBSession.connection.return_value
+        self.assertEqual(connection.execute.call_count, 1)
+        mocked_DBSession.commit.assert_called_once_with()
+
+    @patch('eecologysmsreciever.views.DBSession')
+    def test_dbError_returnsUnsuccess(self, mocked_DBSession):
+        connection = mocked_DBSession.connection.return_value
+        connection.execute.side_effect = DBAPIError(1, 2, 3, 4)
+        request = testing.DummyRequest(post=self.body)
+
+        response = recieve_message(request)
+
+        expected = {'payload': {'success': False, 'error': 'Database error'}}
+        self.assertEquals(response, expected)
+        mocked_DBSession.rollback.assert_called_once_with()
+
+
+class recieve_messageSpoolTest(TestCase):
+
+    def setUp(self):
+        self.settings = {
+            'secret_key': 'supersecretkey',
+        }
+        self.config = testing.setUp(settings=self.settings)
+        self.spool = Mock()
+        self.config.registry.spool = self.spool
+        self.body = {
+            'from': u'1234567890',
+            'message': u'1607,4099,0000,014022,031,00820202020204020200,0,722,15133,52797,49561568,523572094',
+            'message_id': u'7ba817ec-0c78-41cd-be10-7907ff787d39',
+            'sent_to': u'0987654321',
+            'secret': u'supersecretkey',
+            'device_id': u'a gateway id',
+            'sent_timestamp': u'1424873155000'
+        }
+
+    def tearDown(self):
+        DBSession.remove()
+        testing.tearDown()
+
+    @patch('eecologysmsreciever.views.DBSession')
+    def test_spoolsWithoutDb(self, mocked_DBSession):
+        request = testing.DummyRequest(post=self.body)
+
+        response = recieve_message(request)
+
+        expected = {'payload': {'success': True, 'error': None}}
+        self.assertEquals(response, expected)
+        del self.body['secret']
+        self.spool.append.assert_called_once_with(self.body)
+        self.assertEqual(mocked_DBSession.mock_calls, [])
+
+    @patch('eecologysmsreciever.views.DBSession')
+    def test_badText_spoolsAndReturnsUnsuccess(self, mocked_DBSession):
+        self.body['message'] = u'hallo'
+        request = testing.DummyRequest(post=self.body)
+
+        response = recieve_message(request)
+
+        expected = {'payload': {'success': False, 'error': 'Invalid message'}}
+        self.assertEquals(response, expected)
+        self.assertTrue(self.spool.append.called)
+
+    @patch('eecologysmsreciever.views.DBSession')
+    def test_spoolError_storesInDb(self, mocked_DBSession):
+        self.spool.append.side_effect = IOError('disk full')
+        request = testing.DummyRequest(post=self.body)
+
+        response = recieve_message(request)
+
+        expected = {'payload': {'success': True, 'error': None}}
+        self.assertEquals(response, expected)
+        mocked_DBSession.commit.assert_called_once_with()
+
+    @patch('eecologysmsreciever.views.DBSession')
+    def test_drainerfailing_storesInDb(self, mocked_DBSession):
+        self.config.registry.spool_drainer = Mock(failing=True)
+        request = testing.DummyRequest(post=self.body)
+
+        response = recieve_message(request)
+
+        expected = {'payload': {'success': True, 'error': None}}
+        self.assertEquals(response, expected)
+        self.assertFalse(self.spool.append.called)
+        self.assertTrue(mocked_DBSession.commit.called)
+
+
+class recieve_messageRecentlySeenTest(TestCase):
+
+    def setUp(self):
+        self.settings = {
+            'secret_key': 'supersecretkey',
+        }
+        self.config = testing.setUp(settings=self.settings)
+        self.config.registry.recent_messages = RecentlySeen()
+        self.config.registry.recent_positions = RecentlySeen()
+        self.body = {
+            'from': u'1234567890',
+            'message': u'1607,4099,0000,014022,031,00820202020204020200,0,722,15133,52797,49561568,523572094,15133,53335,49694351,523804057',
+            'message_id': u'7ba817ec-0c78-41cd-be10-7907ff787d39',
+            'sent_to': u'0987654321',
+            'secret': u'supersecretkey',
+            'device_id': u'a gateway id',
+            'sent_timestamp': u'1424873155000'
+        }
+
+    def tearDown(self):
+        DBSession.remove()
+        testing.tearDown()
+
+    @patch('eecologysmsreciever.views.DBSession')
+    def test_resend_acknowledgedWithoutDb(self, mocked_DBSession):
+        recieve_message(testing.DummyRequest(post=self.body))
+        mocked_DBSession.reset_mock()
+
+        response = recieve_message(testing.DummyRequest(post=self.body))
+
+        expected = {'payload': {'success': True, 'error': None}}
+        self.assertEquals(response, expected)
+        self.assertEqual(mocked_DBSession.mock_calls, [])
+
+    @patch('eecologysmsreciever.views.DBSession')
+    def test_dbError_notremembered(self, mocked_DBSession):
+        mocked_DBSession.add.side_effect = DBAPIError(1, 2, 3, 4)
+        recieve_message(testing.DummyRequest(post=self.body))
+        mocked_DBSession.add.side_effect = None
+
+        recieve_message(testing.DummyRequest(post=self.body))
+
+        self.assertTrue(mocked_DBSession.add.called)
+        self.assertEqual(len(self.config.registry.recent_messages), 1)
+
+    @patch('eecologysmsreciever.views.DBSession')
+    def test_recentposition_skipped(self, mocked_DBSession):
+        recieve_message(testing.DummyRequest(post=self.body))
+        # same positions in another message
+        self.body['message_id'] = u'c6e2a4f5-8b3d-4e2a-9f1c-2d7b8e6a5c40'
+        mocked_DBSession.reset_mock()
+
+        recieve_message(testing.DummyRequest(post=self.body))
+
+        self.assertFalse(mocked_DBSession.begin_nested.called)
+        self.assertFalse(mocked_DBSession.merge.called)
+
+    @patch('eecologysmsreciever.views.DBSession')
+    def test_corewritepath_recentposition_skipped(self, mocked_DBSession):
+        self.config.registry.settings['write_path'] = 'core'
+        connection = mocked_DBSession.connection.return_value
+        recieve_message(testing.DummyRequest(post=self.body))
+        self.body['message_id'] = u'c6e2a4f5-8b3d-4e2a-9f1c-2d7b8e6a5c40'
+        connection.reset_mock()
+
+        recieve_message(testing.DummyRequest(post=self.body))
+
+        # raw message and message, no positions
+        self.assertEqual(connection.execute.call_count, 2)
+
+    @patch('eecologysmsreciever.views.DBSession')
+    def test_countshitsandmisses(self, mocked_DBSession):
+        before = METRICS.collect()[0].get(('sms_recently_seen_total', (('kind', 'message'), ('result', 'hit'))), 0)
+        recieve_message(testing.DummyRequest(post=self.body))
+        recieve_message(testing.DummyRequest(post=self.body))
+
+        counters = METRICS.collect()[0]
+        self.assertEqual(counters[('sms_recently_seen_total', (('kind', 'message'), ('result', 'hit')))], before + 1)
+
+
+class recieve_messageAdmissionTest(TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp(settings={'secret_key': 'supersecretkey'})
+        self.admission = AdmissionControl(Limits(1, None, 5.0), retry_after=60)
+        self.config.registry.admission = self.admission
+        self.body = {
+            'from': u'1234567890',
+            'message': u'1607,4099,0000',
+            'message_id': u'7ba817ec-0c78-41cd-be10-7907ff787d39',
+            'sent_to': u'0987654321',
+            'secret': u'supersecretkey',
+            'device_id': u'a gateway id',
+            'sent_timestamp': u'1424873155000'
+        }
+
+    def tearDown(self):
+        DBSession.remove()
+        testing.tearDown()
+
+    @patch('eecologysmsreciever.views.DBSession')
+    def test_admitted_stored(self, mocked_DBSession):
+        request = testing.DummyRequest(post=self.body)
+
+        response = recieve_message(request)
+
+        self.assertEqual(response, {'payload': {'success': True, 'error': None}})
+        self.assertTrue(mocked_DBSession.commit.called)
+        self.assertEqual(self.admission.in_flight, 0)
+        self.assertEqual(self.admission.admitted, 1)
+
+    @patch('eecologysmsreciever.views.DBSession')
+    def test_overlimit_rejectedwithretryafter(self, mocked_DBSession):
+        self.admission.latency.add(100.0)
+        request = testing.DummyRequest(post=self.body)
+
+        response = recieve_message(request)
+
+        self.assertEqual(response, {'payload': {'success': False, 'error': 'Busy'}})
+        self.assertEqual(request.response.status_int, 503)
+        self.assertEqual(request.response.headers['Retry-After'], '60')
+        self.assertFalse(mocked_DBSession.add.called)
+        self.assertFalse(mocked_DBSession.commit.called)
+
+    @patch('eecologysmsreciever.views.DBSession')
+    def test_dberror_stillreleased(self, mocked_DBSession):
+        mocked_DBSession.commit.side_effect = DBAPIError('INSERT', {}, Exception())
+        request = testing.DummyRequest(post=self.body)
+
+        response = recieve_message(request)
+
+        self.assertEqual(response, {'payload': {'success': False, 'error': 'Database error'}})
+        self.assertEqual(self.admission.in_flight, 0)
+        self.assertEqual(self.admission.gateway_in_flight, {})
+
+    @patch('eecologysmsreciever.views.DBSession')
+    def test_breakeropen_stillreleased(self, mocked_DBSession):
+        self.config.registry.breaker = CircuitBreaker(failure_threshold=1)
+        self.config.registry.breaker.record(False, 0.0)
+        request = testing.DummyRequest(post=self.body)
+
+        response = recieve_message(request)
+
+        self.assertEqual(response['payload']['success'], False)
+        self.assertFalse(mocked_DBSession.add.called)
+        self.assertEqual(self.admission.in_flight, 0)
+
+
+class recieve_messageCircuitBreakerTest(TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp(settings={'secret_key': 'supersecretkey'})
+        self.breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30.0)
+        self.config.registry.breaker = self.breaker
+        self.body = {
+            'from': u'1234567890',
+            'message': u'1607,4099,0000',
+            'message_id': u'7ba817ec-0c78-41cd-be10-7907ff787d39',
+            'sent_to': u'0987654321',
+            'secret': u'supersecretkey',
+            'device_id': u'a gateway id',
+            'sent_timestamp': u'1424873155000'
+        }
+
+    def tearDown(self):
+        DBSession.remove()
+        testing.tearDown()
+
+    @patch('eecologysmsreciever.views.DBSession')
+    def test_dberror_opens(self, mocked_DBSession):
+        mocked_DBSession.commit.side_effect = DBAPIError('INSERT', {}, Exception())
+        request = testing.DummyRequest(post=self.body)
+
+        response = recieve_message(request)
+
+        self.assertEqual(response, {'payload': {'success': False, 'error': 'Database error'}})
+        self.assertEqual(self.breaker.state, OPEN)
+
+    @patch('eecologysmsreciever.views.DBSession')
+    def test_invalidmessage_resetsfailures(self, mocked_DBSession):
+        self.breaker.failure_threshold = 2
+        self.breaker.record(False, 0.1)
+        self.body['message'] = u'hallo'
+        request = testing.DummyRequest(post=self.body)
+
+        recieve_message(request)
+
+        self.assertEqual(self.breaker.failures, 0)
+
+    @patch('eecologysmsreciever.views.DBSession')
+    def test_open_failsfastwithretryafter(self, mocked_DBSession):
+        self.breaker.record(False, 0.1)
+        request = testing.DummyRequest(post=self.body)
+
+        response = recieve_message(request)
+
+        self.assertEqual(response, {'payload': {'success': False, 'error': 'Database unavailable'}})
+        self.assertEqual(request.response.status_int, 503)
+        self.assertIn(request.response.headers['Retry-After'], ('29', '30'))
+        self.assertEqual(mocked_DBSession.mock_calls, [])
+
+
+class recieve_messagesTest(TestCase):
+
+    def setUp(self):
+        self.settings = {
+            'secret_key': 'supersecretkey',
+        }
+        self.config = testing.setUp(settings=self.settings)
+        self.messages = [{
+            'from': u'1234567890',
+            'message': u'1607,4099,0000,014022,031,00820202020204020200,0,722,15133,52797,49561568,523572094',
+            'message_id': u'7ba817ec-0c78-41cd-be10-7907ff787d39',
+            'sent_to': u'0987654321',
+            'device_id': u'a gateway id',
+            'sent_timestamp': u'1424873155000'
+        }, {
+            'from': u'1234567890',
+            'message': u'1607,4099,0000',
+            'message_id': u'8ba817ec-0c78-41cd-be10-7907ff787d39',
+            'sent_to': u'0987654321',
+            'device_id': u'a gateway id',
+            'sent_timestamp': u'1424873156000'
+        }]
+
+    def tearDown(self):
+        DBSession.remove()
+        testing.tearDown()
+
+    def form_request(self, messages, secret=u'supersecretkey'):
+        post = [] if secret is None else [('secret', secret)]
+        for message in messages:
+            post += sorted(message.items())
+        request = Request.blank('/messages/batch', POST=post)
+        request.registry = self.config.registry
+        return request
+
+    def ndjson_request(self, messages, secret=u'supersecretkey'):
+        request = Request.blank('/messages/batch', method='POST')
+        request.content_type = 'application/x-ndjson'
+        lines = [json.dumps(dict(message, secret=secret)) for message in messages] + [u'']
+        request.body = b'\n'.join(line.encode('utf-8') for line in lines)
+        request.registry = self.config.registry
+        return request
+
+    @patch('eecologysmsreciever.views.DBSession')
+    def test_formarrays_returnsResultPerMessage(self, mocked_DBSession):
+        request = self.form_request(self.messages)
+
+        response = recieve_messages(request)
+
+        expected = {'payload': {'success': True, 'error': None, 'results': [
+            {'success': True, 'error': None, 'message_id': u'7ba817ec-0c78-41cd-be10-7907ff787d39'},
+            {'success': True, 'error': None, 'message_id': u'8ba817ec-0c78-41cd-be10-7907ff787d39'},
+        ]}}
+        self.assertEquals(response, expected)
+
+    @patch('eecologysmsreciever.views.DBSession')
+    def test_formarrays_commitsPerMessage(self, mocked_DBSession):
+        request = self.form_request(self.messages)
+
+        recieve_messages(request)
+
+        self.assertFalse(mocked_DBSession.execute.called)
+        self.assertEqual(mocked_DBSession.commit.call_count, 6)
+
+    @patch('eecologysmsreciever.views.DBSession')
+    def test_admissionrejected_retryafter(self, mocked_DBSession):
+        admission = AdmissionControl(Limits(None, None, 5.0), retry_after=60)
+        admission.latency.add(100.0)
+        self.config.registry.admission = admission
+        request = self.form_request(self.messages)
+
+        response = recieve_messages(request)
+
+        errors = [result['error'] for result in response['payload']['results']]
+        self.assertEqual(errors, ['Busy', 'Busy'])
+        self.assertEqual(request.response.status_int, 200)
+        self.assertEqual(request.response.headers['Retry-After'], '60')
+        self.assertFalse(mocked_DBSession.commit.called)
+
+    @patch('eecologysmsreciever.views.DBSession')
+    def test_ndjson_returnsResultPerMessage(self, mocked_DBSession):
+        self.messages[1]['message'] = u'hallo'
+        self.messages[1]['sent_timestamp'] = 1424873156000
+        request = self.ndjson_request(self.messages)
+
+        response = recieve_messages(request)
+
+        expected = {'payload': {'success': True, 'error': None, 'results': [
+            {'success': True, 'error': None, 'message_id': u'7ba817ec-0c78-41cd-be10-7907ff787d39'},
+            {'success': False, 'error': 'Invalid message', 'message_id': u'8ba817ec-0c78-41cd-be10-7907ff787d39'},
+        ]}}
+        self.assertEquals(response, expected)
+
+    @patch('eecologysmsreciever.views.DBSession')
+    def test_badSecret_returnsUnsuccess(self, mocked_DBSession):
+        request = self.form_request(self.messages, secret=u'the wrong secret')
+
+        response = recieve_messages(request)
+
+        expected = {'payload': {'success': False, 'error': 'Forbidden'}}
+        self.assertEquals(response, expected)
+        self.assertFalse(mocked_DBSession.add.called)
+
+    @patch('eecologysmsreciever.views.DBSession')
+    def test_querysecret_returnsForbidden(self, mocked_DBSession):
+        request = self.form_request(self.messages, secret=None)
+        request.query_string = 'secret=supersecretkey'
+
+        response = recieve_messages(request)
+
+        expected = {'payload': {'success': False, 'error': 'Forbidden'}}
+        self.assertEquals(response, expected)
+        self.assertFalse(mocked_DBSession.add.called)
+
+    @patch('eecologysmsreciever.views.DBSession')
+    def test_ndjsonbadsecret_returnsForbidden(self, mocked_DBSession):
+        request = self.ndjson_request(self.messages, secret=u'the wrong secret')
+
+        response = recieve_messages(request)
+
+        expected = {'payload': {'success': False, 'error': 'Forbidden'}}
+        self.assertEquals(response, expected)
+        self.assertFalse(mocked_DBSession.add.called)
+
+    @patch('eecologysmsreciever.views.DBSession')
+    def test_missingfield_returnsInvalidMessage(self, mocked_DBSession):
+        del self.messages[0]['device_id']
+        request = self.ndjson_request(self.messages[:1])
+
+        response = recieve_messages(request)
+
+        expected = [{'success': False, 'error': 'Invalid message', 'message_id': u'7ba817ec-0c78-41cd-be10-7907ff787d39'}]
+        self.assertEquals(response['payload']['results'], expected)
+
+    @patch('eecologysmsreciever.views.DBSession')
+    def test_unequalformarrays_returnsInvalidBatch(self, mocked_DBSession):
+        del self.messages[1]['device_id']
+        request = self.form_request(self.messages)
+
+        response = recieve_messages(request)
+
+        expected = {'payload': {'success': False, 'error': 'Invalid batch'}}
+        self.assertEquals(response, expected)
+
+    @patch('eecologysmsreciever.views.DBSession')
+    def test_rawmessagealreadyexists_returnsSuccess(self, mocked_DBSession):
+        mocked_DBSession.add.side_effect = IntegrityError(1, 2, 3, 4)
+        request = self.form_request(self.messages[:1])
+
+        response = recieve_messages(request)
+
+        expected = [{'success': True, 'error': None, 'message_id': u'7ba817ec-0c78-41cd-be10-7907ff787d39'}]
+        self.assertEquals(response['payload']['results'], expected)
+
+    @patch('eecologysmsreciever.views.DBSession')
+    def test_dbError_returnsUnsuccessPerMessage(self, mocked_DBSession):
+        mocked_DBSession.add.side_effect = DBAPIError(1, 2, 3, 4)
+        request = self.form_request(self.messages[:1])
+
+        response = recieve_messages(request)
+
+        expected = [{'success': False, 'error': 'Database error', 'message_id': u'7ba817ec-0c78-41cd-be10-7907ff787d39'}]
+        self.assertEquals(response['payload']['results'], expected)
+
+
 class StatusTest(TestCase):
 
     @patch('eecologysmsreciever.views.utcnow')
-    @patch('eecologysmsreciever.views.DBSession')
-    def test_it(self, mocked_DBSession, mocked_utcnow):
+    @patch('eecologysmsreciever.views.ReadSession')
+    def test_it(self, mocked_ReadSession, mocked_utcnow):
         mocked_utcnow.return_value = datetime(2014, 9, 18, 12, 43, tzinfo=utc)
         request = testing.DummyRequest()
         request.registry.settings = {'alert_too_old': 4}
@@ -166,19 +710,21 @@ class StatusTest(TestCase):
         response = status(request)
 
         self.assertTrue('version' in response)
-        mocked_DBSession.execute.assert_called_once_with("SET TIME ZONE 'UTC'")
+        self.assertFalse(mocked_ReadSession.execute.called)
 
-    @patch('eecologysmsreciever.views.DBSession')
-    def test_baddbconnection(self, mocked_DBSession):
-        mocked_DBSession.execute.side_effect = DBAPIError(1, 2, 3, 4)
+    @patch('eecologysmsreciever.views.ReadSession')
+    def test_baddbconnection(self, mocked_ReadSession):
+        mocked_ReadSession.query.side_effect = DBAPIError(1, 2, 3, 4)
+        request = testing.DummyRequest()
+        request.registry.settings = {'alert_too_old': 4}
 
         with self.assertRaises(DBAPIError):
-            status(testing.DummyRequest())
+            status(request)
 
     @patch('eecologysmsreciever.views.utcnow')
-    @patch('eecologysmsreciever.views.DBSession')
-    def test_positiontooold(self, mocked_DBSession, mocked_utcnow):
-        mocked_DBSession.execute.side_effect = NoResultFound()
+    @patch('eecologysmsreciever.views.ReadSession')
+    def test_positiontooold(self, mocked_ReadSession, mocked_utcnow):
+        mocked_ReadSession.query.side_effect = NoResultFound()
         mocked_utcnow.return_value = datetime(2015, 9, 18, 12, 43, tzinfo=utc)
         request = testing.DummyRequest()
         request.registry.settings = {'alert_too_old': 4}
@@ -186,3 +732,435 @@ class StatusTest(TestCase):
         with self.assertRaises(HTTPServerError):
             status(request)
 
+    @patch('eecologysmsreciever.views.utcnow')
+    @patch('eecologysmsreciever.views.ReadSession')
+    def test_preparedconnection_executesprepared(self, mocked_ReadSession, mocked_utcnow):
+        mocked_utcnow.return_value = datetime(2014, 9, 18, 12, 43, tzinfo=utc)
+        connection = mocked_ReadSession.connection.return_value
+        connection.info = {'sms_prepared': 'ewkt'}
+        request = testing.DummyRequest()
+        request.registry.settings = {'alert_too_old': 4}
+
+        response = status(request)
+
+        self.assertTrue('version' in response)
+        self.assertFalse(mocked_ReadSession.query.called)
+        args, params = connection.execute.call_args
+        self.assertIn('EXECUTE sms_latest_position', str(args[0]))
+        self.assertEqual(params, {'date_time': datetime(2014, 9, 18, 8, 43)})
+
+    @patch('eecologysmsreciever.views.ReadSession')
+    def test_drainerfailing(self, mocked_ReadSession):
+        testing.setUp()
+        self.addCleanup(testing.tearDown)
+        request = testing.DummyRequest()
+        request.registry.settings = {'alert_too_old': 4}
+        request.registry.spool_drainer = Mock(failing=True, last_error='permission denied for table raw_message')
+
+        with self.assertRaises(HTTPServerError) as e:
+            status(request)
+
+        self.assertIn('permission denied', str(e.exception))
+        self.assertFalse(mocked_ReadSession.query.called)
+
+
+class StatusWatermarkTest(TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp(settings={'alert_too_old': 4})
+        self.watermark = Watermark()
+        self.config.registry.watermark = self.watermark
+        self.request = testing.DummyRequest()
+
+    def tearDown(self):
+        testing.tearDown()
+
+    @patch('eecologysmsreciever.views.utcnow')
+    @patch('eecologysmsreciever.views.ReadSession')
+    def test_recentwatermark_nodbquery(self, mocked_ReadSession, mocked_utcnow):
+        mocked_utcnow.return_value = datetime(2014, 9, 18, 12, 43)
+        self.watermark.update(datetime(2014, 9, 18, 10, 43))
+
+        response = status(self.request)
+
+        self.assertTrue('version' in response)
+        self.assertEqual(mocked_ReadSession.mock_calls, [])
+
+    @patch('eecologysmsreciever.views.utcnow')
+    @patch('eecologysmsreciever.views.ReadSession')
+    def test_breaker_state(self, mocked_ReadSession, mocked_utcnow):
+        mocked_utcnow.return_value = datetime(2014, 9, 18, 12, 43)
+        self.watermark.update(datetime(2014, 9, 18, 10, 43))
+        self.config.registry.breaker = CircuitBreaker()
+
+        response = status(self.request)
+
+        self.assertEqual(response['circuit_breaker'], 'closed')
+
+    @patch('eecologysmsreciever.views.utcnow')
+    @patch('eecologysmsreciever.views.ReadSession')
+    def test_unknownwatermark_fallsbacktodb(self, mocked_ReadSession, mocked_utcnow):
+        mocked_utcnow.return_value = datetime(2014, 9, 18, 12, 43)
+        query = mocked_ReadSession.query.return_value.filter.return_value.limit.return_value
+        query.scalar.return_value = datetime(2014, 9, 18, 11, 43)
+
+        response = status(self.request)
+
+        self.assertTrue('version' in response)
+        self.assertEqual(self.watermark.get(), datetime(2014, 9, 18, 11, 43))
+
+    @patch('eecologysmsreciever.views.utcnow')
+    @patch('eecologysmsreciever.views.ReadSession')
+    def test_oldwatermark_dbcheckedrecently_nodbquery(self, mocked_ReadSession, mocked_utcnow):
+        mocked_utcnow.return_value = datetime(2014, 9, 18, 12, 43)
+        self.watermark.update(datetime(2014, 9, 17, 12, 43))
+        self.watermark.checked()
+
+        with self.assertRaises(HTTPServerError):
+            status(self.request)
+
+        self.assertEqual(mocked_ReadSession.mock_calls, [])
+
+    @patch('eecologysmsreciever.views.DBSession')
+    def test_ingest_raiseswatermark(self, mocked_DBSession):
+        self.config.registry.settings['secret_key'] = 'supersecretkey'
+        self.config.registry.settings['write_path'] = 'core'
+        body = {
+            'from': u'1234567890',
+            'message': u'1607,4099,0000,15133,52797,49561568,523572094,15133,53335,49694351,523804057',
+            'message_id': u'7ba817ec-0c78-41cd-be10-7907ff787d39',
+            'sent_to': u'0987654321',
+            'secret': u'supersecretkey',
+            'device_id': u'a gateway id',
+            'sent_timestamp': u'1424873155000'
+        }
+
+        recieve_message(testing.DummyRequest(post=body))
+
+        self.assertEqual(self.watermark.get(), datetime(2015, 5, 13, 14, 48, 55))
+
+
+class device_statusTest(TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp(settings={'alert_too_old': 4, 'devices.latest': True})
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def row(self, device_info_serial, date_time, battery_voltage, max_age=None, min_battery_voltage=None):
+        row = Mock(device_info_serial=device_info_serial,
+                   date_time=date_time,
+                   lon=4.9,
+                   lat=52.3,
+                   battery_voltage=battery_voltage,
+                   memory_usage=0.0,
+                   gateway_id=u'a gateway id',
+                   message_date_time=datetime(2015, 5, 13, 15, 0, 0),
+                   max_age=max_age,
+                   min_battery_voltage=min_battery_voltage)
+        return row
+
+    def status(self, rows, params=None):
+        with patch('eecologysmsreciever.views.ReadSession') as mocked_ReadSession:
+            with patch('eecologysmsreciever.views.utcnow') as mocked_utcnow:
+                mocked_utcnow.return_value = datetime(2015, 5, 13, 16, 0, 0)
+                mocked_ReadSession.query.return_value.order_by.return_value.all.return_value = rows
+                return device_status(testing.DummyRequest(params=params or {}))
+
+    def test_okdevice_notlisted(self):
+        response = self.status([self.row(1607, datetime(2015, 5, 13, 14, 0, 0), 4.1)])
+
+        self.assertEqual(response, {'devices': []})
+
+    def test_staledevice(self):
+        response = self.status([self.row(1607, datetime(2015, 5, 13, 11, 0, 0), 4.1)])
+
+        expected = {'devices': [{
+            'device_info_serial': 1607,
+            'date_time': '2015-05-13T11:00:00',
+            'lon': 4.9,
+            'lat': 52.3,
+            'battery_voltage': 4.1,
+            'memory_usage': 0.0,
+            'gateway_id': u'a gateway id',
+            'message_date_time': '2015-05-13T15:00:00',
+            'max_age': 4.0,
+            'min_battery_voltage': 3.7,
+            'stale': True,
+            'low_battery': False,
+        }]}
+        self.assertEqual(response, expected)
+
+    def test_nofix_stale(self):
+        response = self.status([self.row(1607, None, 4.1)])
+
+        self.assertTrue(response['devices'][0]['stale'])
+
+    def test_lowbattery(self):
+        response = self.status([self.row(1607, datetime(2015, 5, 13, 14, 0, 0), 3.6)])
+
+        self.assertFalse(response['devices'][0]['stale'])
+        self.assertTrue(response['devices'][0]['low_battery'])
+
+    def test_perdevicethresholds(self):
+        rows = [
+            self.row(1607, datetime(2015, 5, 13, 11, 0, 0), 4.1, max_age=24),
+            self.row(1608, datetime(2015, 5, 13, 14, 0, 0), 3.9, min_battery_voltage=4.0),
+        ]
+
+        response = self.status(rows)
+
+        self.assertEqual([d['device_info_serial'] for d in response['devices']], [1608])
+        self.assertTrue(response['devices'][0]['low_battery'])
+
+    def test_settingthresholds(self):
+        self.config.registry.settings['devices.max_age'] = '1'
+        self.config.registry.settings['devices.min_battery_voltage'] = '4.2'
+
+        response = self.status([self.row(1607, datetime(2015, 5, 13, 14, 0, 0), 4.1)])
+
+        self.assertTrue(response['devices'][0]['stale'])
+        self.assertTrue(response['devices'][0]['low_battery'])
+
+    def test_all(self):
+        response = self.status([self.row(1607, datetime(2015, 5, 13, 14, 0, 0), 4.1)], {'all': 'true'})
+
+        self.assertEqual(len(response['devices']), 1)
+        self.assertFalse(response['devices'][0]['stale'])
+
+    def test_disabled_notfound(self):
+        self.config.registry.settings['devices.latest'] = False
+
+        with self.assertRaises(HTTPNotFound):
+            device_status(testing.DummyRequest())
+
+
+class positionsTest(TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp()
+        self.config.registry.read_engine = Mock()
+        self.connection = self.config.registry.read_engine.connect.return_value
+        self.connection.execute.return_value.first.return_value = (0, None, None)
+        self.params = {'device_info_serial': '1608', 'start': '2015-06-01'}
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def request(self, headers=None):
+        request = Request.blank('/positions', headers=headers)
+        request.GET.update(self.params)
+        request.registry = self.config.registry
+        return request
+
+    def test_streams(self):
+        result = self.connection.execution_options.return_value.execute.return_value
+        result.fetchmany.return_value = []
+        request = self.request()
+
+        response = positions(request)
+
+        self.assertEqual(response.content_type, 'application/json')
+        self.assertIsNotNone(response.etag)
+        self.connection.execution_options.assert_called_once_with(stream_results=True)
+        self.assertEqual(json.loads(response.body.decode('utf-8')), {'positions': [], 'next': None})
+        self.connection.close.assert_called_once_with()
+
+    def test_etagmatches_notmodified(self):
+        etag = positions(self.request()).etag
+        request = self.request({'If-None-Match': '"{0}"'.format(etag)})
+
+        response = positions(request)
+
+        self.assertIsInstance(response, HTTPNotModified)
+        self.assertEqual(self.connection.execution_options.call_count, 1)
+
+    def test_badparams(self):
+        request = testing.DummyRequest(params={'device_info_serial': '1608'})
+
+        with self.assertRaises(HTTPBadRequest):
+            positions(request)
+
+    def test_dberror_closesconnection(self):
+        self.connection.execute.side_effect = DBAPIError(1, 2, 3, 4)
+        request = self.request()
+
+        with self.assertRaises(DBAPIError):
+            positions(request)
+
+        self.connection.close.assert_called_once_with()
+
+    def test_sqlalchemyerror_closesconnection(self):
+        self.connection.execution_options.return_value.execute.side_effect = ResourceClosedError()
+        request = self.request()
+
+        with self.assertRaises(ResourceClosedError):
+            positions(request)
+
+        self.connection.close.assert_called_once_with()
+
+
+class exportTest(TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp()
+        self.config.registry.read_engine = Mock()
+        self.config.registry.exports = Bulkhead(1, 0, 0)
+        self.connection = self.config.registry.read_engine.connect.return_value
+        self.result = self.connection.execution_options.return_value.execute.return_value
+        self.result.fetchmany.return_value = []
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def request(self):
+        request = Request.blank('/export')
+        request.GET.update({'device_info_serial': '1608,1609', 'start': '2015-06-01'})
+        request.registry = self.config.registry
+        return request
+
+    def test_streamsgzip(self):
+        response = export(self.request())
+
+        self.assertEqual(response.content_type, 'application/gzip')
+        self.assertEqual(self.config.registry.exports.active, 1)
+        self.connection.execution_options.assert_called_once_with(stream_results=True)
+        response.app_iter.close()
+        self.connection.close.assert_called_once_with()
+        self.assertEqual(self.config.registry.exports.active, 0)
+
+    def test_exportinprogress_unavailable(self):
+        self.config.registry.exports.acquire()
+
+        with self.assertRaises(HTTPServiceUnavailable):
+            export(self.request())
+
+        self.assertFalse(self.config.registry.read_engine.connect.called)
+
+    def test_dberror_released(self):
+        self.connection.execution_options.return_value.execute.side_effect = DBAPIError(1, 2, 3, 4)
+
+        with self.assertRaises(DBAPIError):
+            export(self.request())
+
+        self.connection.close.assert_called_once_with()
+        self.assertEqual(self.config.registry.exports.active, 0)
+
+
+class readyTest(TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp()
+        self.startup = Startup(100.0, 100.5)
+        self.config.registry.startup = self.startup
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def test_ready(self):
+        self.startup.mark_ready()
+        request = testing.DummyRequest()
+
+        response = ready(request)
+
+        self.assertTrue(response['ready'])
+        self.assertEqual(response['startup']['phases'], {'import': 0.5})
+        self.assertEqual(request.response.status_int, 200)
+
+    def test_starting_notready(self):
+        request = testing.DummyRequest()
+
+        response = ready(request)
+
+        self.assertFalse(response['ready'])
+        self.assertEqual(request.response.status_int, 503)
+
+    def test_breakeropen_notready(self):
+        self.startup.mark_ready()
+        breaker = CircuitBreaker(failure_threshold=1)
+        breaker.record(False, 0.1)
+        self.config.registry.breaker = breaker
+        request = testing.DummyRequest()
+
+        response = ready(request)
+
+        self.assertFalse(response['ready'])
+        self.assertEqual(response['circuit_breaker'], 'open')
+        self.assertEqual(request.response.status_int, 503)
+
+
+class pool_statusTest(TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp()
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def test_it(self):
+        request = testing.DummyRequest()
+        request.registry.engine = Mock()
+        request.registry.engine.pool = Mock()
+
+        self.assertEqual(pool_status(request), {'pid': os.getpid()})
+
+    def test_readpoolandbulkheads(self):
+        request = testing.DummyRequest()
+        request.registry.engine = Mock()
+        request.registry.read_engine = Mock()
+        request.registry.bulkheads = {'read': Bulkhead(2, 1, 5.0)}
+
+        stats = pool_status(request)
+
+        self.assertEqual(stats['read'], {})
+        self.assertEqual(stats['bulkheads']['read']['concurrency'], 2)
+
+    def test_admission(self):
+        request = testing.DummyRequest()
+        request.registry.engine = Mock()
+        request.registry.admission = AdmissionControl(Limits(4, 1.0, 5.0))
+
+        stats = pool_status(request)
+
+        self.assertEqual(stats['admission']['in_flight'], 0)
+        self.assertEqual(stats['admission']['limits']['max_in_flight'], 4)
+
+    def test_breaker(self):
+        request = testing.DummyRequest()
+        request.registry.engine = Mock()
+        request.registry.breaker = CircuitBreaker()
+
+        stats = pool_status(request)
+
+        self.assertEqual(stats['circuit_breaker']['state'], 'closed')
+
+
+class metricsTest(TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp(settings={'secret_key': 'supersecretkey'})
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def outcome_count(self, name):
+        counters, histograms = METRICS.collect()
+        return counters.get(('sms_messages_total', (('outcome', name),)), 0)
+
+    @patch('eecologysmsreciever.views.DBSession')
+    def test_countsoutcome(self, mocked_DBSession):
+        before = self.outcome_count('forbidden')
+        request = testing.DummyRequest(post={'secret': 'wrong'})
+
+        recieve_message(request)
+
+        self.assertEqual(self.outcome_count('forbidden'), before + 1)
+
+    def test_prometheus(self):
+        request = testing.DummyRequest()
+
+        response = metrics(request)
+
+        self.assertEqual(response.content_type, 'text/plain')
+        self.assertIn(u'# TYPE sms_stage_seconds histogram', response.text)
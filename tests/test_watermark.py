@@ -0,0 +1,80 @@
+from datetime import datetime
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from mock import patch
+from pytz import utc
+
+from eecologysmsreciever.watermark import Watermark
+
+
+class WatermarkTest(TestCase):
+
+    def test_unknown(self):
+        self.assertIsNone(Watermark().get())
+
+    def test_update_onlyincreases(self):
+        watermark = Watermark()
+
+        watermark.update(datetime(2015, 5, 13, 14, 48, 55))
+        watermark.update(datetime(2015, 5, 13, 14, 39, 57))
+
+        self.assertEqual(watermark.get(), datetime(2015, 5, 13, 14, 48, 55))
+
+    def test_update_timezoneaware(self):
+        watermark = Watermark()
+
+        watermark.update(datetime(2015, 5, 13, 14, 48, 55, tzinfo=utc))
+
+        self.assertEqual(watermark.get(), datetime(2015, 5, 13, 14, 48, 55))
+
+    @patch('eecologysmsreciever.watermark.time')
+    def test_fallback_due(self, mocked_time):
+        mocked_time.time.return_value = 1000
+        watermark = Watermark(fallback_interval=300)
+        self.assertTrue(watermark.fallback_due())
+
+        watermark.checked()
+        mocked_time.time.return_value = 1299
+        self.assertFalse(watermark.fallback_due())
+
+        mocked_time.time.return_value = 1300
+        self.assertTrue(watermark.fallback_due())
+
+    def test_checked_withdatetime_updates(self):
+        watermark = Watermark()
+
+        watermark.checked(datetime(2015, 5, 13, 14, 48, 55))
+
+        self.assertEqual(watermark.get(), datetime(2015, 5, 13, 14, 48, 55))
+
+
+class SharedWatermarkTest(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'sms.watermark')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_sharedbetweeninstances(self):
+        writer = Watermark(self.path)
+        reader = Watermark(self.path)
+
+        writer.update(datetime(2015, 5, 13, 14, 48, 55))
+
+        self.assertEqual(reader.get(), datetime(2015, 5, 13, 14, 48, 55))
+        writer.close()
+        reader.close()
+
+    def test_survivesrestart(self):
+        watermark = Watermark(self.path)
+        watermark.update(datetime(2015, 5, 13, 14, 48, 55))
+        watermark.close()
+
+        watermark = Watermark(self.path)
+
+        self.assertEqual(watermark.get(), datetime(2015, 5, 13, 14, 48, 55))
+        watermark.close()
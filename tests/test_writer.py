@@ -0,0 +1,268 @@
+from datetime import datetime
+from unittest import TestCase
+import uuid
+from mock import Mock
+from pytz import utc
+
+from eecologysmsreciever.models import RawMessage
+from eecologysmsreciever.parser import parse_body
+from eecologysmsreciever.writer import store_message, insert_positions_statement, naive_utc
+from eecologysmsreciever.writer import INSERT_RAW_MESSAGE, INSERT_MESSAGE, EXECUTE_STORE_MESSAGE_STATEMENTS, PREPARED
+from eecologysmsreciever.writer import prepare_store_message, prepare_statements, prepared_location
+from eecologysmsreciever.writer import UPSERT_DEVICE_LATEST, warm_statements, _insert_positions_statements
+
+
+class store_messageTest(TestCase):
+
+    def setUp(self):
+        self.raw_message = RawMessage()
+        self.raw_message.message_id = uuid.UUID('7ba817ec-0c78-41cd-be10-7907ff787d39')
+        self.raw_message.sent_from = u'1234567890'
+        self.raw_message.body = u'1607,4099,0000,014022,031,00820202020204020200,0,722,15133,52797,49561568,523572094,15133,53335,49694351,523804057'
+        self.raw_message.sent_to = u'0987654321'
+        self.raw_message.gateway_id = u'a gateway id'
+        self.raw_message.sent_timestamp = datetime(2015, 2, 25, 14, 5, 55)
+        self.parsed = parse_body(self.raw_message.body)
+        self.connection = Mock()
+        self.connection.execute.return_value.scalar.return_value = 1234
+
+    def test_storesRawMessageMessageAndPositions(self):
+        raw_id = store_message(self.connection, self.raw_message, self.parsed)
+
+        self.assertEqual(raw_id, 1234)
+        self.assertEqual(self.connection.execute.call_count, 3)
+        calls = self.connection.execute.call_args_list
+        self.assertEqual(calls[0][0][0], INSERT_RAW_MESSAGE)
+        self.assertEqual(calls[0][1]['message_id'], '7ba817ec-0c78-41cd-be10-7907ff787d39')
+        self.assertEqual(calls[1][0][0], INSERT_MESSAGE)
+        self.assertEqual(calls[1][1]['id'], 1234)
+        self.assertEqual(calls[1][1]['date_time'], datetime(2015, 2, 25, 14, 5, 55))
+        self.assertEqual(calls[2][0][0], insert_positions_statement(2))
+        self.assertEqual(calls[2][1]['date_time_0'], datetime(2015, 5, 13, 14, 39, 57))
+        self.assertEqual(calls[2][1]['lon_1'], 4.9694351)
+
+    def test_serverlocation_nolocationparams(self):
+        store_message(self.connection, self.raw_message, self.parsed, 'server')
+
+        calls = self.connection.execute.call_args_list
+        self.assertEqual(calls[2][0][0], insert_positions_statement(2, 'server'))
+        self.assertNotIn('location_0', calls[2][1])
+
+    def test_devicelatest_upsertslatestfix(self):
+        store_message(self.connection, self.raw_message, self.parsed, device_latest=True)
+
+        calls = self.connection.execute.call_args_list
+        self.assertEqual(len(calls), 4)
+        self.assertEqual(calls[3][0][0], UPSERT_DEVICE_LATEST)
+        params = calls[3][0][1]
+        self.assertEqual(params['device_info_serial'], 1607)
+        self.assertEqual(params['message_date_time'], datetime(2015, 2, 25, 14, 5, 55))
+        self.assertEqual(params['battery_voltage'], 4.099)
+        self.assertEqual(params['gateway_id'], u'a gateway id')
+        self.assertEqual(params['date_time'], datetime(2015, 5, 13, 14, 48, 55))
+        self.assertEqual(params['lon'], 4.9694351)
+
+    def test_devicelatest_nopositions_nofix(self):
+        parsed = parse_body(u'1607,4099,0000')
+
+        store_message(self.connection, self.raw_message, parsed, device_latest=True)
+
+        params = self.connection.execute.call_args[0][1]
+        self.assertEqual(params['battery_voltage'], 4.099)
+        self.assertIsNone(params['date_time'])
+
+    def test_devicelatest_duplicateRawMessage_noupsert(self):
+        self.connection.execute.return_value.scalar.return_value = None
+
+        store_message(self.connection, self.raw_message, self.parsed, device_latest=True)
+
+        self.assertEqual(self.connection.execute.call_count, 1)
+
+    def test_duplicateRawMessage_storesNothingElse(self):
+        self.connection.execute.return_value.scalar.return_value = None
+
+        raw_id = store_message(self.connection, self.raw_message, self.parsed)
+
+        self.assertIsNone(raw_id)
+        self.assertEqual(self.connection.execute.call_count, 1)
+
+    def test_unparsedMessage_storesRawMessageOnly(self):
+        raw_id = store_message(self.connection, self.raw_message, None)
+
+        self.assertEqual(raw_id, 1234)
+        self.assertEqual(self.connection.execute.call_count, 1)
+
+    def test_noPositions_skipsPositionInsert(self):
+        parsed = parse_body(u'1607,4099,0000')
+
+        store_message(self.connection, self.raw_message, parsed)
+
+        self.assertEqual(self.connection.execute.call_count, 2)
+
+    def test_samePositionTwice_insertsOnce(self):
+        parsed = parse_body(u'1607,4099,0000,15133,52797,49561568,523572094,15133,52797,49561568,523572094')
+
+        store_message(self.connection, self.raw_message, parsed)
+
+        calls = self.connection.execute.call_args_list
+        self.assertEqual(calls[2][0][0], insert_positions_statement(1))
+
+
+class store_message_preparedTest(TestCase):
+
+    def setUp(self):
+        self.raw_message = RawMessage()
+        self.raw_message.message_id = uuid.UUID('7ba817ec-0c78-41cd-be10-7907ff787d39')
+        self.raw_message.sent_from = u'1234567890'
+        self.raw_message.body = u'1607,4099,0000,014022,031,00820202020204020200,0,722,15133,52797,49561568,523572094,15133,53335,49694351,523804057,15133,53335,49694351,523804057'
+        self.raw_message.sent_to = u'0987654321'
+        self.raw_message.gateway_id = u'a gateway id'
+        self.raw_message.sent_timestamp = datetime(2015, 2, 25, 14, 5, 55)
+        self.parsed = parse_body(self.raw_message.body)
+        self.connection = Mock()
+        self.connection.info = {PREPARED: 'ewkt'}
+        self.connection.execute.return_value.scalar.return_value = 1234
+
+    def test_singlestatement(self):
+        raw_id = store_message(self.connection, self.raw_message, self.parsed)
+
+        self.assertEqual(raw_id, 1234)
+        self.connection.execute.assert_called_once()
+        args, params = self.connection.execute.call_args
+        self.assertIs(args[0], EXECUTE_STORE_MESSAGE_STATEMENTS['ewkt'])
+        self.assertEqual(params['message_id'], '7ba817ec-0c78-41cd-be10-7907ff787d39')
+        self.assertEqual(params['device_info_serial'], 1607)
+        # same fix twice is sent once
+        self.assertEqual(params['date_times'], [datetime(2015, 5, 13, 14, 39, 57), datetime(2015, 5, 13, 14, 48, 55)])
+        self.assertEqual(params['lons'], [4.9561568, 4.9694351])
+        self.assertEqual(params['locations'], ['SRID=4326;POINT(4.9561568 52.3572094)', 'SRID=4326;POINT(4.9694351 52.3804057)'])
+
+    def test_unparsedMessage_nullheader(self):
+        store_message(self.connection, self.raw_message, None)
+
+        args, params = self.connection.execute.call_args
+        self.assertIsNone(params['device_info_serial'])
+        self.assertEqual(params['date_times'], [])
+
+    def test_serverlocation_nolocations(self):
+        self.connection.info = {PREPARED: 'server'}
+
+        store_message(self.connection, self.raw_message, self.parsed, 'server')
+
+        args, params = self.connection.execute.call_args
+        self.assertIs(args[0], EXECUTE_STORE_MESSAGE_STATEMENTS['server'])
+        self.assertNotIn('locations', params)
+        self.assertNotIn(':locations', str(args[0]))
+
+    def test_devicelatest_upsertafterexecute(self):
+        store_message(self.connection, self.raw_message, self.parsed, device_latest=True)
+
+        calls = self.connection.execute.call_args_list
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(calls[1][0][0], UPSERT_DEVICE_LATEST)
+
+    def test_preparedforotherlocation_notused(self):
+        store_message(self.connection, self.raw_message, self.parsed, 'server')
+
+        self.assertEqual(self.connection.execute.call_count, 3)
+
+
+class prepare_statementsTest(TestCase):
+
+    def test_ewkt(self):
+        statement = prepare_store_message('ewkt')
+
+        self.assertIn('double precision[], text[]) AS', statement)
+        self.assertIn('unnest($11, $12, $13, $14) AS p (date_time, lon, lat, location)', statement)
+        self.assertIn('ST_GeomFromEWKT(p.location)', statement)
+
+    def test_server(self):
+        statement = prepare_store_message('server')
+
+        self.assertIn('double precision[]) AS', statement)
+        self.assertIn('unnest($11, $12, $13) AS p (date_time, lon, lat)', statement)
+        self.assertIn('lat, location)', statement)
+        self.assertIn('ST_SetSRID(ST_MakePoint(p.lon, p.lat), 4326)', statement)
+
+    def test_database(self):
+        statement = prepare_store_message('database')
+
+        self.assertIn('unnest($11, $12, $13) AS p (date_time, lon, lat)', statement)
+        self.assertNotIn('location', statement)
+
+    def test_preparesandmarksconnection(self):
+        dbapi_connection = Mock()
+        connection_record = Mock()
+        connection_record.info = {}
+
+        prepare_statements('server')(dbapi_connection, connection_record)
+
+        executed = [c[0][0] for c in dbapi_connection.cursor.return_value.execute.call_args_list]
+        self.assertIn('PREPARE sms_store_message', executed[0])
+        self.assertIn('PREPARE sms_latest_position', executed[1])
+        dbapi_connection.commit.assert_called_once_with()
+        self.assertEqual(connection_record.info, {PREPARED: 'server'})
+
+    def test_prepared_location_unprepared(self):
+        connection = Mock()
+        connection.info = {}
+
+        self.assertIsNone(prepared_location(connection))
+
+
+class insert_positions_statementTest(TestCase):
+
+    def test_cached(self):
+        self.assertIs(insert_positions_statement(3), insert_positions_statement(3))
+
+    def test_warm_statements(self):
+        warm_statements('database', 3)
+
+        self.assertIn((3, 'database'), _insert_positions_statements)
+
+    def test_onconflict(self):
+        statement = str(insert_positions_statement(2))
+
+        self.assertIn(':lat_1', statement)
+        self.assertIn('ON CONFLICT (device_info_serial, date_time) DO NOTHING', statement)
+
+    def test_ewkt(self):
+        statement = str(insert_positions_statement(1))
+
+        self.assertIn('lat, location)', statement)
+        self.assertIn('ST_GeomFromEWKT(:location_0)', statement)
+
+    def test_server(self):
+        statement = str(insert_positions_statement(1, 'server'))
+
+        self.assertIn('lat, location)', statement)
+        self.assertIn('ST_SetSRID(ST_MakePoint(:lon_0, :lat_0), 4326))', statement)
+
+    def test_database(self):
+        statement = str(insert_positions_statement(1, 'database'))
+
+        self.assertIn('lat)', statement)
+        self.assertNotIn('location', statement)
+
+
+class UPSERT_DEVICE_LATESTTest(TestCase):
+
+    def test_outoforder_notoverwritten(self):
+        statement = str(UPSERT_DEVICE_LATEST)
+
+        self.assertIn('ON CONFLICT (device_info_serial) DO UPDATE SET', statement)
+        self.assertIn('battery_voltage = CASE WHEN d.message_date_time IS NULL OR '
+                      'EXCLUDED.message_date_time >= d.message_date_time '
+                      'THEN EXCLUDED.battery_voltage ELSE d.battery_voltage END', statement)
+        self.assertIn('lon = CASE WHEN EXCLUDED.date_time IS NOT NULL AND '
+                      '(d.date_time IS NULL OR EXCLUDED.date_time > d.date_time) '
+                      'THEN EXCLUDED.lon ELSE d.lon END', statement)
+
+
+class naive_utcTest(TestCase):
+
+    def test_aware(self):
+        self.assertEqual(naive_utc(datetime(2015, 5, 13, 14, 39, 57, tzinfo=utc)), datetime(2015, 5, 13, 14, 39, 57))
+
+    def test_naive(self):
+        self.assertEqual(naive_utc(datetime(2015, 5, 13, 14, 39, 57)), datetime(2015, 5, 13, 14, 39, 57))